@@ -0,0 +1,178 @@
+import argparse, random, time
+from pymongo import InsertOne, DeleteMany
+from modules import variables, dbIntegration
+from modules.addressIndex import addressIndex, gapDocument
+
+# Address allocation with a large fleet: overlap checks and available gap updates after each change of a radio's range
+# The previous path scanned every configuredRadio document per check and rebuilt availableModbusAddress (drop, then
+# one insert_one per gap) per change, the address index bisects and persists the changed gaps in one bulk_write
+# Both run against in memory stand ins of the collections that count database round trips and written documents
+# Radios get blockSize register blocks (10k radios of 50 registers do not fit the 16-bit register space)
+# Run from the project root: python -m benchmarks.addressIndexBenchmark --radios 10000 --moves 200
+
+class CountingCollection:
+
+    # Stand in for a pymongo collection, only what the allocation paths call
+
+    def __init__(self, documents=()):
+
+        self.documents = list(documents)
+        self.roundTrips = 0
+        self.writtenDocuments = 0
+
+    def find(self, filter=None, projection=None):
+
+        self.roundTrips += 1
+
+        return [dict(document) for document in self.documents]
+
+    def drop(self):
+
+        self.roundTrips += 1
+        self.documents = []
+
+    def insert_one(self, document):
+
+        self.roundTrips += 1
+        self.writtenDocuments += 1
+        self.documents.append(document)
+
+    def bulk_write(self, operations):
+
+        self.roundTrips += 1
+
+        for operation in operations:
+
+            if isinstance(operation, InsertOne):
+
+                self.writtenDocuments += 1
+                self.documents.append(operation._doc)
+
+            elif isinstance(operation, DeleteMany):
+
+                removedRanges = set(operation._filter["modbusAddressRange"]["$in"])
+                self.documents = [document for document in self.documents if document["modbusAddressRange"] not in removedRanges]
+
+def legacyPolice(configuredRadios, proposedStartAddress, supposedEndAddress):
+
+    for storedAddress in configuredRadios.find({}, {"modbusStartAddress": 1, "modbusEndAddress": 1, "_id": 0}):
+
+        if supposedEndAddress >= int(storedAddress["modbusStartAddress"]) and proposedStartAddress <= int(storedAddress["modbusEndAddress"]):
+
+            return False
+
+    return True
+
+def legacyRebuild(configuredRadios, availableAddresses):
+
+    availableAddresses.drop()
+    utilizedRange = configuredRadios.find({}, {"modbusStartAddress": 1, "modbusEndAddress": 1, "_id": 0})
+    utilizedRange.sort(key=lambda x: x["modbusStartAddress"])
+    previousEnd = variables.lowestRegister - 1
+
+    for address in utilizedRange:
+
+        if address["modbusStartAddress"] - previousEnd > 1:
+
+            availableAddresses.insert_one(gapDocument(previousEnd + 1, address["modbusStartAddress"] - 1))
+
+        previousEnd = max(previousEnd, address["modbusEndAddress"])
+
+    if variables.highestRegister - previousEnd >= 1:
+
+        availableAddresses.insert_one(gapDocument(previousEnd + 1, variables.highestRegister))
+
+def configuredFleet(radioCount, blockSize):
+
+    slots = (variables.highestRegister - variables.lowestRegister + 1) // blockSize
+
+    if radioCount > slots:
+
+        raise ValueError(f"{radioCount} radios of {blockSize} registers do not fit the register space")
+
+    radios = []
+
+    for index, slot in enumerate(sorted(random.sample(range(slots), radioCount))):
+
+        startAddress = variables.lowestRegister + slot * blockSize
+        radios.append({"xbeeMac": f"0013A200{0x40000000 + index:08X}", "modbusStartAddress": startAddress, "modbusEndAddress": startAddress + blockSize - 1})
+
+    return radios
+
+def plannedMoves(radios, moveCount, blockSize):
+
+    # (radio, new start address) pairs, each new block taken from a free gap of the fleet as it is before the moves
+
+    addressIndex.load(radios)
+    freeStarts = [start for gapStart, gapEnd in addressIndex.gaps() for start in range(gapStart, gapEnd - blockSize + 2, blockSize)]
+
+    return [(radio, startAddress) for radio, startAddress in zip(random.sample(radios, moveCount), random.sample(freeStarts, moveCount))]
+
+def runLegacy(radios, moves, blockSize):
+
+    configuredRadios = CountingCollection(dict(radio) for radio in radios)
+    availableAddresses = CountingCollection()
+    byMac = {radio["xbeeMac"]: radio for radio in configuredRadios.documents}
+
+    legacyRebuild(configuredRadios, availableAddresses)
+
+    configuredRadios.roundTrips = availableAddresses.roundTrips = availableAddresses.writtenDocuments = 0
+    startTime = time.perf_counter()
+
+    for radio, startAddress in moves:
+
+        # The radio's own block is not excluded by the previous police, moves always go to a free gap here
+
+        if legacyPolice(configuredRadios, startAddress, startAddress + blockSize - 1):
+
+            byMac[radio["xbeeMac"]].update(modbusStartAddress=startAddress, modbusEndAddress=startAddress + blockSize - 1)
+            legacyRebuild(configuredRadios, availableAddresses)
+
+    return time.perf_counter() - startTime, configuredRadios.roundTrips + availableAddresses.roundTrips, availableAddresses.writtenDocuments, availableAddresses.documents
+
+def runIndexed(radios, moves, blockSize):
+
+    configuredRadios = CountingCollection(dict(radio) for radio in radios)
+    availableAddresses = CountingCollection()
+    dbIntegration.configuredRadioCollection = configuredRadios
+    dbIntegration.availableModbusAddressCollection = availableAddresses
+
+    dbIntegration.loadAddressIndex()
+    dbIntegration.updateReusableAddress()
+
+    configuredRadios.roundTrips = availableAddresses.roundTrips = availableAddresses.writtenDocuments = 0
+    startTime = time.perf_counter()
+
+    for radio, startAddress in moves:
+
+        if dbIntegration.modbusAddressPolice(startAddress, startAddress + blockSize - 1, radio["xbeeMac"]) is True:
+
+            addressIndex.add(startAddress, startAddress + blockSize - 1, radio["xbeeMac"])
+            dbIntegration.updateReusableAddress()
+
+    return time.perf_counter() - startTime, configuredRadios.roundTrips + availableAddresses.roundTrips, availableAddresses.writtenDocuments, availableAddresses.documents
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Modbus address allocation benchmark")
+    parser.add_argument("-r", "--radios", type=int, default=10000, help="Configured radios")
+    parser.add_argument("-m", "--moves", type=int, default=200, help="Radios moved to a free block, each move is one check and one gap update")
+    parser.add_argument("-b", "--block-size", type=int, default=6, help="Registers per radio block")
+    args = parser.parse_args()
+
+    radios = configuredFleet(args.radios, args.block_size)
+    moves = plannedMoves(radios, args.moves, args.block_size)
+
+    print (f"{args.radios:,} radios of {args.block_size} registers, {args.moves} moves")
+    print (f"{'path':<16}{'ms/move':>10}{'round trips/move':>18}{'gap docs written/move':>23}")
+
+    results = {}
+
+    for name, run in (("scan + rebuild", runLegacy), ("address index", runIndexed)):
+
+        elapsed, roundTrips, writtenDocuments, storedGaps = run(radios, moves, args.block_size)
+        results[name] = sorted(gap["modbusAddressRange"] for gap in storedGaps)
+
+        print (f"{name:<16}{elapsed / args.moves * 1000:>10.3f}{roundTrips / args.moves:>18.1f}{writtenDocuments / args.moves:>23.1f}")
+
+    print (f"\nstored gaps identical: {results['scan + rebuild'] == results['address index']} ({len(results['address index']):,} gaps)")
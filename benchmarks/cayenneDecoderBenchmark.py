@@ -0,0 +1,61 @@
+import argparse, timeit
+from python_cayennelpp.decoder import decode
+from modules.cayenneDecoder import decodeCayenneValues
+
+# Compares the per packet decode cost of the previous hex string path against the native bytes decoder
+# Run from the project root: python -m benchmarks.cayenneDecoderBenchmark
+
+payloads = {
+
+    # Scalar records only, the previous path can decode these
+    "temperature+humidity": bytes.fromhex("0167011002683c"),
+    "ten analog inputs": bytes.fromhex("".join(f"{channel:02x}02{channel * 123:04x}" for channel in range(10))),
+    # Multi value records, the previous path fails on float(dict) for these
+    "gps+accelerometer": bytes.fromhex("018806765ff2960a0003e8027104d2fb2e0000"),
+
+}
+
+def legacyDecode(xbeeByteData):
+
+    # Previous cayenneParse decode path: hex string, python_cayennelpp, then a walk over dicts
+
+    sensorValues = []
+
+    for item in decode(xbeeByteData.hex()):
+
+        value = item.get("value")
+
+        if value is not None:
+
+            sensorValues.append(float(value))
+
+    return sensorValues
+
+def timePerCall(function, payload, iterations):
+
+    return min(timeit.repeat(lambda: function(payload), number=iterations, repeat=5)) / iterations
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cayenne LPP decoder microbenchmark")
+    parser.add_argument("-n", "--iterations", type=int, default=20000, help="Decodes per timing run")
+    args = parser.parse_args()
+
+    print (f"{'payload':<24}{'bytes':>6}{'legacy us':>12}{'native us':>12}{'speedup':>10}")
+
+    for name, payload in payloads.items():
+
+        nativeTime = timePerCall(decodeCayenneValues, payload, args.iterations)
+
+        try:
+
+            legacyTime = timePerCall(legacyDecode, payload, args.iterations)
+            legacyText = f"{legacyTime * 1e6:>12.2f}"
+            speedupText = f"{legacyTime / nativeTime:>9.1f}x"
+
+        except TypeError:
+
+            legacyText = f"{'fails':>12}"
+            speedupText = f"{'-':>10}"
+
+        print (f"{name:<24}{len(payload):>6}{legacyText}{nativeTime * 1e6:>12.2f}{speedupText}")
@@ -0,0 +1,187 @@
+import argparse, asyncio, random, threading, time
+from modules import variables, main
+from modules.coordinator import Coordinator
+from modules.routingCache import routingCache
+from modules.downlink import DownlinkQueue, stateShift, counterMask, pointSent
+from modules.modbus import contextManager
+from digi.xbee.models.protocol import XBeeProtocol
+from pymodbus.client import AsyncModbusTcpClient
+from .gatewayLoadBenchmark import syntheticRadios, percentile
+
+# Modbus write back without radios: a modbus client writes control registers of random radios on the real server,
+# the downlink queue sends them through a real Coordinator whose xbee device is a FakeTransmitDevice
+# Reports how many writes were coalesced, checks no radio was sent to more often than downlinkMinInterval,
+# measures client write to transmission latency and reads the status registers back
+# Run from the project root: python -m benchmarks.downlinkBenchmark --radios 500 --rate 200
+
+class FakeTransmitDevice:
+
+    # Duck typed digi-xbee XBeeDevice, only what RemoteXBeeDevice and send_data_async need
+    # Transmissions are recorded as (mac, payload, perf_counter time), failRate of them raise like a closed serial port
+
+    comm_iface = object() # RemoteXBeeDevice requires a communication interface of the local device
+
+    def __init__(self, failRate=0.0):
+
+        self.failRate = failRate
+        self.transmissions = []
+        self.failures = 0
+        self._lock = threading.Lock() # Called from asyncio.to_thread workers
+
+    def get_protocol(self):
+
+        return XBeeProtocol.ZIGBEE
+
+    def is_open(self):
+
+        return True
+
+    def send_data_async(self, remoteDevice, data):
+
+        if random.random() < self.failRate:
+
+            with self._lock:
+
+                self.failures += 1
+
+            raise ConnectionError("simulated serial failure")
+
+        with self._lock:
+
+            self.transmissions.append((str(remoteDevice.get_64bit_addr()), bytes(data), time.perf_counter()))
+
+async def writeControls(port, radios, rate, duration, hotRadios, writeTimes):
+
+    # Writes random values to random control points, hotRadios of the radios get most of the writes so they coalesce
+
+    client = AsyncModbusTcpClient("127.0.0.1", port=port, timeout=2, retries=0)
+
+    await client.connect()
+
+    hot = radios[:hotRadios]
+    writes = 0
+    interval = 1 / rate
+    nextWrite = time.perf_counter()
+    endTime = nextWrite + duration
+
+    try:
+
+        while time.perf_counter() < endTime:
+
+            radio = random.choice(hot) if hot and random.random() < 0.8 else random.choice(radios)
+            point = random.randrange(variables.downlinkControlCount)
+            address = radio["modbusStartAddress"] + variables.downlinkControlOffset + point
+            response = await client.write_register(address, random.randrange(1000))
+
+            if not response.isError():
+
+                writeTimes.setdefault(radio["xbeeMac"], []).append(time.perf_counter())
+                writes += 1
+
+            nextWrite += interval
+            await asyncio.sleep(max(0, nextWrite - time.perf_counter()))
+
+    finally:
+
+        client.close()
+
+    return writes
+
+async def runBenchmark(args):
+
+    variables.downlinkEnabled = True
+    variables.downlinkMinInterval = args.min_interval
+
+    radios = syntheticRadios(args.radios)
+    routingCache.load(radios)
+
+    context = contextManager()
+    device = FakeTransmitDevice(args.fail_rate)
+    coordinator = Coordinator("fake", main.xbeeQueue)
+    coordinator.device = device
+    coordinator.connected = True
+    variables.coordinators = [coordinator]
+
+    variables.downlink = DownlinkQueue(variables.registerImage)
+    variables.downlink.sync(routingCache.routes())
+
+    tasks = [
+
+        asyncio.create_task(main.modbusServer(context, host="127.0.0.1", port=args.modbus_port)),
+        asyncio.create_task(variables.downlink.run())
+
+    ]
+
+    await asyncio.sleep(0.5)
+
+    writeTimes = {}
+    writes = await writeControls(args.modbus_port, radios, args.rate, args.duration, args.hot_radios, writeTimes)
+
+    # Let the rate limited radios drain
+
+    drainDeadline = time.perf_counter() + args.min_interval + 5
+
+    while variables.downlink.stats()["pendingRadios"] and time.perf_counter() < drainDeadline:
+
+        await asyncio.sleep(0.05)
+
+    for task in tasks:
+
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Shortest gap between two transmissions to the same radio, and latency from a write to the first send after it
+
+    sendTimes = {}
+
+    for mac, payload, sentAt in device.transmissions:
+
+        sendTimes.setdefault(mac, []).append(sentAt)
+
+    shortestGap = min((later - earlier for times in sendTimes.values() for earlier, later in zip(times, times[1:])), default=None)
+    latencies = []
+
+    for mac, times in writeTimes.items():
+
+        sent = sendTimes.get(mac, [])
+
+        for writtenAt in times:
+
+            sentAt = next((sentAt for sentAt in sent if sentAt >= writtenAt), None)
+
+            if sentAt is not None:
+
+                latencies.append(sentAt - writtenAt)
+
+    latencies.sort()
+
+    sentStatuses = 0
+
+    for radio in radios[:min(len(radios), 200)]:
+
+        offset, count = routingCache.lookupRoute(radio["xbeeMac"])["controlRange"]
+        statuses = variables.registerImage.read(radio["modbusStartAddress"] + offset + count, count)
+        sentStatuses += sum(1 for status in statuses if status >> stateShift == pointSent and status & counterMask)
+
+    stats = variables.downlink.stats()
+
+    print (f"radios {args.radios} ({args.hot_radios} hot), {args.rate:,.0f} control writes/s offered for {args.duration}s, min interval {args.min_interval}s per radio")
+    print (f"client writes {writes:,}, coalesced {stats['coalesced']:,}, points sent {stats['sent']:,} in {len(device.transmissions):,} transmissions, failed {stats['failed']:,}")
+    print (f"shortest gap between transmissions to one radio {shortestGap if shortestGap is None else f'{shortestGap:.3f}s'}, still pending {stats['pendingPoints']}")
+    print (f"write to transmission latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print (f"status registers reading sent among the first {min(len(radios), 200)} radios: {sentStatuses:,}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Hardware free modbus write back benchmark")
+    parser.add_argument("-r", "--radios", type=int, default=500, help="Number of configured radios")
+    parser.add_argument("-f", "--rate", type=float, default=200, help="Control register writes per second")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Seconds of writes")
+    parser.add_argument("-i", "--min-interval", type=float, default=1, help="Seconds between transmissions to one radio")
+    parser.add_argument("--hot-radios", type=int, default=10, help="Radios receiving 80%% of the writes")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of transmissions the fake device fails")
+    parser.add_argument("--modbus-port", type=int, default=15030, help="Local port of the modbus server under test")
+    args = parser.parse_args()
+
+    asyncio.run(runBenchmark(args))
@@ -0,0 +1,322 @@
+import argparse, asyncio, random, threading, time, psutil
+from modules import variables, main
+from modules.coordinator import Coordinator
+from modules.routingCache import routingCache
+from modules.historyWriter import HistoryWriter
+from modules.ingestBridge import makeDataReceiveCallback
+from modules.gatewayLogging import setupLogging, stopLogging
+from modules.modbus import contextManager
+from pymodbus.client import AsyncModbusTcpClient
+
+# End to end gateway benchmark without radios or mongodb
+# Synthetic coordinators call the real data received callback from their own threads, frames then go through the
+# real ingest bridge, modbusPolling, routing cache, change detection, decoding, register encoding and history writer,
+# the configured radio table and the history collections are replaced by in memory stand ins,
+# and a modbus tcp client keeps reading the register map from the real server while the load runs
+# Ingest to register latency is measured from the callback call to the end of the frame's register write
+# Run from the project root: python -m benchmarks.gatewayLoadBenchmark --radios 5000 --rate 2000
+
+class SyntheticRemoteDevice:
+
+    __slots__ = ("xbeeMacAddress",)
+
+    def __init__(self, xbeeMacAddress):
+
+        self.xbeeMacAddress = xbeeMacAddress
+
+    def get_64bit_addr(self):
+
+        return self.xbeeMacAddress
+
+class SyntheticMessage:
+
+    # Duck typed digi-xbee XBeeMessage, only what the data received callback reads
+
+    __slots__ = ("remote_device", "data", "timestamp")
+
+    def __init__(self, remoteDevice, data, timestamp):
+
+        self.remote_device = remoteDevice
+        self.data = data
+        self.timestamp = timestamp
+
+def mappedBlocks(radioCount):
+
+    return min(radioCount, (variables.highestRegister - variables.lowestRegister + 1) // variables.incrementalModbusAddress)
+
+def syntheticRadios(radioCount):
+
+    # Configured radio documents as configureXbeeRadio stores them, with the register layout already learned
+    # The register range only holds (highestRegister - lowestRegister + 1) / incrementalModbusAddress radios,
+    # larger fleets wrap around it so several radios share a block, which is fine for load measurements
+
+    radios = []
+
+    for index in range(radioCount):
+
+        startAddress = variables.lowestRegister + (index % mappedBlocks(radioCount)) * variables.incrementalModbusAddress
+
+        radios.append({
+
+            "xbeeNodeIdentifier": f"SIM{index:05d}",
+            "xbeeMac": f"0013A200{0x40000000 + index:08X}",
+            "modbusStartAddress": startAddress,
+            "modbusEndAddress": startAddress + variables.incrementalModbusAddress - 1,
+            "registerLayout": [[1, 0x67], [2, 0x68], [3, 0x74], [4, 0x64]] # Channels of syntheticPayload, stored as the gateway learns them
+
+        })
+
+    return radios
+
+def syntheticPayload(sequence):
+
+    # Temperature, humidity, battery voltage and a packet counter, a typical sensor node frame
+
+    temperature = random.randint(150, 300)
+    humidity = random.randint(60, 180)
+    voltage = random.randint(330, 420)
+
+    return bytes((1, 0x67)) + temperature.to_bytes(2, "big", signed=True) + bytes((2, 0x68, humidity, 3, 0x74)) + voltage.to_bytes(2, "big") + bytes((4, 0x64)) + (sequence & 0xFFFFFFFF).to_bytes(4, "big")
+
+class SyntheticFrameSource:
+
+    # One simulated coordinator: a thread calling the data received callback at rate frames/s
+    # With burst > 1 frames are sent back to back in groups of burst, the average rate stays the same
+
+    def __init__(self, name, radios, ingestBridge, rate, burst, sentTimes):
+
+        self.coordinator = Coordinator(name, ingestBridge)
+        self.coordinator.connected = True
+        self.callback = makeDataReceiveCallback(ingestBridge, self.coordinator)
+        self.remoteDevices = [SyntheticRemoteDevice(radio["xbeeMac"]) for radio in radios]
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.sentTimes = sentTimes
+        self.sentFrames = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"synthetic-{name}", daemon=True)
+
+    def start(self):
+
+        self._thread.start()
+
+    def stop(self):
+
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+
+        burstInterval = self.burst / self.rate
+        nextBurst = time.perf_counter()
+        remoteDevices = self.remoteDevices
+        sentTimes = self.sentTimes
+
+        while not self._stop.is_set():
+
+            delay = nextBurst - time.perf_counter()
+
+            if delay > 0:
+
+                time.sleep(delay)
+
+            for _ in range(self.burst):
+
+                payload = syntheticPayload(self.sentFrames)
+                message = SyntheticMessage(random.choice(remoteDevices), payload, time.time())
+
+                # Keyed by the payload object itself, it travels untouched from the callback to processFrame
+                sentTimes[id(payload)] = (time.perf_counter(), payload)
+                self.callback(message)
+                self.sentFrames += 1
+
+            # Fixed schedule, a late burst is followed immediately by the next one instead of lowering the rate
+            nextBurst += burstInterval
+
+class InMemoryHistory:
+
+    # Stand in for storeXbeeHistoryBatch, optionally waiting dbLatency seconds per batch like a remote mongodb
+
+    def __init__(self, dbLatency=0.0):
+
+        self.dbLatency = dbLatency
+        self.storedDocuments = 0
+        self.collections = set()
+
+    def storeBatch(self, historyBatch):
+
+        if self.dbLatency:
+
+            time.sleep(self.dbLatency)
+
+        for xbeeMacAddress, document in historyBatch:
+
+            self.collections.add(xbeeMacAddress)
+
+        self.storedDocuments += len(historyBatch)
+
+        return {"success": f"stored {len(historyBatch)} history documents", "inserted": len(historyBatch)}
+
+async def pollRegisters(port, stop, pollInterval, pollLatencies, highestAddress):
+
+    # Reads every register assigned to a radio, from lowestRegister up to highestAddress (excluded)
+
+    client = AsyncModbusTcpClient("127.0.0.1", port=port, timeout=2, retries=0)
+
+    await client.connect()
+
+    try:
+
+        while not stop.is_set():
+
+            for address in range(variables.lowestRegister, highestAddress, 100):
+
+                startTime = time.perf_counter()
+                response = await client.read_holding_registers(address, count=min(100, highestAddress - address))
+
+                if not response.isError():
+
+                    pollLatencies.append(time.perf_counter() - startTime)
+
+            await asyncio.sleep(pollInterval)
+
+    finally:
+
+        client.close()
+
+def percentile(samples, fraction):
+
+    if not samples:
+
+        return 0.0
+
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+async def runBenchmark(args):
+
+    radios = syntheticRadios(args.radios)
+    routingCache.load(radios)
+
+    history = InMemoryHistory(args.db_latency)
+    variables.historyWriter = HistoryWriter(history.storeBatch)
+
+    sentTimes = {}
+    latencies = []
+
+    async def timedProcessFrame(registerImage, mac, raw_data, coordinator=None, receivedAt=None):
+
+        await processFrame(registerImage, mac, raw_data, coordinator, receivedAt)
+
+        sent = sentTimes.pop(id(raw_data), None)
+
+        if sent is not None:
+
+            latencies.append(time.perf_counter() - sent[0])
+
+    # modbusPolling builds its processing stage around main.processFrame, wrapping it times every frame end to end
+    processFrame = main.processFrame
+    main.processFrame = timedProcessFrame
+
+    context = contextManager()
+    main.xbeeQueue.bindLoop()
+
+    sources = [SyntheticFrameSource(f"synthetic{index}", radios[index::args.coordinators], main.xbeeQueue, args.rate / args.coordinators, args.burst, sentTimes) for index in range(args.coordinators)]
+    variables.coordinators = [source.coordinator for source in sources]
+    variables.radioFlag = True
+
+    stopPolling = asyncio.Event()
+    pollLatencies = []
+
+    tasks = [
+
+        asyncio.create_task(main.modbusPolling(variables.registerImage)),
+        asyncio.create_task(variables.historyWriter.run()),
+        asyncio.create_task(main.modbusServer(context, host="127.0.0.1", port=args.modbus_port))
+
+    ]
+
+    await asyncio.sleep(0.5)
+
+    pollTask = asyncio.create_task(pollRegisters(args.modbus_port, stopPolling, args.poll_interval, pollLatencies, variables.lowestRegister + mappedBlocks(args.radios) * variables.incrementalModbusAddress))
+    process = psutil.Process()
+    process.cpu_percent()
+    peakRss = process.memory_info().rss
+    startTime = time.perf_counter()
+
+    for source in sources:
+
+        source.start()
+
+    while time.perf_counter() - startTime < args.duration:
+
+        await asyncio.sleep(0.5)
+        peakRss = max(peakRss, process.memory_info().rss)
+
+    for source in sources:
+
+        source.stop()
+
+    sendElapsed = time.perf_counter() - startTime
+
+    # Let queued frames finish so the latency tail includes them
+
+    drainDeadline = time.perf_counter() + 10
+
+    while (main.xbeeQueue.qsize() or any(variables.processingStage.shardDepths())) and time.perf_counter() < drainDeadline:
+
+        await asyncio.sleep(0.05)
+
+    elapsed = time.perf_counter() - startTime
+    cpuPercent = process.cpu_percent()
+    peakRss = max(peakRss, process.memory_info().rss)
+
+    stopPolling.set()
+    await pollTask
+
+    await variables.historyWriter.flush()
+
+    for task in tasks:
+
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    main.processFrame = processFrame
+
+    sentFrames = sum(source.sentFrames for source in sources)
+    ingestStats = main.xbeeQueue.stats()
+    latencies.sort()
+    pollLatencies.sort()
+
+    print (f"radios {args.radios}, coordinators {args.coordinators}, offered {args.rate:,.0f} frames/s in bursts of {args.burst}, {args.duration}s")
+    print (f"sent {sentFrames:,} frames ({sentFrames / sendElapsed:,.0f}/s), written to registers {len(latencies):,} ({len(latencies) / elapsed:,.0f}/s sustained)")
+    print (f"dropped {ingestStats['dropped']:,}, coalesced {ingestStats['coalesced']:,}, still queued {len(sentTimes) - ingestStats['dropped'] - ingestStats['coalesced']:,}")
+    print (f"ingest to register latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms, max {percentile(latencies, 1.0) * 1000:.2f} ms")
+    print (f"modbus reads {len(pollLatencies):,}, p50 {percentile(pollLatencies, 0.5) * 1000:.2f} ms, p99 {percentile(pollLatencies, 0.99) * 1000:.2f} ms")
+    print (f"history documents stored {history.storedDocuments:,} in {len(history.collections):,} collections, dropped past the backlog {variables.historyWriter.stats()['droppedDocuments']:,}")
+    print (f"cpu {cpuPercent:.0f}% of one core, peak rss {peakRss / 1024 / 1024:.1f} MiB")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Hardware free end to end gateway load benchmark")
+    parser.add_argument("-r", "--radios", type=int, default=2000, help="Number of simulated radios")
+    parser.add_argument("-c", "--coordinators", type=int, default=1, help="Number of simulated coordinator radios sharing the load")
+    parser.add_argument("-f", "--rate", type=float, default=1000, help="Offered frames per second over all coordinators")
+    parser.add_argument("-b", "--burst", type=int, default=1, help="Frames sent back to back per burst, 1 sends evenly spaced frames")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Seconds of load")
+    parser.add_argument("-l", "--db-latency", type=float, default=0.0, help="Simulated seconds per history batch write")
+    parser.add_argument("-p", "--poll-interval", type=float, default=0.1, help="Seconds between full register map reads of the modbus client")
+    parser.add_argument("--modbus-port", type=int, default=15020, help="Local port of the modbus server under test")
+    parser.add_argument("--log-level", default="WARNING", help="Gateway log level during the run")
+    args = parser.parse_args()
+
+    setupLogging(logFile="", level=args.log_level, console=True)
+
+    try:
+
+        asyncio.run(runBenchmark(args))
+
+    finally:
+
+        stopLogging()
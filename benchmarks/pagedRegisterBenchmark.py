@@ -0,0 +1,156 @@
+import argparse, asyncio, random, time, tracemalloc
+from array import array
+from modules.modbus import RegisterEncoder, RegisterImage, RegisterImageBlock, contextManager
+from pymodbus.server import ModbusTcpServer
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.datastore import ModbusSequentialDataBlock
+
+# Memory and read latency of the paged register image over the whole 16-bit address space
+# Radios get blocks either packed from register 0 or scattered over the address space, each writes one 10 float frame,
+# then 125 register requests at random assigned addresses are timed on the pymodbus datablock
+# The same layout is compared with a flat 65536 register array and the list backed ModbusSequentialDataBlock
+# A final run serves the paged image to a modbus client to show the end to end read latency
+# Run from the project root: python -m benchmarks.pagedRegisterBenchmark --radios 100 1000 3000
+
+registerSpace = 65536
+
+class FlatRegisters(array):
+
+    # The register image as one preallocated array('H'), the layout the paged image replaced
+
+    def read(self, startAddress, count):
+
+        return self[startAddress:startAddress + count]
+
+def radioBlocks(radioCount, blockSize, scattered):
+
+    slots = registerSpace // blockSize
+
+    if radioCount > slots:
+
+        raise ValueError(f"{radioCount} radios of {blockSize} registers do not fit in {registerSpace} registers")
+
+    chosen = random.sample(range(slots), radioCount) if scattered else range(radioCount)
+
+    return [slot * blockSize for slot in chosen]
+
+def buildDatastores(startAddresses, frame):
+
+    # Returns (name, datablock, bytes allocated for the registers) per datastore, holding and input counted separately
+    # when the datastore keeps them apart
+
+    datastores = []
+
+    tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    registerImage = RegisterImage(registerSpace, sharedInputRegisters=True)
+
+    for startAddress in startAddresses:
+
+        registerImage.write(startAddress, frame)
+
+    datastores.append(("paged image", RegisterImageBlock(registerImage.holding), tracemalloc.get_traced_memory()[0] - before))
+
+    before = tracemalloc.get_traced_memory()[0]
+    flatImage = FlatRegisters("H", bytes(2 * registerSpace))
+    flatView = memoryview(flatImage)
+
+    for startAddress in startAddresses:
+
+        flatView[startAddress:startAddress + len(frame)] = frame
+
+    datastores.append(("flat array", RegisterImageBlock(flatImage), tracemalloc.get_traced_memory()[0] - before))
+
+    before = tracemalloc.get_traced_memory()[0]
+    holdingBlock = ModbusSequentialDataBlock(1, [0] * registerSpace)
+    inputBlock = ModbusSequentialDataBlock(1, [0] * registerSpace)
+    registers = frame.tolist()
+
+    for startAddress in startAddresses:
+
+        holdingBlock.setValues(startAddress + 1, list(registers))
+        inputBlock.setValues(startAddress + 1, list(registers))
+
+    datastores.append(("sequential blocks", holdingBlock, tracemalloc.get_traced_memory()[0] - before))
+
+    tracemalloc.stop()
+
+    return datastores, registerImage
+
+def timeReads(block, readAddresses):
+
+    startTime = time.perf_counter_ns()
+
+    for address in readAddresses:
+
+        block.getValues(address + 1, 125)
+
+    return (time.perf_counter_ns() - startTime) / len(readAddresses)
+
+async def pollImage(registerImage, startAddresses, blockSize, duration, port):
+
+    server = ModbusTcpServer(contextManager(registerImage), address=("127.0.0.1", port))
+    serverTask = asyncio.create_task(server.serve_forever())
+
+    await asyncio.sleep(0.3)
+
+    client = AsyncModbusTcpClient("127.0.0.1", port=port, timeout=2, retries=0)
+
+    await client.connect()
+
+    latencies = []
+    endTime = time.perf_counter() + duration
+
+    while time.perf_counter() < endTime:
+
+        startAddress = random.choice(startAddresses)
+        startTime = time.perf_counter()
+        response = await client.read_holding_registers(startAddress, count=blockSize)
+
+        if not response.isError():
+
+            latencies.append(time.perf_counter() - startTime)
+
+    client.close()
+    await server.shutdown()
+    serverTask.cancel()
+
+    await asyncio.gather(serverTask, return_exceptions=True)
+
+    latencies.sort()
+
+    return len(latencies) / duration, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Paged register image memory and read latency")
+    parser.add_argument("-r", "--radios", type=int, nargs="+", default=[100, 1000, 3000], help="Configured radio counts to measure")
+    parser.add_argument("-b", "--block-size", type=int, default=20, help="Registers per radio block (10 floats take 20)")
+    parser.add_argument("-n", "--reads", type=int, default=100000, help="Datablock reads timed per datastore")
+    parser.add_argument("-d", "--duration", type=float, default=3, help="Seconds of modbus client polling for the largest fleet")
+    parser.add_argument("-p", "--port", type=int, default=15050, help="Local port of the polled server")
+    args = parser.parse_args()
+
+    frame = RegisterEncoder(maxValues=10).encode([random.uniform(-100, 100) for _ in range(10)])
+    frame = memoryview(array("H", frame.tobytes()))
+
+    print (f"{'radios':>7}  {'layout':<10}{'datastore':<20}{'KiB':>9}{'ns/read':>10}")
+
+    for radioCount in args.radios:
+
+        for scattered in (False, True):
+
+            startAddresses = radioBlocks(radioCount, args.block_size, scattered)
+            readAddresses = [min(random.choice(startAddresses), registerSpace - 125) for _ in range(args.reads)]
+            datastores, registerImage = buildDatastores(startAddresses, frame)
+
+            for name, block, allocated in datastores:
+
+                print (f"{radioCount:>7}  {'scattered' if scattered else 'packed':<10}{name:<20}{allocated / 1024:>9.1f}{timeReads(block, readAddresses):>10,.0f}")
+
+            print (f"{'':>7}  {'':<10}{'paged image pages':<20}{registerImage.stats()['allocatedPages']:>9} of {len(registerImage.holding._pages)}")
+
+    requestsPerSecond, p50, p99 = asyncio.run(pollImage(registerImage, startAddresses, args.block_size, args.duration, args.port))
+
+    print (f"\nmodbus client reading {args.block_size} register blocks of {args.radios[-1]} scattered radios: {requestsPerSecond:,.0f} requests/s, p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms")
@@ -0,0 +1,95 @@
+import argparse, asyncio, random, time
+from modules.ingestBridge import IngestBridge
+from modules.processingPool import ShardedProcessingStage
+
+# Throughput of the sharded processing stage for a growing number of workers
+# Each frame is decoded through the stage and then waits --io-latency seconds, standing in for a slow database call
+# Per radio ordering is checked on every frame
+# Run from the project root: python -m benchmarks.processingPoolBenchmark
+
+def makeFrames(frameCount, radioCount):
+
+    macAddresses = [f"0013A200{random.getrandbits(32):08X}" for _ in range(radioCount)]
+    frames = []
+
+    for sequence in range(frameCount):
+
+        # Temperature on channel 1 and the sequence number as a generic sensor on channel 2
+
+        payload = bytes.fromhex(f"016700{random.randint(0, 255):02x}0264{sequence:08x}")
+        frames.append((macAddresses[sequence % radioCount], payload))
+
+    return frames
+
+async def runStage(frames, workerCount, ioLatency, decodeOffload):
+
+    ingestBridge = IngestBridge(capacity=len(frames), overflowPolicy="dropNewest")
+    lastSequence = {}
+    outOfOrder = 0
+    processed = 0
+    finished = asyncio.Event()
+
+    async def processFrame(xbeeMacAddress, xbeeDataAsByte, coordinator, receivedAt):
+
+        nonlocal outOfOrder, processed
+
+        records = await stage.decode(xbeeDataAsByte)
+        sequence = records[1][2]
+
+        if sequence < lastSequence.get(xbeeMacAddress, -1):
+
+            outOfOrder += 1
+
+        lastSequence[xbeeMacAddress] = sequence
+
+        if ioLatency:
+
+            await asyncio.sleep(ioLatency)
+
+        processed += 1
+
+        if processed == len(frames):
+
+            finished.set()
+
+    stage = ShardedProcessingStage(ingestBridge, processFrame, workerCount=workerCount, shardCapacity=1000, decodeOffload=decodeOffload)
+
+    for xbeeMacAddress, payload in frames:
+
+        ingestBridge.put(xbeeMacAddress, payload)
+
+    startTime = time.perf_counter()
+    stageTask = asyncio.create_task(stage.run())
+    await finished.wait()
+    elapsed = time.perf_counter() - startTime
+    stageTask.cancel()
+
+    try:
+
+        await stageTask
+
+    except asyncio.CancelledError:
+
+        pass
+
+    return len(frames) / elapsed, outOfOrder
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Sharded processing stage scaling benchmark")
+    parser.add_argument("-f", "--frames", type=int, default=20000, help="Frames pushed through the stage per run")
+    parser.add_argument("-r", "--radios", type=int, default=500, help="Number of simulated radios")
+    parser.add_argument("-l", "--io-latency", type=float, default=0.001, help="Simulated database wait per frame in seconds")
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Worker counts to measure")
+    parser.add_argument("-o", "--decode-offload", choices=["thread", "process"], default=None, help="Offload decoding to a pool")
+    args = parser.parse_args()
+
+    frames = makeFrames(args.frames, args.radios)
+
+    print (f"{'workers':>8}{'frames/s':>12}{'out of order':>14}")
+
+    for workerCount in args.workers:
+
+        framesPerSecond, outOfOrder = asyncio.run(runStage(frames, workerCount, args.io_latency, args.decode_offload))
+
+        print (f"{workerCount:>8}{framesPerSecond:>12,.0f}{outOfOrder:>14}")
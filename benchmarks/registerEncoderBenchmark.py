@@ -0,0 +1,64 @@
+import argparse, random, timeit
+from modules.modbus import RegisterEncoder, ProfileEncoder, floatToRegisters
+
+# Throughput of the bulk register encoder against the previous per float loop, then of per radio register profiles
+# Run from the project root: python -m benchmarks.registerEncoderBenchmark
+
+def legacyEncode(sensorValues):
+
+    # Previous modbusPolling path: one pack/unpack per float, list extends, then a slice to 20 registers
+
+    registerValues = []
+
+    for val in sensorValues:
+
+        registerValues.extend(floatToRegisters(val))
+
+    return registerValues[:20]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Float to register encoder throughput benchmark")
+    parser.add_argument("-n", "--iterations", type=int, default=50000, help="Encodes per timing run")
+    args = parser.parse_args()
+
+    encoder = RegisterEncoder(maxValues=10)
+    swappedEncoder = RegisterEncoder(maxValues=10, wordOrder="big", byteOrder="little")
+
+    print (f"{'values':>7}{'legacy pkt/s':>16}{'bulk pkt/s':>14}{'bulk+list pkt/s':>18}{'swapped pkt/s':>16}")
+
+    for valueCount in (2, 5, 10):
+
+        sensorValues = [random.uniform(-1000, 1000) for _ in range(valueCount)]
+        timings = []
+
+        for function in (legacyEncode, encoder.encode, lambda values: encoder.encode(values).tolist(), swappedEncoder.encode):
+
+            bestTime = min(timeit.repeat(lambda: function(sensorValues), number=args.iterations, repeat=5))
+            timings.append(args.iterations / bestTime)
+
+        print (f"{valueCount:>7}{timings[0]:>16,.0f}{timings[1]:>14,.0f}{timings[2]:>18,.0f}{timings[3]:>16,.0f}")
+
+    # Register profiles: registers written per frame and encodes per second, 20 values in a 50 register block
+
+    profiles = {
+
+        "float32 (no profile)": None,
+        "float32 CDAB profile": ["float32"],
+        "float32 ABCD": [{"type": "float32", "order": "ABCD"}],
+        "float32 DCBA": [{"type": "float32", "order": "DCBA"}],
+        "int16 x10": [{"type": "int16", "scale": 10}],
+        "int16 x10 + uint32": [{"type": "int16", "scale": 10}] * 19 + ["uint32"]
+
+    }
+
+    sensorValues = [random.uniform(-1000, 1000) for _ in range(20)]
+
+    print (f"\n{'profile':<24}{'registers':>10}{'pkt/s':>14}")
+
+    for name, profile in profiles.items():
+
+        profileEncoder = RegisterEncoder(maxValues=25) if profile is None else ProfileEncoder(profile, 50)
+        bestTime = min(timeit.repeat(lambda: profileEncoder.encode(sensorValues), number=args.iterations, repeat=5))
+
+        print (f"{name:<24}{len(profileEncoder.encode(sensorValues)):>10}{args.iterations / bestTime:>14,.0f}")
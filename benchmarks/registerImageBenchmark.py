@@ -0,0 +1,155 @@
+import argparse, asyncio, random, time
+from array import array
+from modules.modbus import RegisterEncoder, RegisterImage, contextManager
+from pymodbus.server import ModbusTcpServer
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSequentialDataBlock
+
+# Register image datablock against the list backed ModbusSequentialDataBlocks it replaced
+# Part one times the per frame register write, part two serves both datastores to concurrent modbus clients
+# while frames keep being written, and reports the reads answered
+# Run from the project root: python -m benchmarks.registerImageBenchmark
+
+def legacyContext(registerCount):
+
+    store = ModbusSlaveContext(
+        di=ModbusSequentialDataBlock(0, [0]*registerCount),
+        co=ModbusSequentialDataBlock(0, [0]*registerCount),
+        hr=ModbusSequentialDataBlock(0, [0]*registerCount),
+        ir=ModbusSequentialDataBlock(0, [0]*registerCount),
+    )
+
+    return ModbusServerContext(slaves=store, single=True)
+
+def legacyWriter(context):
+
+    # The write processFrame used to do: a list of python ints set into the holding and then the input block
+
+    legacyStore = context[0]
+
+    def legacyWrite(startAddress, registers):
+
+        registers = registers.tolist()
+        legacyStore.setValues(3, startAddress, registers)
+        legacyStore.setValues(4, startAddress, registers)
+
+    return legacyWrite
+
+def frameWriters(registerCount):
+
+    # Each writer takes (start address, encoded register memoryview) like processFrame
+
+    return {
+
+        "sequential blocks": legacyWriter(legacyContext(registerCount)),
+        "image, separate FC4": RegisterImage(registerCount, sharedInputRegisters=False).write,
+        "image, shared FC4": RegisterImage(registerCount, sharedInputRegisters=True).write
+
+    }
+
+def timeWrites(writeCount, registerCount):
+
+    encoder = RegisterEncoder(maxValues=10)
+    frames = [(random.randrange(0, registerCount - 20), encoder.encode([random.uniform(-100, 100) for _ in range(random.randint(2, 10))]).tobytes()) for _ in range(1000)]
+    frames = [(startAddress, memoryview(array("H", registerBytes))) for startAddress, registerBytes in frames]
+
+    print (f"{'datastore':<22}{'ns/write':>10}")
+
+    for name, write in frameWriters(registerCount).items():
+
+        startTime = time.perf_counter_ns()
+
+        for index in range(writeCount):
+
+            startAddress, registers = frames[index % 1000]
+            write(startAddress, registers)
+
+        print (f"{name:<22}{(time.perf_counter_ns() - startTime) / writeCount:>10,.0f}")
+
+async def pollUnderLoad(name, context, write, registerCount, clientCount, duration, writeRate, port):
+
+    server = ModbusTcpServer(context, address=("127.0.0.1", port))
+    serverTask = asyncio.create_task(server.serve_forever())
+
+    await asyncio.sleep(0.3)
+
+    encoder = RegisterEncoder(maxValues=10)
+    stop = asyncio.Event()
+    latencies = []
+
+    async def writer():
+
+        while not stop.is_set():
+
+            write(random.randrange(0, registerCount - 20), encoder.encode([random.uniform(-100, 100) for _ in range(10)]))
+
+            await asyncio.sleep(1 / writeRate)
+
+    async def poller():
+
+        client = AsyncModbusTcpClient("127.0.0.1", port=port, timeout=2, retries=0)
+
+        await client.connect()
+
+        try:
+
+            while not stop.is_set():
+
+                for address in range(0, registerCount, 125):
+
+                    startTime = time.perf_counter()
+                    response = await client.read_holding_registers(address, count=min(125, registerCount - address))
+
+                    if not response.isError():
+
+                        latencies.append(time.perf_counter() - startTime)
+
+        finally:
+
+            client.close()
+
+    tasks = [asyncio.create_task(writer())] + [asyncio.create_task(poller()) for _ in range(clientCount)]
+
+    await asyncio.sleep(duration)
+
+    stop.set()
+    await asyncio.gather(*tasks)
+    await server.shutdown()
+    serverTask.cancel()
+
+    await asyncio.gather(serverTask, return_exceptions=True)
+
+    latencies.sort()
+
+    print (f"{name:<22}{len(latencies) / duration:>12,.0f}{latencies[len(latencies) // 2] * 1000:>10.2f}{latencies[int(len(latencies) * 0.99)] * 1000:>10.2f}")
+
+async def runPolling(args):
+
+    print (f"\n{args.clients} clients reading the whole map in 125 register requests, {args.write_rate:,.0f} frame writes/s")
+    print (f"{'datastore':<22}{'reads/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+
+    # Rounds alternate between the datastores, a single run of each is within the noise of the server's own work
+
+    for round in range(args.rounds):
+
+        legacy = legacyContext(args.registers)
+        registerImage = RegisterImage(args.registers, sharedInputRegisters=True)
+        port = args.port + 2 * round
+
+        await pollUnderLoad("sequential blocks", legacy, legacyWriter(legacy), args.registers, args.clients, args.duration, args.write_rate, port)
+        await pollUnderLoad("image, shared FC4", contextManager(registerImage), registerImage.write, args.registers, args.clients, args.duration, args.write_rate, port + 1)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Register image datablock benchmark")
+    parser.add_argument("-w", "--writes", type=int, default=200000, help="Frame writes timed per datastore")
+    parser.add_argument("-n", "--registers", type=int, default=1000, help="Registers in the map")
+    parser.add_argument("-c", "--clients", type=int, default=4, help="Concurrent modbus clients")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="Seconds of polling per datastore")
+    parser.add_argument("-r", "--write-rate", type=float, default=1000, help="Frame writes per second while polling")
+    parser.add_argument("--rounds", type=int, default=2, help="Polling rounds per datastore")
+    parser.add_argument("-p", "--port", type=int, default=15030, help="First local port used by the benchmark servers")
+    args = parser.parse_args()
+
+    timeWrites(args.writes, args.registers)
+    asyncio.run(runPolling(args))
@@ -0,0 +1,134 @@
+import argparse, datetime, random, time
+import pymongo
+from modules.dbSchema import bootstrapSchema
+
+# Query latency of the gateway's database lookups before and after the schema bootstrap creates its indexes
+# A synthetic fleet is written to a scratch database of a real MongoDB server (mongomock has no query planner):
+# configuredRadio documents as configureXbeeRadio stores them and per radio history collections for a few radios
+# Every query is timed without indexes, bootstrapSchema is run, then the same queries are timed again, the documents
+# each query examined (explain executionStats) are shown next to the latencies
+# Run from the project root: python -m benchmarks.schemaIndexBenchmark --mongo-uri mongodb://localhost:27017/ --radios 10000
+
+def syntheticFleet(gatewayDb, radioCount, historyRadios, samples, blockSize):
+
+    radios = [{
+
+        "xbeeNodeIdentifier": f"SITE RADIO {index:05d}",
+        "xbeeMac": f"0013A200{0x40000000 + index:08X}",
+        "modbusStartAddress": index * blockSize,
+        "modbusEndAddress": index * blockSize + blockSize - 1,
+        "modbusUnitId": index + 1 if index < 247 else None
+
+    } for index in range(radioCount)]
+
+    gatewayDb["configuredRadio"].insert_many(radios)
+
+    # One sample a minute per history radio, ending now
+
+    startTime = datetime.datetime.now() - datetime.timedelta(minutes=samples)
+
+    for radio in radios[:historyRadios]:
+
+        gatewayDb[radio["xbeeMac"]].insert_many([{"timestamp": startTime + datetime.timedelta(minutes=sample), "data": [random.uniform(0, 100) for _ in range(5)]} for sample in range(samples)])
+
+    return radios, startTime
+
+def fleetQueries(radios, historyRadios, startTime, samples):
+
+    # (name, collection name, filter, sort) of the lookups dbIntegration and history readers issue
+
+    radio = random.choice(radios)
+    historyRadio = random.choice(radios[:historyRadios])
+    rangeStart = startTime + datetime.timedelta(minutes=random.randrange(max(1, samples - 60)))
+
+    return [
+
+        ("radio by mac", "configuredRadio", {"xbeeMac": radio["xbeeMac"]}, None),
+        ("radio by node identifier", "configuredRadio", {"xbeeNodeIdentifier": radio["xbeeNodeIdentifier"]}, None),
+        ("radio by start address", "configuredRadio", {"modbusStartAddress": radio["modbusStartAddress"]}, None),
+        ("history hour of a radio", historyRadio["xbeeMac"], {"timestamp": {"$gte": rangeStart, "$lt": rangeStart + datetime.timedelta(hours=1)}}, None),
+        ("latest history sample", historyRadio["xbeeMac"], {}, [("timestamp", pymongo.DESCENDING)])
+
+    ]
+
+def timeQueries(gatewayDb, radios, historyRadios, startTime, samples, repeats):
+
+    # name -> (p50 seconds, p99 seconds, documents examined by the last query)
+
+    timings = {}
+    examined = {}
+
+    for _ in range(repeats):
+
+        for name, collectionName, queryFilter, sort in fleetQueries(radios, historyRadios, startTime, samples):
+
+            cursor = gatewayDb[collectionName].find(queryFilter, {"_id": 0})
+
+            if sort:
+
+                cursor = cursor.sort(sort).limit(1)
+
+            queryStart = time.perf_counter()
+            list(cursor)
+            timings.setdefault(name, []).append(time.perf_counter() - queryStart)
+
+            explainCommand = {"find": collectionName, "filter": queryFilter}
+
+            if sort:
+
+                explainCommand.update(sort=dict(sort), limit=1)
+
+            examined[name] = gatewayDb.command("explain", explainCommand, verbosity="executionStats")["executionStats"]["totalDocsExamined"]
+
+    results = {}
+
+    for name, samplesTaken in timings.items():
+
+        samplesTaken.sort()
+        results[name] = (samplesTaken[len(samplesTaken) // 2], samplesTaken[min(len(samplesTaken) - 1, int(len(samplesTaken) * 0.99))], examined[name])
+
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Gateway database query latency before and after the schema bootstrap")
+    parser.add_argument("-u", "--mongo-uri", default="mongodb://localhost:27017/", help="MongoDB server to run against")
+    parser.add_argument("--database", default="GatewayIndexBenchmark", help="Scratch database, dropped before and after the run")
+    parser.add_argument("-r", "--radios", type=int, default=10000, help="Configured radios")
+    parser.add_argument("--history-radios", type=int, default=10, help="Radios given a history collection")
+    parser.add_argument("-s", "--samples", type=int, default=50000, help="History samples per history radio, one a minute")
+    parser.add_argument("-n", "--repeats", type=int, default=200, help="Timed runs of every query")
+    parser.add_argument("-k", "--keep", action="store_true", help="Keep the scratch database after the run")
+    args = parser.parse_args()
+
+    if args.database == "Gateway":
+
+        parser.error("refusing to drop the gateway's own database, pick a scratch database")
+
+    dbclient = pymongo.MongoClient(args.mongo_uri, serverSelectionTimeoutMS=5000)
+    dbclient.drop_database(args.database)
+    gatewayDb = dbclient[args.database]
+
+    try:
+
+        radios, startTime = syntheticFleet(gatewayDb, args.radios, args.history_radios, args.samples, 6)
+        before = timeQueries(gatewayDb, radios, args.history_radios, startTime, args.samples, args.repeats)
+        bootstrapStart = time.perf_counter()
+        result = bootstrapSchema(gatewayDb)
+
+        print (f"{result.get('success') or result.get('error')} in {time.perf_counter() - bootstrapStart:.2f}s, run again: {bootstrapSchema(gatewayDb).get('version')}")
+
+        after = timeQueries(gatewayDb, radios, args.history_radios, startTime, args.samples, args.repeats)
+
+        print (f"\n{args.radios:,} radios, {args.history_radios} history collections of {args.samples:,} samples")
+        print (f"{'query':<28}{'p50 ms before':>14}{'p99 before':>12}{'examined':>10}{'p50 ms after':>14}{'p99 after':>11}{'examined':>10}")
+
+        for name in before:
+
+            print (f"{name:<28}{before[name][0] * 1000:>14.3f}{before[name][1] * 1000:>12.3f}{before[name][2]:>10,}{after[name][0] * 1000:>14.3f}{after[name][1] * 1000:>11.3f}{after[name][2]:>10,}")
+
+    finally:
+
+        if not args.keep:
+
+            dbclient.drop_database(args.database)
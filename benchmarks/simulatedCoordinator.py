@@ -0,0 +1,131 @@
+import os, tty, time, struct, threading
+
+# XBee coordinator stand in on a pseudo terminal, for running the gateway without radios attached
+# The pty slave path is given to the gateway as a coordinator port, the simulator answers the AT commands
+# digi-xbee sends while opening the device and injects receive packet (0x90) frames for simulated radios
+
+atCommandResponses = {
+
+    b"AP": b"\x01", # API mode without escaping
+    b"HV": b"\x42\x00", # Hardware version of an XBee3 module
+    b"VR": b"\x10\x0B", # Zigbee firmware
+    b"SH": b"\x00\x13\xA2\x00",
+    b"MY": b"\x00\x00",
+    b"NI": b"SIMULATED",
+    b"CE": b"\x01", # Coordinator role
+    b"BR": b"\x03",
+
+}
+
+def buildApiFrame(frameData):
+
+    return b"\x7E" + struct.pack(">H", len(frameData)) + frameData + bytes([0xFF - (sum(frameData) & 0xFF)])
+
+class SimulatedCoordinator:
+
+    def __init__(self, serialLow=0x4239E84F):
+
+        self.serialLow = serialLow
+        self.sentFrames = 0
+        self.masterFd, self.slaveFd = os.openpty()
+        tty.setraw(self.slaveFd)
+        self.port = os.ttyname(self.slaveFd)
+
+        self._writeLock = threading.Lock()
+        self._running = True
+        self._reader = threading.Thread(target=self._answerCommands, name=f"simulated-{self.port}", daemon=True)
+        self._reader.start()
+
+    def _write(self, frame):
+
+        with self._writeLock:
+
+            os.write(self.masterFd, frame)
+
+    def _answerCommands(self):
+
+        buffer = b""
+
+        while self._running:
+
+            try:
+
+                buffer += os.read(self.masterFd, 1024)
+
+            except OSError:
+
+                return
+
+            while True:
+
+                start = buffer.find(b"\x7E")
+
+                if start < 0 or len(buffer) < start + 3:
+
+                    break
+
+                frameLength = struct.unpack(">H", buffer[start + 1:start + 3])[0]
+
+                if len(buffer) < start + 4 + frameLength:
+
+                    break
+
+                frameData = buffer[start + 3:start + 3 + frameLength]
+                buffer = buffer[start + 4 + frameLength:]
+
+                if frameData[0] in (0x08, 0x09):
+
+                    # AT command (applied or queued): frame id, two character command, optional parameter
+
+                    command = frameData[2:4]
+                    value = atCommandResponses.get(command, b"")
+
+                    if command == b"SL":
+
+                        value = struct.pack(">I", self.serialLow)
+
+                    if len(frameData) > 4:
+
+                        value = b"" # Setting a parameter, acknowledge only
+
+                    # A real module answers after a few milliseconds, answering instantly races digi-xbee's response listener
+
+                    time.sleep(0.005)
+                    self._write(buildApiFrame(b"\x88" + frameData[1:2] + command + b"\x00" + value))
+
+    def sendFrame(self, xbeeMacAddress, payload):
+
+        # Receive packet from a remote radio: 64-bit source, 16-bit source, options, rf data
+
+        frameData = b"\x90" + bytes.fromhex(xbeeMacAddress) + b"\xFF\xFE" + b"\x01" + bytes(payload)
+        self._write(buildApiFrame(frameData))
+        self.sentFrames += 1
+
+    def close(self):
+
+        # The reader blocked on the master keeps the pty alive after close, a byte from the slave side lets it return first,
+        # the slave path then vanishes like the port of an unplugged usb adapter
+
+        if self._running:
+
+            self._running = False
+
+            try:
+
+                os.write(self.slaveFd, b"\x00")
+
+            except OSError:
+
+                pass
+
+            self._reader.join(timeout=1)
+
+        for fileDescriptor in (self.masterFd, self.slaveFd):
+
+            try:
+
+                os.close(fileDescriptor)
+
+            except OSError:
+
+                pass
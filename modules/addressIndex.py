@@ -0,0 +1,247 @@
+import logging, threading
+from bisect import bisect_left, bisect_right
+from . import variables
+
+logger = logging.getLogger(__name__)
+
+# In memory index of the modbus register ranges allocated to configured radios and of the free gaps between them
+# Accepted ranges never overlap, so sorted by start address they are sorted by end address too and an overlap check
+# only looks at the range starting closest below the proposed end: a bisect instead of a scan of every configuredRadio
+# Adding or removing a range only replaces the gap around it, the gaps added and removed since the last persist are
+# kept so the availableModbusAddress collection is updated with one bulk_write diff instead of a drop and rebuild
+# allocate picks a free block for a new radio: firstFit takes the lowest block that fits, bestFit the block in the
+# smallest gap it fits so large gaps stay whole, start addresses are multiples of alignment counted from lowestRegister
+
+allocationPolicies = ("firstFit", "bestFit")
+
+def gapDocument(gapStart, gapEnd):
+
+    # availableModbusAddress document of a free gap, consumable when a whole radio block fits in it
+
+    gapSize = gapEnd - gapStart + 1
+
+    return {"modbusAddressRange": f"{gapStart}-{gapEnd}", "size": gapSize, "consumable": "✅" if gapSize >= variables.incrementalModbusAddress else "❌"}
+
+class AddressIndex:
+
+    def __init__(self, lowestRegister=None, highestRegister=None):
+
+        self.lowestRegister = variables.lowestRegister if lowestRegister is None else lowestRegister
+        self.highestRegister = variables.highestRegister if highestRegister is None else highestRegister
+        self.loaded = False
+        self.fullSyncNeeded = True # Set on load, the stored gaps are then diffed against the index instead of the changes
+
+        self._starts = [] # Sorted start addresses
+        self._ends = [] # End address of the range at the same position
+        self._owners = [] # Mac address of the range at the same position
+        self._ranges = {} # mac address -> (start address, end address)
+        self._gapChanges = {} # (gap start, gap end) -> 1 added or -1 removed since the last takeGapChanges
+        self._lock = threading.RLock() # dbIntegration functions run on gui, gateway and worker threads
+
+    def load(self, configuredRadios):
+
+        # Rebuilds the index from configuredRadio documents, returns the number of ranges
+
+        ranges = sorted((int(radio["modbusStartAddress"]), int(radio["modbusEndAddress"]), str(radio["xbeeMac"]).upper()) for radio in configuredRadios if radio.get("modbusStartAddress") is not None and radio.get("modbusEndAddress") is not None)
+        overlaps = sum(1 for previous, current in zip(ranges, ranges[1:]) if current[0] <= previous[1])
+
+        if overlaps:
+
+            logger.warning("%d configured radio ranges overlap the range before them, overlap checks assume they do not", overlaps)
+
+        with self._lock:
+
+            self._starts = [start for start, end, mac in ranges]
+            self._ends = [end for start, end, mac in ranges]
+            self._owners = [mac for start, end, mac in ranges]
+            self._ranges = {mac: (start, end) for start, end, mac in ranges}
+            self._gapChanges = {}
+            self.fullSyncNeeded = True
+            self.loaded = True
+
+        return len(ranges)
+
+    def overlapping(self, startAddress, endAddress, excludeMac=None):
+
+        # Mac address of a radio whose range overlaps startAddress to endAddress, None when the range is free
+        # excludeMac skips the range of the radio being moved
+
+        with self._lock:
+
+            index = bisect_right(self._starts, endAddress) - 1
+
+            while index >= 0:
+
+                if self._owners[index] != excludeMac:
+
+                    return self._owners[index] if self._ends[index] >= startAddress else None
+
+                index -= 1
+
+            return None
+
+    def _changeGap(self, gapStart, gapEnd, change):
+
+        if gapStart > gapEnd:
+
+            return
+
+        netChange = self._gapChanges.get((gapStart, gapEnd), 0) + change
+
+        if netChange:
+
+            self._gapChanges[(gapStart, gapEnd)] = netChange
+
+        else:
+
+            del self._gapChanges[(gapStart, gapEnd)]
+
+    def _neighbours(self, index):
+
+        # End of the range before position index and start of the range at it, the bounds of the gap at that position
+
+        previousEnd = self._ends[index - 1] if index else self.lowestRegister - 1
+        nextStart = self._starts[index] if index < len(self._starts) else self.highestRegister + 1
+
+        return previousEnd, nextStart
+
+    def add(self, startAddress, endAddress, xbeeMacAddress):
+
+        # Allocates a range, a radio that already has one is moved, the gap it fell in is split in two
+
+        xbeeMacAddress = str(xbeeMacAddress).upper()
+
+        with self._lock:
+
+            self.remove(xbeeMacAddress)
+
+            index = bisect_left(self._starts, startAddress)
+            previousEnd, nextStart = self._neighbours(index)
+
+            self._changeGap(previousEnd + 1, nextStart - 1, -1)
+            self._changeGap(previousEnd + 1, startAddress - 1, 1)
+            self._changeGap(endAddress + 1, nextStart - 1, 1)
+
+            self._starts.insert(index, startAddress)
+            self._ends.insert(index, endAddress)
+            self._owners.insert(index, xbeeMacAddress)
+            self._ranges[xbeeMacAddress] = (startAddress, endAddress)
+
+    def remove(self, xbeeMacAddress):
+
+        # Frees a radio's range, the gaps on both sides of it merge into one, returns the freed range
+
+        xbeeMacAddress = str(xbeeMacAddress).upper()
+
+        with self._lock:
+
+            freedRange = self._ranges.pop(xbeeMacAddress, None)
+
+            if freedRange is None:
+
+                return None
+
+            startAddress, endAddress = freedRange
+            index = bisect_left(self._starts, startAddress)
+
+            while self._owners[index] != xbeeMacAddress:
+
+                index += 1
+
+            del self._starts[index], self._ends[index], self._owners[index]
+
+            previousEnd, nextStart = self._neighbours(index)
+
+            self._changeGap(previousEnd + 1, startAddress - 1, -1)
+            self._changeGap(endAddress + 1, nextStart - 1, -1)
+            self._changeGap(previousEnd + 1, nextStart - 1, 1)
+
+        return freedRange
+
+    def gaps(self):
+
+        # Free (gap start, gap end) ranges in address order
+
+        with self._lock:
+
+            gaps = []
+            previousEnd = self.lowestRegister - 1
+
+            for startAddress, endAddress in zip(self._starts, self._ends):
+
+                if startAddress - previousEnd > 1:
+
+                    gaps.append((previousEnd + 1, startAddress - 1))
+
+                previousEnd = max(previousEnd, endAddress)
+
+            if self.highestRegister - previousEnd >= 1:
+
+                gaps.append((previousEnd + 1, self.highestRegister))
+
+        return gaps
+
+    def allocate(self, blockSize, policy=None, alignment=None, reservedRanges=()):
+
+        # Start address of a free block of blockSize registers, None when no gap holds one
+        # reservedRanges are (start, end) ranges no radio may use, e.g. the summary block
+
+        policy = variables.addressAllocationPolicy if policy is None else policy
+        alignment = (variables.addressAlignment or variables.incrementalModbusAddress) if alignment is None else alignment
+
+        if policy not in allocationPolicies:
+
+            raise ValueError(f"Invalid allocation policy {policy}. Allowed policies: {allocationPolicies}")
+
+        bestStart = None
+        bestSize = None
+
+        for gapStart, gapEnd in self.gaps():
+
+            # Reserved ranges split a gap into the free pieces around them
+
+            pieces = [(gapStart, gapEnd)]
+
+            for reservedStart, reservedEnd in reservedRanges:
+
+                pieces = [piece for pieceStart, pieceEnd in pieces for piece in ((pieceStart, min(pieceEnd, reservedStart - 1)), (max(pieceStart, reservedEnd + 1), pieceEnd)) if piece[0] <= piece[1]]
+
+            for pieceStart, pieceEnd in pieces:
+
+                startAddress = pieceStart + (-(pieceStart - self.lowestRegister) % alignment)
+
+                if startAddress + blockSize - 1 > pieceEnd:
+
+                    continue
+
+                if policy == "firstFit":
+
+                    return startAddress
+
+                if bestSize is None or pieceEnd - pieceStart < bestSize:
+
+                    bestStart, bestSize = startAddress, pieceEnd - pieceStart
+
+        return bestStart
+
+    def takeGapChanges(self):
+
+        # (removed gaps, added gaps) since the previous call
+
+        with self._lock:
+
+            gapChanges, self._gapChanges = self._gapChanges, {}
+
+        return [gap for gap, change in gapChanges.items() if change < 0], [gap for gap, change in gapChanges.items() if change > 0]
+
+    def stats(self):
+
+        return {
+
+            "loaded": self.loaded,
+            "ranges": len(self._starts),
+            "pendingGapChanges": len(self._gapChanges)
+
+        }
+
+addressIndex = AddressIndex()
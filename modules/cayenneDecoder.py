@@ -0,0 +1,118 @@
+import logging
+from struct import Struct
+
+# Cayenne LPP decoder working directly on the received bytes
+# Each record is channel (1 byte), type (1 byte) and a big endian value whose layout is looked up once per record
+# Values are divided (not multiplied) by their resolution so results match python_cayennelpp bit for bit
+
+logger = logging.getLogger(__name__)
+
+# type -> (name, value size in bytes, struct used to unpack the value, divisor per value)
+lppTypes = {
+
+    0x00: ("Digital Input", 1, Struct(">B"), (1.0,)),
+    0x01: ("Digital Output", 1, Struct(">B"), (1.0,)),
+    0x02: ("Analog Input", 2, Struct(">h"), (100.0,)),
+    0x03: ("Analog Output", 2, Struct(">h"), (100.0,)),
+    0x64: ("Generic Sensor", 4, Struct(">I"), (1.0,)),
+    0x65: ("Illuminance Sensor", 2, Struct(">H"), (1.0,)),
+    0x66: ("Presence Sensor", 1, Struct(">B"), (1.0,)),
+    0x67: ("Temperature Sensor", 2, Struct(">h"), (10.0,)),
+    0x68: ("Humidity Sensor", 1, Struct(">B"), (2.0,)),
+    0x71: ("Accelerometer", 6, Struct(">hhh"), (1000.0, 1000.0, 1000.0)),
+    0x73: ("Barometer", 2, Struct(">H"), (10.0,)),
+    0x74: ("Voltage", 2, Struct(">H"), (100.0,)),
+    0x75: ("Current", 2, Struct(">H"), (1000.0,)),
+    0x76: ("Frequency", 4, Struct(">I"), (1.0,)),
+    0x78: ("Percentage", 1, Struct(">B"), (1.0,)),
+    0x79: ("Altitude", 2, Struct(">h"), (1.0,)),
+    0x7D: ("Concentration", 2, Struct(">H"), (1.0,)),
+    0x80: ("Power", 2, Struct(">H"), (1.0,)),
+    0x82: ("Distance", 4, Struct(">I"), (1000.0,)),
+    0x83: ("Energy", 4, Struct(">I"), (1000.0,)),
+    0x84: ("Direction", 2, Struct(">H"), (1.0,)),
+    0x85: ("Unix Time", 4, Struct(">I"), (1.0,)),
+    0x86: ("Gyrometer", 6, Struct(">hhh"), (100.0, 100.0, 100.0)),
+    0x87: ("Colour", 3, Struct(">BBB"), (1.0, 1.0, 1.0)),
+    0x88: ("GPS Location", 9, Struct(">bHbHbH"), (10000.0, 10000.0, 100.0)),
+    0x8E: ("Switch", 1, Struct(">B"), (1.0,)),
+
+}
+
+# Types whose values are 24 bit signed integers, unpacked as a signed high byte followed by an unsigned low word
+wideValueTypes = frozenset((0x88,))
+
+def decodeCayenne(payload):
+
+    # Returns a list of (channel, type, value) where value is a float, or a tuple of floats for multi value types
+    # Decoding stops at the first unknown type and returns what was decoded so far, like python_cayennelpp
+
+    if not isinstance(payload, (bytes, bytearray)):
+
+        payload = memoryview(payload).cast("B")
+
+    payloadLength = len(payload)
+    pointer = 0
+    result = []
+
+    while pointer < payloadLength:
+
+        if pointer + 2 > payloadLength:
+
+            raise ValueError(f"Truncated cayenne record at byte {pointer} of {payloadLength}")
+
+        channel = payload[pointer]
+        lppType = payload[pointer + 1]
+        typeDetails = lppTypes.get(lppType)
+
+        if typeDetails is None:
+
+            logger.warning("Decoding stopped, unrecognized cayenne type %#04x on channel %d", lppType, channel, extra={"rateLimitKey": (lppType, channel)})
+
+            return result
+
+        valueSize, unpacker, divisors = typeDetails[1], typeDetails[2], typeDetails[3]
+        pointer += 2
+
+        if pointer + valueSize > payloadLength:
+
+            raise ValueError(f"Cayenne type {lppType:#04x} on channel {channel} needs {valueSize} bytes, only {payloadLength - pointer} left")
+
+        rawValues = unpacker.unpack_from(payload, pointer)
+        pointer += valueSize
+
+        if len(divisors) == 1:
+
+            result.append((channel, lppType, rawValues[0] / divisors[0]))
+
+        elif lppType in wideValueTypes:
+
+            result.append((channel, lppType, tuple(((rawValues[index] << 16) | rawValues[index + 1]) / divisor for index, divisor in zip(range(0, len(rawValues), 2), divisors))))
+
+        else:
+
+            result.append((channel, lppType, tuple(rawValue / divisor for rawValue, divisor in zip(rawValues, divisors))))
+
+    return result
+
+def decodeCayenneValues(payload):
+
+    # Flat list of floats in payload order, multi value types contribute one float per axis
+
+    return flattenCayenneValues(decodeCayenne(payload))
+
+def flattenCayenneValues(records):
+
+    sensorValues = []
+
+    for channel, lppType, value in records:
+
+        if type(value) is tuple:
+
+            sensorValues.extend(value)
+
+        else:
+
+            sensorValues.append(value)
+
+    return sensorValues
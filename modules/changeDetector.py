@@ -0,0 +1,184 @@
+import time
+from . import variables
+
+# Per radio change detection so unchanged or insignificant frames skip the modbus writes and the history insert
+# Deadbands are configured on the configuredRadio document, keyed by cayenne channel number:
+#     "deadbands": {"1": {"absolute": 0.5}, "2": {"percent": 2}}
+# A channel is unchanged while its new value is within any of its configured bands of the last written value
+# A write is always forced once maxSilence seconds (per radio, else maxSilenceHeartbeat) passed since the last one
+
+deadbandKinds = ("absolute", "percent")
+
+def validateDeadbands(deadbands):
+
+    # Returns an error message, or None when the deadband configuration is valid
+
+    if not isinstance(deadbands, dict):
+
+        return "Deadbands should be a dictionary of channel number to {'absolute': value, 'percent': value}"
+
+    for channel, bands in deadbands.items():
+
+        if not str(channel).isdigit() or not 0 <= int(channel) <= 255:
+
+            return f"Invalid deadband channel {channel}, expected a cayenne channel number between 0 and 255"
+
+        if not isinstance(bands, dict) or not bands:
+
+            return f"Deadband of channel {channel} should be a dictionary with absolute and/or percent"
+
+        for kind, band in bands.items():
+
+            if kind not in deadbandKinds:
+
+                return f"Invalid deadband kind {kind} on channel {channel}. Allowed kinds: {deadbandKinds}"
+
+            if isinstance(band, bool) or not isinstance(band, (int, float)) or band < 0:
+
+                return f"Deadband {kind} of channel {channel} should be a non negative number"
+
+    return None
+
+def valueWithinBands(newValue, lastValue, bands):
+
+    difference = abs(newValue - lastValue)
+
+    if "absolute" in bands and difference <= bands["absolute"]:
+
+        return True
+
+    if "percent" in bands and difference <= abs(lastValue) * bands["percent"] / 100:
+
+        return True
+
+    return False
+
+class ChangeDetector:
+
+    def __init__(self, maxSilence=None):
+
+        self.maxSilence = variables.maxSilenceHeartbeat if maxSilence is None else maxSilence
+
+        self.repeatedPayloads = 0
+        self.deadbandSuppressed = 0
+        self.heartbeatWrites = 0
+
+        self._lastPayload = {} # mac -> last received payload bytes
+        self._lastRecords = {} # mac -> {(channel, type): value} as last written
+        self._lastWrite = {} # mac -> (monotonic time, start address) of the last write
+
+    def _writeDue(self, xbeeMacAddress, route, now):
+
+        # Returns "unwritten" when the block was never written (or the radio moved to another block), "heartbeat" when silent too long
+
+        lastWrite = self._lastWrite.get(xbeeMacAddress)
+
+        if lastWrite is None or lastWrite[1] != route["modbusStartAddress"]:
+
+            return "unwritten"
+
+        if now - lastWrite[0] >= route.get("maxSilence", self.maxSilence):
+
+            return "heartbeat"
+
+        return None
+
+    def isRepeatedPayload(self, xbeeMacAddress, xbeeDataAsByte, route):
+
+        # Exact match fast path, checked before decoding
+
+        if not variables.changeDetectionEnabled:
+
+            return False
+
+        if self._lastPayload.get(xbeeMacAddress) == xbeeDataAsByte and not self._writeDue(xbeeMacAddress, route, time.monotonic()):
+
+            self.repeatedPayloads += 1
+
+            return True
+
+        self._lastPayload[xbeeMacAddress] = bytes(xbeeDataAsByte)
+
+        return False
+
+    def hasSignificantChange(self, xbeeMacAddress, records, route):
+
+        # records are the (channel, type, value) tuples from decodeCayenne
+
+        if not variables.changeDetectionEnabled:
+
+            return True
+
+        writeDue = self._writeDue(xbeeMacAddress, route, time.monotonic())
+
+        if writeDue is not None:
+
+            if writeDue == "heartbeat":
+
+                self.heartbeatWrites += 1
+
+            return True
+
+        lastRecords = self._lastRecords.get(xbeeMacAddress)
+
+        if lastRecords is None or len(lastRecords) != len(records):
+
+            return True
+
+        deadbands = route.get("deadbands") or {}
+
+        for channel, lppType, value in records:
+
+            lastValue = lastRecords.get((channel, lppType))
+
+            if lastValue is None:
+
+                return True
+
+            if value == lastValue:
+
+                continue
+
+            bands = deadbands.get(str(channel))
+
+            if bands is None:
+
+                return True
+
+            if type(value) is tuple:
+
+                if type(lastValue) is not tuple or not all(valueWithinBands(axis, lastAxis, bands) for axis, lastAxis in zip(value, lastValue)):
+
+                    return True
+
+            elif type(lastValue) is tuple or not valueWithinBands(value, lastValue, bands):
+
+                return True
+
+        self.deadbandSuppressed += 1
+
+        return False
+
+    def recordWrite(self, xbeeMacAddress, records, route):
+
+        self._lastRecords[xbeeMacAddress] = {(channel, lppType): value for channel, lppType, value in records}
+        self._lastWrite[xbeeMacAddress] = (time.monotonic(), route["modbusStartAddress"])
+
+    def forget(self, xbeeMacAddress):
+
+        self._lastPayload.pop(xbeeMacAddress, None)
+        self._lastRecords.pop(xbeeMacAddress, None)
+        self._lastWrite.pop(xbeeMacAddress, None)
+
+    def stats(self):
+
+        return {
+
+            "trackedRadios": len(self._lastWrite),
+            "repeatedPayloads": self.repeatedPayloads,
+            "deadbandSuppressed": self.deadbandSuppressed,
+            "heartbeatWrites": self.heartbeatWrites
+
+        }
+
+changeDetector = ChangeDetector()
@@ -0,0 +1,196 @@
+import os, asyncio, logging, time
+from . import variables
+from .serialSelector import selectUsbPort
+from digi.xbee.devices import XBeeDevice, RemoteXBeeDevice
+from digi.xbee.models.address import XBee64BitAddress
+from .ingestBridge import makeDataReceiveCallback
+
+logger = logging.getLogger(__name__)
+
+# One coordinator radio attached to the gateway, several of them can feed the same ingest bridge
+# A coordinator is configured either by usb serial number ("SER=...") or by port path (/dev/ttyUSB0, COM3, a pty...)
+# Each one owns its polling task and reconnects on its own when its radio is unplugged
+
+def coordinatorTargets():
+
+    return list(variables.coordinatorRadios) or [variables.prefferedRadioSerialNumber]
+
+class Coordinator:
+
+    def __init__(self, target, ingestBridge, baudRate=None):
+
+        self.target = target
+        self.name = target # Tag attached to every frame received through this coordinator
+        self.ingestBridge = ingestBridge
+        self.baudRate = variables.xbeeBaudRate if baudRate is None else baudRate
+
+        self.device = None
+        self.port = None
+        self.connected = False
+
+        self.framesReceived = 0
+        self.bytesReceived = 0
+        self.framesPerSecond = 0.0
+        self.lastFrameTime = None
+        self.reconnects = 0
+        self.framesSent = 0
+
+        self._disconnected = None
+
+    def resolvePort(self):
+
+        if str(self.target).upper().startswith("SER="):
+
+            return selectUsbPort(serialNumber=self.target)
+
+        if os.path.exists(self.target) or str(self.target).upper().startswith("COM"):
+
+            return self.target
+
+        logger.warning("Coordinator port %s not found", self.target, extra={"rateLimitKey": self.target})
+
+        return None
+
+    def countFrame(self, xbeeDataAsByte):
+
+        # Called on the xbee reader thread of this coordinator only
+
+        self.framesReceived += 1
+        self.bytesReceived += len(xbeeDataAsByte)
+        self.lastFrameTime = time.time()
+
+    def _portLost(self):
+
+        return self.port is not None and self.port.startswith("/dev/") and not os.path.exists(self.port)
+
+    async def connect(self, port):
+
+        loop = asyncio.get_running_loop()
+        device = XBeeDevice(port, self.baudRate)
+
+        try:
+
+            await asyncio.to_thread(device.open)
+
+        except Exception:
+
+            await asyncio.to_thread(device.close)
+
+            raise
+
+        self._disconnected = asyncio.Event()
+        device.add_data_received_callback(makeDataReceiveCallback(self.ingestBridge, self))
+
+        if hasattr(device, "add_error_callback"):
+
+            # Only available on the customized digi-xbee build, otherwise a vanished port is detected by polling
+
+            device.add_error_callback(lambda error: loop.call_soon_threadsafe(self._disconnected.set))
+
+        self.device = device
+        self.port = port
+        self.connected = True
+        variables.radioFlag = True
+
+        logger.info("Coordinator %s connected on %s", self.name, port)
+
+    async def disconnect(self):
+
+        self.connected = False
+        variables.radioFlag = any(coordinator.connected for coordinator in variables.coordinators)
+
+        if self.device is not None and self.device.is_open():
+
+            try:
+
+                await asyncio.to_thread(self.device.close)
+
+            except Exception as e:
+
+                logger.warning("Could not close coordinator %s: %s", self.name, e)
+
+    async def transmit(self, xbeeMacAddress, payload):
+
+        # Downlink to one radio, send_data_async returns once the frame is written to the coordinator's serial port
+
+        device = self.device
+
+        if device is None or not self.connected:
+
+            raise ConnectionError(f"coordinator {self.name} is not connected")
+
+        remoteDevice = RemoteXBeeDevice(device, XBee64BitAddress.from_hex_string(xbeeMacAddress))
+
+        await asyncio.to_thread(device.send_data_async, remoteDevice, payload)
+
+        self.framesSent += 1
+
+    async def run(self):
+
+        while True:
+
+            port = await asyncio.to_thread(self.resolvePort)
+
+            if port is None:
+
+                await asyncio.sleep(variables.coordinatorReconnectInterval)
+
+                continue
+
+            try:
+
+                await self.connect(port)
+
+            except Exception as e:
+
+                logger.warning("Could not open coordinator %s on %s: %s", self.name, port, e, extra={"rateLimitKey": self.name})
+
+                await asyncio.sleep(variables.coordinatorReconnectInterval)
+
+                continue
+
+            try:
+
+                lastCount = self.framesReceived
+                lastTime = time.monotonic()
+
+                while not self._disconnected.is_set() and not self._portLost():
+
+                    try:
+
+                        await asyncio.wait_for(self._disconnected.wait(), timeout=1)
+
+                    except asyncio.TimeoutError:
+
+                        pass
+
+                    now = time.monotonic()
+                    self.framesPerSecond = (self.framesReceived - lastCount) / (now - lastTime)
+                    lastCount, lastTime = self.framesReceived, now
+
+                logger.warning("Coordinator %s disconnected from %s, reconnecting", self.name, port)
+
+            finally:
+
+                await self.disconnect()
+
+            self.reconnects += 1
+            self.framesPerSecond = 0.0
+
+            await asyncio.sleep(variables.coordinatorReconnectInterval)
+
+    def stats(self):
+
+        return {
+
+            "name": self.name,
+            "port": self.port,
+            "connected": self.connected,
+            "framesReceived": self.framesReceived,
+            "bytesReceived": self.bytesReceived,
+            "framesPerSecond": self.framesPerSecond,
+            "lastFrameTime": self.lastFrameTime,
+            "reconnects": self.reconnects,
+            "framesSent": self.framesSent
+
+        }
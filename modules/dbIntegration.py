@@ -1,7 +1,17 @@
 from . import variables
-from .modbus import getIpAddress
-from pymongo.errors import PyMongoError
-import pymongo, datetime, random, string
+from .modbus import getIpAddress, modbusUnitIds, validateRegisterLayout, validateRegisterProfile
+from .summaryBlock import summaryRegisterCount
+from .downlink import validateControlRegisters
+from .routingCache import routingCache
+from .addressIndex import addressIndex, gapDocument
+from .changeDetector import validateDeadbands, changeDetector
+from .dbSchema import bootstrapSchema, ensureHistoryIndexes, schemaMigrations
+from .historyStore import ensureHistoryStorage, storeHistoryBatch, readHistory, renameHistory, swapHistory, dropHistory
+from .historyRollup import ensureRollupStorage, ensureRadioHistoryRetention, rollupPass, readRollups, renameRollups, swapRollups, dropRollups
+from pymongo.errors import PyMongoError, BulkWriteError, DuplicateKeyError
+import pymongo, datetime, random, string, logging
+
+logger = logging.getLogger(__name__)
 
 # dbclient = pymongo.MongoClient("mongodb://"+getIpAddress()+":27017/")
 dbclient = pymongo.MongoClient("mongodb://10.79.220.202:27017/")
@@ -10,7 +20,19 @@ gatewayDb = dbclient["Gateway"]
 configuredRadioCollection = gatewayDb["configuredRadio"]
 availableModbusAddressCollection = gatewayDb["availableModbusAddress"]
 
-def modbusAddressPolice(proposedStartAddress, supposedEndAddress):
+def loadAddressIndex(configuredRadios=None):
+
+    # Rebuilds the in memory address index, from the given configuredRadio documents or from the database
+
+    if configuredRadios is None:
+
+        configuredRadios = configuredRadioCollection.find({}, {"xbeeMac": 1, "modbusStartAddress": 1, "modbusEndAddress": 1, "_id": 0})
+
+    return addressIndex.load(configuredRadios)
+
+def modbusAddressPolice(proposedStartAddress, supposedEndAddress, xbeeMacAddress=None):
+
+    # xbeeMacAddress is the radio being moved, its current range does not count as an overlap
 
     try:
 
@@ -22,26 +44,27 @@ def modbusAddressPolice(proposedStartAddress, supposedEndAddress):
 
             return {"error": "Invalid modbus address"}
 
-        if proposedStartAddress < variables.lowestRegister or supposedEndAddress > variables.highestRegister+1:
+        if proposedStartAddress < variables.lowestRegister or supposedEndAddress > variables.highestRegister:
 
-            return {"error":f"Modbus address out of range\n\nRange: 0 - {variables.highestRegister}"}
-        
-        # Retrieve all the modbus startAddress and endAddress range from the db
+            return {"error":f"Modbus address out of range\n\nRange: {variables.lowestRegister} - {variables.highestRegister}"}
 
-        allConfiguredAddress = list(configuredRadioCollection.find({}, {"modbusStartAddress": 1, "modbusEndAddress": 1, "_id": 0}))
-        
-        # Check that passed address is available for use
+        if variables.summaryBlockEnabled and variables.modbusAddressingMode == "shared":
+
+            summaryEndAddress = variables.summaryStartAddress + summaryRegisterCount() - 1
 
-        for storedAddress in allConfiguredAddress:
+            if supposedEndAddress >= variables.summaryStartAddress and proposedStartAddress <= summaryEndAddress:
 
-            startAddress = int(storedAddress.get("modbusStartAddress"))
-            endAddress = int(storedAddress.get("modbusEndAddress"))
+                return {"error": f"Modbus address overlaps the summary block\n\nSummary block: {variables.summaryStartAddress} - {summaryEndAddress}"}
+        
+        # Check that passed address is available for use against the in memory index of the configured ranges
+
+        if not addressIndex.loaded:
 
-            # validate that user specified address is within the available range
+            loadAddressIndex()
 
-            if supposedEndAddress >= startAddress and proposedStartAddress <= endAddress:
+        if addressIndex.overlapping(proposedStartAddress, supposedEndAddress, None if xbeeMacAddress is None else str(xbeeMacAddress).upper()) is not None:
 
-                return {"error":'Could not update:\n\nSelected modbus startAddress address would cause adress overlapping'}
+            return {"error":'Could not update:\n\nSelected modbus startAddress address would cause adress overlapping'}
         
         return True
 
@@ -51,98 +74,59 @@ def modbusAddressPolice(proposedStartAddress, supposedEndAddress):
 
 def updateReusableAddress(returnData=None):
 
-    try:
-
-        availableModbusAddressCollection.drop()
-        dataList = []
-
-        # Retrieve all configured ranges and sort by startAddress address
-        utiilizedRange = list(configuredRadioCollection.find({}, {"modbusStartAddress": 1, "modbusEndAddress": 1, "_id": 0}))
-        utiilizedRange.sort(key=lambda x: x["modbusStartAddress"])
-
-        # Define register bounds
-        lowestPossibleAddress = variables.lowestRegister  # e.g., 0
-        highestPossibleAddress = variables.highestRegister  # e.g., 1000
-
-        # Initialize previous endAddress to the minimum address
-        previousEnd = lowestPossibleAddress - 1
-
-        for address in utiilizedRange:
-
-            startAddress = address["modbusStartAddress"]
-            endAddress = address["modbusEndAddress"]
-
-            # If there is a gap between previous endAddress and current startAddress
-            if startAddress - previousEnd > 1:
-
-                gapStart = previousEnd + 1
-                gapEnd = startAddress - 1
-                gapSize = gapEnd - gapStart + 1
-
-                if gapSize >= variables.incrementalModbusAddress:
-
-                    usable = "✅"
-
-                else:
+    # Brings the availableModbusAddress collection in line with the free gaps of the address index in one bulk_write:
+    # only the gaps changed since the last call, or after a reload of the index the difference with the stored gaps
 
-                    usable = "❌"
+    try:
 
-                availableRange = {"modbusAddressRange": f'{gapStart}-{gapEnd}', "size": gapSize, "consumable": usable}
+        if not addressIndex.loaded:
 
-                try:
+            loadAddressIndex()
 
-                    availableModbusAddressCollection.insert_one(availableRange)
+        if addressIndex.fullSyncNeeded:
 
-                    if returnData is not None:
+            addressIndex.fullSyncNeeded = False
+            addressIndex.takeGapChanges()
 
-                        dataList.append(availableRange)
-                
-                except PyMongoError as e:
+            wantedGaps = {gapDocument(gapStart, gapEnd)["modbusAddressRange"]: (gapStart, gapEnd) for gapStart, gapEnd in addressIndex.gaps()}
+            storedGaps = {storedGap["modbusAddressRange"] for storedGap in availableModbusAddressCollection.find({}, {"modbusAddressRange": 1, "_id": 0})}
+            removedGaps = list(storedGaps - set(wantedGaps))
+            addedGaps = [wantedGaps[gapRange] for gapRange in set(wantedGaps) - storedGaps]
 
-                    return {"error":f"failed to store {availableRange} in database", "details": str(e)}
+        else:
 
-            previousEnd = max(previousEnd, endAddress)
+            removedGaps, addedGaps = addressIndex.takeGapChanges()
+            removedGaps = [gapDocument(gapStart, gapEnd)["modbusAddressRange"] for gapStart, gapEnd in removedGaps]
 
-        # Check for any remaining gap at the endAddress
-        if highestPossibleAddress - previousEnd >= 1:
+        updateOperation = [pymongo.InsertOne(gapDocument(gapStart, gapEnd)) for gapStart, gapEnd in addedGaps]
 
-            gapStart = previousEnd + 1
-            gapEnd = highestPossibleAddress
-            gapSize = gapEnd - gapStart + 1
+        if removedGaps:
 
-            if gapSize >= variables.incrementalModbusAddress:
+            updateOperation.insert(0, pymongo.DeleteMany({"modbusAddressRange": {"$in": removedGaps}}))
 
-                usable = "✅"
+        if updateOperation:
 
-            else:
+            try:
 
-                usable = "❌"
+                availableModbusAddressCollection.bulk_write(updateOperation)
 
-            availableRange = {"modbusAddressRange": f'{gapStart}-{gapEnd}', "size": gapSize, "consumable":usable}
+            except PyMongoError as e:
 
-            try:
+                addressIndex.fullSyncNeeded = True # The stored gaps are unknown now, diff them in full next time
 
-                availableModbusAddressCollection.insert_one(availableRange)
+                return {"error": "failed to store the available address gaps in database", "details": str(e)}
 
-                if returnData is not None:
+        if returnData is None:
 
-                    dataList.append(availableRange)
-                
-            except PyMongoError as e:
+            return
 
-                return {"error":f'failed to store {availableRange} in database', "details": str(e)}
+        dataList = [gapDocument(gapStart, gapEnd) for gapStart, gapEnd in addressIndex.gaps()]
 
-        if dataList and returnData is not None:
+        if dataList:
 
             return dataList
-        
-        if not dataList and returnData is not None:
-
-            return {"info": "No available address gaps found."}
-        
-        if returnData is None:
 
-            return 
+        return {"info": "No available address gaps found."}
 
     except Exception as e:
 
@@ -170,7 +154,9 @@ def updateAllEndAddress(newRange):
         
         if result.modified_count:
 
+            loadAddressIndex()
             updateReusableAddress()
+            loadRoutingCache()
 
             return {"success":f"updated {result.modified_count}"}
         
@@ -201,13 +187,253 @@ def dbQueryModbusStartAddress(xbeeMacAddress):
 
         return str(e)
 
+def loadRoutingCache():
+
+    # Full reload of the in memory routing table, used at startup and as a periodic resync
+
+    try:
+
+        configuredRadios = list(configuredRadioCollection.find({}, {"_id":0}))
+        loadedRoutes = routingCache.load(configuredRadios)
+
+        syncRoutedRegisters()
+
+        if addressIndex.loaded:
+
+            # Changes made by another process (e.g. the configuration gui) reach the address index as well
+
+            loadAddressIndex(configuredRadios)
+
+        return loadedRoutes
+
+    except Exception as e:
+
+        logger.error("Could not load routing cache with details as: %s", e)
+
+        return {"error": str(e)}
+
+def dbQueryRadioRoute(xbeeMacAddress):
+
+    # Single radio lookup used when a mac address is missing from the routing cache
+
+    try:
+
+        xbeeMacAddress = str(xbeeMacAddress).upper()
+        xbeeDetails = configuredRadioCollection.find_one({"xbeeMac":xbeeMacAddress}, {"_id":0})
+
+        if xbeeDetails:
+
+            route = routingCache.updateRoute(xbeeDetails)
+
+            syncRoutedRegisters()
+
+            return route
+
+        routingCache.markUnknown(xbeeMacAddress)
+
+        return None
+
+    except Exception as e:
+
+        logger.error("Could not query route of %s with details as: %s", xbeeMacAddress, e, extra={"rateLimitKey": xbeeMacAddress})
+
+        return None
+
+def storeRegisterLayout(xbeeMacAddress, registerLayout):
+
+    # Stores the channel layout the gateway learned from a radio's frames, called off the event loop
+
+    try:
+
+        configuredRadioCollection.update_one({"xbeeMac": xbeeMacAddress}, {"$set": {"registerLayout": registerLayout}})
+
+        return True
+
+    except Exception as e:
+
+        logger.error("Could not store the register layout of %s with details as: %s", xbeeMacAddress, e, extra={"rateLimitKey": xbeeMacAddress})
+
+        return {"error": str(e)}
+
+def syncRoutedRegisters():
+
+    # Keeps the register structures built from the routing cache in step with it:
+    # the modbus units of unitId mode, the slots of the summary block and the control registers of the downlink
+
+    if variables.deviceContexts is not None:
+
+        variables.deviceContexts.sync(routingCache.routes())
+
+    if variables.summaryBlock is not None:
+
+        variables.summaryBlock.sync(routingCache.routes())
+
+    if variables.downlink is not None:
+
+        variables.downlink.sync(routingCache.routes())
+
+def nextFreeUnitId():
+
+    usedUnitIds = set(configuredRadioCollection.distinct("modbusUnitId"))
+
+    return next((unitId for unitId in modbusUnitIds if unitId not in usedUnitIds), None)
+
+def assignModbusUnitIds():
+
+    # Gives the lowest free unit ids to configured radios that have none, e.g. radios configured before unit ids existed
+
+    try:
+
+        usedUnitIds = set(configuredRadioCollection.distinct("modbusUnitId"))
+        freeUnitIds = (unitId for unitId in modbusUnitIds if unitId not in usedUnitIds)
+        updateOperation = []
+        unassigned = 0
+
+        for radio in configuredRadioCollection.find({"modbusUnitId": None}, {"xbeeMac": 1}).sort("modbusStartAddress", 1):
+
+            unitId = next(freeUnitIds, None)
+
+            if unitId is None:
+
+                unassigned += 1
+
+                continue
+
+            updateOperation.append(pymongo.UpdateOne({"_id": radio["_id"]}, {"$set": {"modbusUnitId": unitId}}))
+
+        if updateOperation:
+
+            configuredRadioCollection.bulk_write(updateOperation)
+
+            logger.info("Assigned modbus unit ids to %d configured radios", len(updateOperation))
+
+        if unassigned:
+
+            logger.warning("%d configured radios have no modbus unit id, unitId mode serves at most %d radios", unassigned, len(modbusUnitIds))
+
+        return len(updateOperation)
+
+    except Exception as e:
+
+        logger.error("Could not assign modbus unit ids with details as: %s", e)
+
+        return {"error": str(e)}
+
+def ensureDatabaseSchema():
+
+    # Brings the database schema (indexes, migrations) to the latest version once per process
+    # The gateway runs it at startup, the configuration paths on first use so the gui process gets it too
+
+    latestVersion = max(version for version, description, migrate in schemaMigrations)
+
+    if variables.databaseSchemaVersion is not None and variables.databaseSchemaVersion >= latestVersion:
+
+        return {"success": f"database schema at version {variables.databaseSchemaVersion}", "version": variables.databaseSchemaVersion}
+
+    result = bootstrapSchema(gatewayDb)
+    variables.databaseSchemaVersion = result["version"]
+
+    try:
+
+        ensureHistoryStorage(gatewayDb) # Collection and indexes of the single collection history modes
+
+    except Exception as e:
+
+        logger.error("Could not prepare %s history storage with details as: %s", variables.historyStorageMode, e)
+
+    try:
+
+        ensureRollupStorage(gatewayDb) # Rollup indexes and the retention of raw history and every rollup tier
+
+    except Exception as e:
+
+        logger.error("Could not apply history retention with details as: %s", e)
+
+    return result
+
+def uniqueIndexesReady():
+
+    return (ensureDatabaseSchema().get("version") or 0) >= 1
+
+def duplicateRadioError(duplicateKeyError, xbeeMacAddress, nodeIdentifier):
+
+    # Error of an insert rejected by a unique index, named after the radio already holding the value
+    # Servers that do not report the index key are answered by looking the radio up
+
+    keyPattern = (duplicateKeyError.details or {}).get("keyPattern") or {}
+
+    if "xbeeMac" in keyPattern or not keyPattern:
+
+        existingRadio = configuredRadioCollection.find_one({"xbeeMac": xbeeMacAddress})
+
+        if existingRadio:
+
+            return {"error":f"Mac address already utilized by {existingRadio['xbeeNodeIdentifier']}"}
+
+    if "xbeeNodeIdentifier" in keyPattern or not keyPattern:
+
+        existingRadio = configuredRadioCollection.find_one({"xbeeNodeIdentifier": nodeIdentifier})
+
+        if existingRadio:
+
+            return {"error":f"Node identifier already utiilized by ({existingRadio['xbeeMac']})"}
+
+    if "modbusUnitId" in keyPattern:
+
+        return {"error": "Modbus unit id taken by a radio configured meanwhile, try again"}
+
+    return {"error": str(duplicateKeyError)}
+
+def reservedAddressRanges():
+
+    # (start, end) register ranges no radio block may use
+
+    if variables.summaryBlockEnabled and variables.modbusAddressingMode == "shared":
+
+        return [(variables.summaryStartAddress, variables.summaryStartAddress + summaryRegisterCount() - 1)]
+
+    return []
+
+def allocateModbusAddress(blockSize=None, policy=None, alignment=None):
+
+    # Start address of the next free block by the address index, policy and alignment default to the gateway settings
+
+    try:
+
+        if not addressIndex.loaded:
+
+            loadAddressIndex()
+
+        blockSize = variables.incrementalModbusAddress if blockSize is None else blockSize
+        startAddress = addressIndex.allocate(blockSize, policy, alignment, reservedAddressRanges())
+
+        if startAddress is None:
+
+            return {"error": f"No free block of {blockSize} registers left"}
+
+        return startAddress
+
+    except Exception as e:
+
+        return {"error": str(e)}
+
 def configureXbeeRadio(xbeeMacAddress, startAddress, nodeIdentifier):
 
+    # startAddress None picks the next free block
+
     try:
 
         xbeeMacAddress = str(xbeeMacAddress).upper()
         nodeIdentifier = str(nodeIdentifier).upper()
 
+        if startAddress is None:
+
+            startAddress = allocateModbusAddress()
+
+            if isinstance(startAddress, dict):
+
+                return startAddress
+
         if type(startAddress) is not int:
 
             return {"error": f"Pass {startAddress} as an integer"}
@@ -220,23 +446,23 @@ def configureXbeeRadio(xbeeMacAddress, startAddress, nodeIdentifier):
 
             return {"error":"Invalid node identifier"}
         
-        validateUniqueMacAddress = configuredRadioCollection.find_one({"xbeeMac":xbeeMacAddress})
-        validateStartAddress = configuredRadioCollection.find_one({"modbusStartAddress":startAddress})
-        validateNodeIdentifier = configuredRadioCollection.find_one({"xbeeNodeIdentifier":nodeIdentifier})
+        # Mac address and node identifier are unique indexes, the insert below fails on a duplicate
+        # Only if the indexes could not be created (duplicates stored before them) are they checked beforehand
 
-        if validateUniqueMacAddress:
+        if not uniqueIndexesReady():
 
-            return {"error":f"Mac address already utilized by {validateUniqueMacAddress['xbeeNodeIdentifier']}"}
+            validateUniqueMacAddress = configuredRadioCollection.find_one({"xbeeMac":xbeeMacAddress})
+            validateNodeIdentifier = configuredRadioCollection.find_one({"xbeeNodeIdentifier":nodeIdentifier})
 
-        if validateStartAddress:
-            
-            return {"error":f"Start address already utilized by {validateStartAddress['xbeeNodeIdentifier']}"}
+            if validateUniqueMacAddress:
+
+                return {"error":f"Mac address already utilized by {validateUniqueMacAddress['xbeeNodeIdentifier']}"}
 
-        if validateNodeIdentifier:
+            if validateNodeIdentifier:
 
-            return {"error":f"Node identifier already utiilized by ({validateNodeIdentifier['xbeeMac']})"}
+                return {"error":f"Node identifier already utiilized by ({validateNodeIdentifier['xbeeMac']})"}
 
-        # Validate that specified modbus address is not in between two xbee device
+        # Validate that specified modbus address is not in between two xbee device (a start address already in use included)
 
         endAddress = startAddress + (variables.incrementalModbusAddress - 1)
         validAddress = modbusAddressPolice(startAddress, endAddress)
@@ -245,19 +471,39 @@ def configureXbeeRadio(xbeeMacAddress, startAddress, nodeIdentifier):
 
             return validAddress
         
-        xbeeData = {"xbeeNodeIdentifier":nodeIdentifier, "xbeeMac":xbeeMacAddress, "modbusStartAddress":startAddress, "modbusEndAddress":endAddress}
+        # Every radio gets a modbus unit id, used when the gateway runs in unitId addressing mode
+
+        unitId = nextFreeUnitId()
+
+        if unitId is None and variables.modbusAddressingMode == "unitId":
 
-        configuredXbee = configuredRadioCollection.insert_one(xbeeData)
+            return {"error": f"No free modbus unit id, unitId mode serves at most {len(modbusUnitIds)} radios"}
 
+        xbeeData = {"xbeeNodeIdentifier":nodeIdentifier, "xbeeMac":xbeeMacAddress, "modbusStartAddress":startAddress, "modbusEndAddress":endAddress, "modbusUnitId":unitId}
+
+        try:
+
+            configuredXbee = configuredRadioCollection.insert_one(xbeeData)
+
+        except DuplicateKeyError as e:
+
+            return duplicateRadioError(e, xbeeMacAddress, nodeIdentifier)
+
+        routingCache.updateRoute(xbeeData)
+        syncRoutedRegisters()
+        addressIndex.add(startAddress, endAddress, xbeeMacAddress)
         updateReusableAddress()
 
         # Create collection with the name been the xbee mac address to hold the recived radio data and timestamp for history purpose
+        # The single collection history modes need nothing per radio
+
+        if variables.historyStorageMode == "perRadio":
 
-        xbeeHistoryEntry = gatewayDb[xbeeMacAddress]
-        initializationData = {"timestamp": datetime.datetime.now(), "data":[0,0,0,0,0,0,0,0,0]}
-        historian = xbeeHistoryEntry.insert_one(initializationData)
+            xbeeHistoryEntry = gatewayDb[xbeeMacAddress]
+            ensureHistoryIndexes(xbeeHistoryEntry)
+            ensureRadioHistoryRetention(xbeeHistoryEntry)
 
-        if configuredXbee.inserted_id and historian.inserted_id:
+        if configuredXbee.inserted_id:
 
             return {"success":"radio configured successfully"}
         
@@ -267,9 +513,170 @@ def configureXbeeRadio(xbeeMacAddress, startAddress, nodeIdentifier):
 
         return {"error":str(e)}
     
+def provisionXbeeRadios(radios, policy=None, alignment=None, dryRun=False):
+
+    # Configures a batch of radios given as {"xbeeMac", "xbeeNodeIdentifier", "modbusStartAddress" (optional)}
+    # The whole batch is validated in memory against one read of the configured radios: radios with a start address
+    # claim it first, the others get the next free block, then every valid radio is inserted with one bulk_write
+    # Invalid rows are reported and skipped, rows are numbered from 1 in the order given, dryRun only validates
+
+    try:
+
+        ensureDatabaseSchema() # Unique indexes catch radios configured by another process while the batch is validated
+
+        if not addressIndex.loaded:
+
+            loadAddressIndex()
+
+        configuredRadios = list(configuredRadioCollection.find({}, {"xbeeMac": 1, "xbeeNodeIdentifier": 1, "modbusUnitId": 1, "_id": 0}))
+        usedMacAddresses = {str(radio.get("xbeeMac")).upper() for radio in configuredRadios}
+        usedNodeIdentifiers = {str(radio.get("xbeeNodeIdentifier")).upper() for radio in configuredRadios}
+        usedUnitIds = {radio.get("modbusUnitId") for radio in configuredRadios}
+        freeUnitIds = (unitId for unitId in modbusUnitIds if unitId not in usedUnitIds)
+        reservedRanges = reservedAddressRanges()
+        blockSize = variables.incrementalModbusAddress
+
+        errors = []
+        accepted = [] # (row, configuredRadio document)
+
+        # Rows with a chosen start address first, so automatically placed blocks are picked around them
+        rows = sorted(enumerate(radios, start=1), key=lambda item: not isinstance(item[1], dict) or item[1].get("modbusStartAddress") in (None, ""))
+
+        for row, radio in rows:
+
+            if not isinstance(radio, dict):
+
+                errors.append({"row": row, "xbeeMac": None, "error": "Row should be a dictionary"})
+
+                continue
+
+            xbeeMacAddress = str(radio.get("xbeeMac", "")).strip().upper()
+            nodeIdentifier = str(radio.get("xbeeNodeIdentifier", "")).strip().upper()
+            startAddress = radio.get("modbusStartAddress")
+            rowError = None
+
+            if len(xbeeMacAddress) != variables.validMacAddressLength:
+
+                rowError = "Invalid mac address entered"
+
+            elif not nodeIdentifier:
+
+                rowError = "Invalid node identifier"
+
+            elif xbeeMacAddress in usedMacAddresses:
+
+                rowError = "Mac address already configured or repeated in the batch"
+
+            elif nodeIdentifier in usedNodeIdentifiers:
+
+                rowError = "Node identifier already configured or repeated in the batch"
+
+            elif startAddress in (None, ""):
+
+                startAddress = addressIndex.allocate(blockSize, policy, alignment, reservedRanges)
+
+                if startAddress is None:
+
+                    rowError = f"No free block of {blockSize} registers left"
+
+            else:
+
+                try:
+
+                    startAddress = int(startAddress)
+
+                except (TypeError, ValueError):
+
+                    rowError = f"Start address {startAddress} is not an integer"
+
+                else:
+
+                    validAddress = modbusAddressPolice(startAddress, startAddress + blockSize - 1)
+
+                    if validAddress != True:
+
+                        rowError = validAddress["error"]
+
+            unitId = None if rowError else next(freeUnitIds, None)
+
+            if not rowError and unitId is None and variables.modbusAddressingMode == "unitId":
+
+                rowError = f"No free modbus unit id, unitId mode serves at most {len(modbusUnitIds)} radios"
+
+            if rowError:
+
+                errors.append({"row": row, "xbeeMac": xbeeMacAddress, "error": rowError})
+
+                continue
+
+            # Claimed in the index right away so later rows of the batch see the block as taken
+
+            endAddress = startAddress + blockSize - 1
+            addressIndex.add(startAddress, endAddress, xbeeMacAddress)
+            usedMacAddresses.add(xbeeMacAddress)
+            usedNodeIdentifiers.add(nodeIdentifier)
+            accepted.append((row, {"xbeeNodeIdentifier": nodeIdentifier, "xbeeMac": xbeeMacAddress, "modbusStartAddress": startAddress, "modbusEndAddress": endAddress, "modbusUnitId": unitId}))
+
+        if dryRun:
+
+            for row, xbeeData in accepted:
+
+                addressIndex.remove(xbeeData["xbeeMac"])
+
+            addressIndex.takeGapChanges()
+
+        elif accepted:
+
+            try:
+
+                configuredRadioCollection.bulk_write([pymongo.InsertOne(dict(xbeeData)) for row, xbeeData in accepted], ordered=False)
+
+            except BulkWriteError as e:
+
+                # Rows rejected by the database (e.g. a radio configured meanwhile by another process) are reported too
+
+                failedRows = {accepted[writeError["index"]][0]: writeError.get("errmsg") for writeError in e.details.get("writeErrors", [])}
+
+                for row, xbeeData in accepted:
+
+                    if row in failedRows:
+
+                        addressIndex.remove(xbeeData["xbeeMac"])
+                        errors.append({"row": row, "xbeeMac": xbeeData["xbeeMac"], "error": failedRows[row]})
+
+                accepted = [(row, xbeeData) for row, xbeeData in accepted if row not in failedRows]
+
+            for row, xbeeData in accepted:
+
+                routingCache.updateRoute(xbeeData)
+
+                if variables.historyStorageMode == "perRadio":
+
+                    # History collection of the radio, created by its indexes like configureXbeeRadio does
+                    ensureHistoryIndexes(gatewayDb[xbeeData["xbeeMac"]])
+                    ensureRadioHistoryRetention(gatewayDb[xbeeData["xbeeMac"]])
+
+            syncRoutedRegisters()
+            updateReusableAddress()
+
+        errors.sort(key=lambda rowError: rowError["row"])
+        configured = [xbeeData for row, xbeeData in sorted(accepted, key=lambda item: item[0])]
+
+        if not configured:
+
+            return {"error": "No radio configured", "configured": configured, "errors": errors}
+
+        return {"success": f"{len(configured)} radios {'valid' if dryRun else 'configured'}, {len(errors)} rows rejected", "configured": configured, "errors": errors}
+
+    except Exception as e:
+
+        addressIndex.loaded = False # Blocks claimed before the failure may not be stored, the index is reloaded on next use
+
+        return {"error": str(e)}
+
 def updateXbeeDetails(oldXbeeMacAddress, jsonParameterToBeUpdated):
 
-    validKeys = ["xbeeMac", "modbusStartAddress", "modbusEndAddress", "xbeeNodeIdentifier"]
+    validKeys = ["xbeeMac", "modbusStartAddress", "modbusEndAddress", "xbeeNodeIdentifier", "deadbands", "maxSilence", "modbusUnitId", "encoding", "registerLayout", "controlRegisters"]
 
     try:
 
@@ -321,7 +728,8 @@ def updateXbeeDetails(oldXbeeMacAddress, jsonParameterToBeUpdated):
                 
                 # Update the already existing historian collection for the specified xbee mac address
 
-                gatewayDb[oldXbeeMacAddress].rename(newMacAddress)
+                renameHistory(gatewayDb, oldXbeeMacAddress, newMacAddress)
+                renameRollups(gatewayDb, oldXbeeMacAddress, newMacAddress)
 
             if key in ("modbusStartAddress", "modbusEndAddress"):
 
@@ -331,7 +739,7 @@ def updateXbeeDetails(oldXbeeMacAddress, jsonParameterToBeUpdated):
 
                 reusableAddressUpdateNeeded = True
 
-                validAddress = modbusAddressPolice(startAddress, endAddress)
+                validAddress = modbusAddressPolice(startAddress, endAddress, oldXbeeMacAddress)
 
                 if validAddress != True:
                     
@@ -359,6 +767,68 @@ def updateXbeeDetails(oldXbeeMacAddress, jsonParameterToBeUpdated):
 
                     return {"error": "new node identifier already exist"}
 
+            if key == "deadbands":
+
+                deadbandError = validateDeadbands(jsonParameterToBeUpdated.get("deadbands"))
+
+                if deadbandError:
+
+                    return {"error": deadbandError}
+
+            if key == "maxSilence":
+
+                maxSilence = jsonParameterToBeUpdated.get("maxSilence")
+
+                if isinstance(maxSilence, bool) or not isinstance(maxSilence, (int, float)) or maxSilence <= 0:
+
+                    return {"error": "maxSilence should be a positive number of seconds"}
+
+            if key == "encoding":
+
+                profileError = validateRegisterProfile(jsonParameterToBeUpdated.get("encoding"))
+
+                if profileError:
+
+                    return {"error": profileError}
+
+            if key == "registerLayout":
+
+                layoutError = validateRegisterLayout(jsonParameterToBeUpdated.get("registerLayout"))
+
+                if layoutError:
+
+                    return {"error": layoutError}
+
+            if key == "controlRegisters":
+
+                if variables.modbusAddressingMode == "unitId":
+
+                    blockRegisters = variables.unitRegisterCount
+
+                else:
+
+                    blockRegisters = int(jsonParameterToBeUpdated.get("modbusEndAddress", oldMacExistence.get("modbusEndAddress"))) - int(jsonParameterToBeUpdated.get("modbusStartAddress", oldMacExistence.get("modbusStartAddress"))) + 1
+
+                controlError = validateControlRegisters(jsonParameterToBeUpdated.get("controlRegisters"), blockRegisters)
+
+                if controlError:
+
+                    return {"error": controlError}
+
+            if key == "modbusUnitId":
+
+                unitId = jsonParameterToBeUpdated.get("modbusUnitId")
+
+                if isinstance(unitId, bool) or not isinstance(unitId, int) or unitId not in modbusUnitIds:
+
+                    return {"error": f"modbusUnitId should be an integer from {modbusUnitIds.start} to {modbusUnitIds.stop - 1}"}
+
+                unitIdExistence = configuredRadioCollection.find_one({"modbusUnitId": unitId, "xbeeMac": {"$ne": oldXbeeMacAddress}})
+
+                if unitIdExistence:
+
+                    return {"error": f"Modbus unit id already utilized by {unitIdExistence['xbeeNodeIdentifier']}"}
+
         
         incomingUpdate = {"$set": jsonParameterToBeUpdated}
 
@@ -366,6 +836,24 @@ def updateXbeeDetails(oldXbeeMacAddress, jsonParameterToBeUpdated):
 
         if update.modified_count:
 
+            currentMacAddress = jsonParameterToBeUpdated.get("xbeeMac", oldXbeeMacAddress)
+
+            if currentMacAddress != oldXbeeMacAddress:
+
+                routingCache.removeRoute(oldXbeeMacAddress)
+                changeDetector.forget(oldXbeeMacAddress)
+                changeDetector.forget(currentMacAddress)
+
+            updatedRadio = configuredRadioCollection.find_one({"xbeeMac":currentMacAddress}, {"_id":0})
+
+            routingCache.updateRoute(updatedRadio)
+            syncRoutedRegisters()
+
+            if addressIndex.loaded and (currentMacAddress != oldXbeeMacAddress or reusableAddressUpdateNeeded):
+
+                addressIndex.remove(oldXbeeMacAddress)
+                addressIndex.add(int(updatedRadio["modbusStartAddress"]), int(updatedRadio["modbusEndAddress"]), currentMacAddress)
+
             if reusableAddressUpdateNeeded == True:
 
                 updateReusableAddress()
@@ -388,37 +876,97 @@ def storeXbeeHistoryData(xbeeMacAddress, xbeeData, xbeeDataTimestamp):
         xbeeMacAddress = str(xbeeMacAddress).upper()
 
         # Validate that mac address has been configured by checking if it exist in the general radio and modbus map collection
-        
-        validateMacAddress = configuredRadioCollection.find_one({"xbeeMac":xbeeMacAddress})
+        # The routing cache answers this without a database round trip once it has been loaded
+
+        if routingCache.loaded:
+
+            validateMacAddress = routingCache.lookupRoute(xbeeMacAddress)
+
+        else:
+
+            validateMacAddress = configuredRadioCollection.find_one({"xbeeMac":xbeeMacAddress})
 
         if not validateMacAddress:
             
-            print ("Mac Address has not been configured")
+            logger.warning("Mac Address %s has not been configured", xbeeMacAddress, extra={"rateLimitKey": xbeeMacAddress})
             return None
         
         # Validate that data is a list object
 
         if not isinstance(xbeeData, list):
 
-            print (f"Expected data {xbeeData} should be passed as list")
+            logger.warning("Expected data %s should be passed as list", xbeeData)
             return None
         
         dataToInsert = {"timestamp": xbeeDataTimestamp, "data":xbeeData}
-        xbeeHistoryEntry = gatewayDb[xbeeMacAddress]
-        historian = xbeeHistoryEntry.insert_one(dataToInsert)
+        insertedCount, failed, lastError = storeHistoryBatch(gatewayDb, [(xbeeMacAddress, dataToInsert)])
 
-        if historian.inserted_id:
+        if insertedCount:
 
             return True
 
-        print ("Could not update the database")    
+        logger.error("Could not update the database")
         return None
     
     except Exception as e:
 
-        print (f"Fatal error with details as; {str(e)}")
+        logger.error("Fatal error with details as; %s", e)
         return None
 
+def storeXbeeHistoryBatch(historyBatch):
+
+    # Bulk counterpart of storeXbeeHistoryData used by the background history writer
+    # historyBatch is a list of (mac address, {"timestamp": ..., "data": [...]}) already validated by the caller
+    # Written in the layout of historyStorageMode, entries that failed are handed back for retry
+
+    insertedCount, failed, lastError = storeHistoryBatch(gatewayDb, historyBatch)
+
+    if failed:
+
+        return {"error": lastError, "inserted": insertedCount, "failed": failed}
+
+    return {"success": f"stored {insertedCount} history documents", "inserted": insertedCount}
+
+def readXbeeHistory(xbeeMacAddress, startTime, endTime):
+
+    # {"timestamp", "data"} documents of a radio from startTime to endTime (excluded), whatever the storage mode
+
+    try:
+
+        return readHistory(gatewayDb, str(xbeeMacAddress).upper(), startTime, endTime)
+
+    except Exception as e:
+
+        return {"error": str(e)}
+
+def readXbeeRollups(xbeeMacAddress, tier, startTime, endTime):
+
+    # Per channel min/max/avg/count summaries of a radio in the 1m, 1h or 1d tier, for trends over long ranges
+
+    try:
+
+        return readRollups(gatewayDb, str(xbeeMacAddress).upper(), tier, startTime, endTime)
+
+    except Exception as e:
+
+        return {"error": str(e)}
+
+def rollupHistory():
+
+    # One pass of the background rollup engine over the history added since the previous pass
+
+    try:
+
+        rolledSamples, moreWaiting = rollupPass(gatewayDb)
+
+    except Exception as e:
+
+        logger.error("History rollup failed with details as: %s", e)
+
+        return {"error": str(e)}
+
+    return {"success": f"rolled up {rolledSamples} history samples", "samples": rolledSamples, "more": moreWaiting}
+
 # Swap history for cases where two radio location was swapped
 # In such scenerio, updating the xbee mac address would return an error
 # Using this swap function is recommended as it also swap the history records of the two location
@@ -441,16 +989,53 @@ def swapXbeeHistoryAndMacAddress(firstXbeeMacAddress, secondXbeeMacAddress):
 
             return {"error": f"second xbee mac address {(secondXbeeMacAddress)} not configured yet"}
 
-        # Carry out swapping
+        # Carry out swapping through a placeholder mac address, the unique xbeeMac index never sees both radios with
+        # the same mac address, documents are addressed by _id once their mac address changed
+
+        placeholderMacAddress = f"{firstXbeeMacAddress}-swap"
+
+        placeholderUpdate = configuredRadioCollection.update_one({"_id": validateFirstXbee["_id"]}, {"$set": {"xbeeMac": placeholderMacAddress}})
+
+        if not placeholderUpdate.modified_count:
+
+            return {"error": "Update request received, but no changes were made."}
+
+        secondUpdate = configuredRadioCollection.update_one({"_id": validateSecondXbee["_id"]}, {"$set": {"xbeeMac": firstXbeeMacAddress}})
+
+        if not secondUpdate.modified_count:
+
+            configuredRadioCollection.update_one({"_id": validateFirstXbee["_id"]}, {"$set": {"xbeeMac": firstXbeeMacAddress}})
+
+            return {"error": "Update request received, but no changes were made."}
+
+        firstUpdate = configuredRadioCollection.update_one({"_id": validateFirstXbee["_id"]}, {"$set": {"xbeeMac": secondXbeeMacAddress}})
 
-        gatewayDb[str(firstXbeeMacAddress)].rename(str(secondXbeeMacAddress))
-        gatewayDb[str(secondXbeeMacAddress)].rename(str(firstXbeeMacAddress))
+        # History and rollups follow only once both radio documents carry their new mac address
 
-        firstXbeeUpdate = {"$set": {"xbeeMac":secondXbeeMacAddress}}
-        secondXbeeUpdate = {"$set": {"xbeeMac":firstXbeeMacAddress}}
+        swapHistory(gatewayDb, firstXbeeMacAddress, secondXbeeMacAddress)
+        swapRollups(gatewayDb, firstXbeeMacAddress, secondXbeeMacAddress)
 
-        firstUpdate = configuredRadioCollection.update_one({"xbeeMac":firstXbeeMacAddress}, firstXbeeUpdate)
-        secondUpdate = configuredRadioCollection.update_one({"xbeeMac":secondXbeeMacAddress}, secondXbeeUpdate)
+        if firstUpdate.modified_count or secondUpdate.modified_count:
+
+            swappedRadios = list(configuredRadioCollection.find({"xbeeMac": {"$in": [firstXbeeMacAddress, secondXbeeMacAddress]}}, {"_id":0}))
+
+            for swappedRadio in swappedRadios:
+
+                routingCache.updateRoute(swappedRadio)
+                changeDetector.forget(swappedRadio["xbeeMac"]) # Its last frame was compared against the other radio's registers
+
+            if addressIndex.loaded:
+
+                # Both radios leave the index before either is added back, their ranges swap owners
+
+                addressIndex.remove(firstXbeeMacAddress)
+                addressIndex.remove(secondXbeeMacAddress)
+
+                for swappedRadio in swappedRadios:
+
+                    addressIndex.add(int(swappedRadio["modbusStartAddress"]), int(swappedRadio["modbusEndAddress"]), swappedRadio["xbeeMac"])
+
+            syncRoutedRegisters()
 
         if firstUpdate.modified_count and secondUpdate.modified_count:
 
@@ -477,7 +1062,15 @@ def deleteXbeeDetails(xbeeMacAddress):
         macDetailsToDelete = {"xbeeMac":xbeeMacAddress}
 
         deleteXbee = configuredRadioCollection.delete_one(macDetailsToDelete)
-        gatewayDb[xbeeMacAddress].drop()
+        dropHistory(gatewayDb, xbeeMacAddress)
+        dropRollups(gatewayDb, xbeeMacAddress)
+
+        if deleteXbee.deleted_count:
+
+            routingCache.removeRoute(xbeeMacAddress)
+            changeDetector.forget(xbeeMacAddress)
+            syncRoutedRegisters()
+            addressIndex.remove(xbeeMacAddress)
 
         if deleteXbee.deleted_count and xbeeMacAddress not in gatewayDb.list_collection_names():
 
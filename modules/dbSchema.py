@@ -0,0 +1,127 @@
+import datetime, logging
+import pymongo
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Indexes and versioned migrations of the Gateway database
+# The applied version is kept in the gatewaySchema collection, bootstrapSchema applies the migrations above it in order
+# and stops at the first failure so a later start retries it, every migration must be safe to run again
+# New schema changes are appended to schemaMigrations with the next version number, applied migrations never change
+# Index creation is idempotent on the server: an index that already exists with the same keys and options is kept
+
+schemaCollectionName = "gatewaySchema"
+schemaDocumentId = "gateway"
+
+def ensureHistoryIndexes(historyCollection):
+
+    # Index of a radio's history collection, called when the collection is created (configure, provision)
+
+    historyCollection.create_index([("timestamp", pymongo.ASCENDING)], name="timestamp")
+
+def createLookupIndexes(gatewayDb):
+
+    # Uniqueness of mac address and node identifier is enforced by the server, inserts racing on the same radio fail
+    # with DuplicateKeyError instead of both passing a find_one pre-check
+    # Unit ids are unique among radios that have one, radios configured before unit ids existed have none
+
+    configuredRadioCollection = gatewayDb["configuredRadio"]
+    configuredRadioCollection.create_index([("xbeeMac", pymongo.ASCENDING)], name="xbeeMac", unique=True)
+    configuredRadioCollection.create_index([("xbeeNodeIdentifier", pymongo.ASCENDING)], name="xbeeNodeIdentifier", unique=True)
+    configuredRadioCollection.create_index([("modbusStartAddress", pymongo.ASCENDING)], name="modbusStartAddress")
+    configuredRadioCollection.create_index([("modbusUnitId", pymongo.ASCENDING)], name="modbusUnitId", unique=True, partialFilterExpression={"modbusUnitId": {"$type": "int"}})
+
+    gatewayDb["availableModbusAddress"].create_index([("modbusAddressRange", pymongo.ASCENDING)], name="modbusAddressRange")
+
+    # Only radios with a per radio history collection, create_index would otherwise create an empty one
+
+    existingCollections = set(gatewayDb.list_collection_names())
+
+    for xbeeMacAddress in configuredRadioCollection.distinct("xbeeMac"):
+
+        if xbeeMacAddress in existingCollections:
+
+            ensureHistoryIndexes(gatewayDb[xbeeMacAddress])
+
+def removeHistorySeeds(gatewayDb):
+
+    # Radios used to be configured with an all zero placeholder as the first document of their history collection,
+    # it is not a sample of the radio and would be averaged into the rollups
+
+    seedData = [0, 0, 0, 0, 0, 0, 0, 0, 0]
+    existingCollections = set(gatewayDb.list_collection_names())
+
+    for xbeeMacAddress in gatewayDb["configuredRadio"].distinct("xbeeMac"):
+
+        if xbeeMacAddress not in existingCollections:
+
+            continue
+
+        firstDocument = gatewayDb[xbeeMacAddress].find_one({}, sort=[("_id", pymongo.ASCENDING)])
+
+        if firstDocument is not None and set(firstDocument) == {"_id", "timestamp", "data"} and firstDocument["data"] == seedData:
+
+            gatewayDb[xbeeMacAddress].delete_one({"_id": firstDocument["_id"]})
+
+# (version, description, function called with the Gateway database)
+schemaMigrations = [
+
+    (1, "configuredRadio lookup indexes with unique mac address and node identifier, history timestamp indexes", createLookupIndexes),
+    (2, "remove the all zero placeholder document of every radio history collection", removeHistorySeeds),
+
+]
+
+def schemaVersion(gatewayDb):
+
+    schemaDocument = gatewayDb[schemaCollectionName].find_one({"_id": schemaDocumentId})
+
+    return schemaDocument.get("version", 0) if schemaDocument else 0
+
+def bootstrapSchema(gatewayDb, migrations=None):
+
+    # Applies the migrations above the stored version, returns {"success", "version"} or {"error", "version"} with the
+    # version reached before the failing migration
+
+    migrations = sorted(schemaMigrations if migrations is None else migrations, key=lambda migration: migration[0])
+
+    try:
+
+        currentVersion = schemaVersion(gatewayDb)
+
+    except PyMongoError as e:
+
+        logger.error("Could not read the database schema version with details as: %s", e)
+
+        return {"error": str(e), "version": None}
+
+    for version, description, migrate in migrations:
+
+        if version <= currentVersion:
+
+            continue
+
+        try:
+
+            logger.info("Applying database migration %d: %s", version, description)
+
+            migrate(gatewayDb)
+
+            gatewayDb[schemaCollectionName].update_one(
+
+                {"_id": schemaDocumentId},
+                {"$set": {"version": version}, "$push": {"migrations": {"version": version, "description": description, "appliedAt": datetime.datetime.now()}}},
+                upsert=True
+
+            )
+
+        except Exception as e:
+
+            # e.g. duplicate mac addresses stored before the unique index existed, they have to be removed by hand
+
+            logger.error("Database migration %d failed, the schema stays at version %d: %s", version, currentVersion, e)
+
+            return {"error": f"migration {version} failed: {e}", "version": currentVersion}
+
+        currentVersion = version
+
+    return {"success": f"database schema at version {currentVersion}", "version": currentVersion}
@@ -0,0 +1,323 @@
+import time, asyncio, logging, threading
+from array import array
+from bisect import bisect_right
+from . import variables
+from .cayenneDecoder import lppTypes
+
+logger = logging.getLogger(__name__)
+
+# Modbus write back to the radios
+# Each radio's block ends with its control registers (controlRegisters [offset, count] of the radio, or
+# downlinkControlOffset and downlinkControlCount) followed by one delivery status register per control register
+# A client write (FC6, FC16) to a control register queues that control point for the radio, a write to a point that
+# is still waiting replaces its value, and each radio is sent at most once per downlinkMinInterval seconds with every
+# waiting point in one cayenne payload: channel downlinkChannelBase + point, type downlinkLppType, the register's raw value
+# Transmission goes through the coordinator that last heard the radio with digi-xbee send_data_async, which hands the
+# frame to the coordinator without waiting for the radio's acknowledgement
+# A status register reads as:
+#   bits 12-15  state of the point, pointQueued, pointSent, pointFailed or pointRejected (value does not fit the type)
+#   bits 0-11   transmissions of the point, wrapping at 4096, so a repeated command shows even when the state stays
+
+pointQueued = 1
+pointSent = 2
+pointFailed = 3
+pointRejected = 4
+
+stateShift = 12
+counterMask = 0x0FFF
+
+def validateControlRegisters(controlRegisters, blockRegisters=None):
+
+    # [offset in the radio's block, count], the values keep the registers before offset and the statuses follow the controls
+
+    blockRegisters = variables.incrementalModbusAddress if blockRegisters is None else blockRegisters
+
+    if not isinstance(controlRegisters, (list, tuple)) or len(controlRegisters) != 2 or any(isinstance(item, bool) or not isinstance(item, int) for item in controlRegisters):
+
+        return "controlRegisters should be [offset, count] in the radio's register block"
+
+    offset, count = controlRegisters
+
+    if count < 0 or offset < 2:
+
+        return "controlRegisters should leave at least 2 value registers before its offset and have a positive count"
+
+    if offset + 2 * count > blockRegisters:
+
+        return f"controlRegisters {offset} to {offset + 2 * count - 1} (controls and their statuses) do not fit the {blockRegisters} register block"
+
+    return None
+
+def controlRange(route, blockRegisters):
+
+    # (offset, count) of the radio's control registers, None when the downlink is off or the radio has none
+
+    if not variables.downlinkEnabled:
+
+        return None
+
+    controlRegisters = route.get("controlRegisters")
+    controlRegisters = [variables.downlinkControlOffset, variables.downlinkControlCount] if controlRegisters is None else controlRegisters
+    controlError = validateControlRegisters(controlRegisters, blockRegisters)
+
+    if controlError:
+
+        logger.warning("Radio %s has no downlink: %s", route["xbeeMac"], controlError, extra={"rateLimitKey": route["xbeeMac"]})
+
+        return None
+
+    return tuple(controlRegisters) if controlRegisters[1] else None
+
+def encodeCommand(points, channelBase, lppType):
+
+    # Cayenne payload of {point: raw register value}, returns (payload, points whose value the type cannot hold)
+
+    valueStruct = lppTypes[lppType][2]
+    signed = valueStruct.format[-1].islower()
+    payload = bytearray()
+    rejected = []
+
+    for point, value in sorted(points.items()):
+
+        if signed and value >= 0x8000:
+
+            value -= 0x10000
+
+        try:
+
+            payload += bytes((channelBase + point, lppType)) + valueStruct.pack(value)
+
+        except Exception:
+
+            rejected.append(point)
+
+    return bytes(payload), rejected
+
+class DownlinkQueue:
+
+    def __init__(self, registerImage=None, transmit=None, minInterval=None, channelBase=None, lppType=None):
+
+        self.registerImage = registerImage # Shared register image, None in unitId mode where statuses go to the radio's unit
+        self.transmit = self.transmitThroughCoordinator if transmit is None else transmit # Coroutine function (mac, payload)
+        self.minInterval = variables.downlinkMinInterval if minInterval is None else minInterval
+        self.channelBase = variables.downlinkChannelBase if channelBase is None else channelBase
+        self.lppType = variables.downlinkLppType if lppType is None else lppType
+
+        if self.lppType not in lppTypes or len(lppTypes[self.lppType][3]) != 1:
+
+            raise ValueError(f"Downlink cayenne type {self.lppType} is not a single value cayenne type")
+
+        self.clientWrites = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+
+        self._routes = {} # mac address -> route of radios with control registers
+        self._units = {} # modbus unit id -> mac address, unitId mode
+        self._controlIndex = ([], []) # Sorted first control registers of the shared map, and (first, count, mac address) of each
+        self._pending = {} # mac address -> {point: value} waiting to be sent
+        self._nextSend = {} # mac address -> monotonic time the radio may be sent to again
+        self._status = {} # (mac address, point) -> status word as last written
+        self._lastCoordinator = {} # mac address -> name of the coordinator that last heard the radio
+        self._lock = threading.Lock() # sync runs on dbIntegration worker threads, writes and sends on the event loop
+        self._wakeup = asyncio.Event()
+
+    def sync(self, routes):
+
+        # Rebuilds the control register index from the routing table
+
+        controlRoutes = {route["xbeeMac"]: route for route in routes if route.get("controlRange")}
+        controlRadios = sorted((route["modbusStartAddress"] + route["controlRange"][0], route["controlRange"][1], mac) for mac, route in controlRoutes.items())
+
+        with self._lock:
+
+            self._routes = controlRoutes
+            self._units = {route["modbusUnitId"]: mac for mac, route in controlRoutes.items() if route.get("modbusUnitId") is not None}
+            self._controlIndex = ([controlStart for controlStart, count, mac in controlRadios], controlRadios) # One assignment, lookups on the event loop never see half of it
+
+        return len(controlRoutes)
+
+    def recordCoordinator(self, xbeeMacAddress, coordinatorName):
+
+        if coordinatorName is not None:
+
+            self._lastCoordinator[xbeeMacAddress] = coordinatorName
+
+    def _locate(self, unitId, address):
+
+        # (mac address, point) of a written register, None when it is not a control register
+
+        if unitId is not None:
+
+            route = self._routes.get(self._units.get(unitId))
+
+            if route is None:
+
+                return None
+
+            point = address - route["controlRange"][0]
+
+            return (route["xbeeMac"], point) if 0 <= point < route["controlRange"][1] else None
+
+        controlStarts, controlRadios = self._controlIndex
+        index = bisect_right(controlStarts, address) - 1
+
+        if index < 0:
+
+            return None
+
+        controlStart, count, mac = controlRadios[index]
+
+        return (mac, address - controlStart) if address - controlStart < count else None
+
+    def clientWrite(self, unitId, startAddress, values):
+
+        # Called by the holding register datablock for every client write, unitId is None for the shared map
+
+        for index, value in enumerate(values):
+
+            target = self._locate(unitId, startAddress + index)
+
+            if target is None:
+
+                continue
+
+            mac, point = target
+            points = self._pending.setdefault(mac, {})
+
+            if point in points:
+
+                self.coalesced += 1
+
+            points[point] = value & 0xFFFF
+            self.clientWrites += 1
+            self._setStatus(mac, point, pointQueued, False)
+
+        if self._pending:
+
+            self._wakeup.set()
+
+    def _setStatus(self, xbeeMacAddress, point, state, transmitted):
+
+        route = self._routes.get(xbeeMacAddress)
+
+        if route is None:
+
+            return
+
+        status = self._status.get((xbeeMacAddress, point), 0)
+        status = state << stateShift | ((status + transmitted) & counterMask)
+        self._status[(xbeeMacAddress, point)] = status
+        offset, count = route["controlRange"]
+
+        if variables.deviceContexts is not None:
+
+            variables.deviceContexts.write(route, [(offset + count + point, array("H", (status,)))])
+
+        elif self.registerImage is not None:
+
+            self.registerImage.write(route["modbusStartAddress"] + offset + count + point, array("H", (status,)))
+
+    async def transmitThroughCoordinator(self, xbeeMacAddress, payload):
+
+        # The coordinator that last heard the radio, any connected one otherwise
+
+        connected = [coordinator for coordinator in variables.coordinators if coordinator.connected]
+        preferred = [coordinator for coordinator in connected if coordinator.name == self._lastCoordinator.get(xbeeMacAddress)]
+
+        if not connected:
+
+            raise ConnectionError("no coordinator radio is connected")
+
+        await (preferred or connected)[0].transmit(xbeeMacAddress, payload)
+
+    async def _send(self, xbeeMacAddress, points):
+
+        if xbeeMacAddress not in self._routes:
+
+            return # Deleted, or its control registers removed, while its points were waiting
+
+        payload, rejected = encodeCommand(points, self.channelBase, self.lppType)
+
+        for point in rejected:
+
+            logger.warning("Control point %d of %s: %d does not fit cayenne type %s, not sent", point, xbeeMacAddress, points.pop(point), self.lppType, extra={"rateLimitKey": xbeeMacAddress})
+            self.rejected += 1
+            self._setStatus(xbeeMacAddress, point, pointRejected, False)
+
+        if not points:
+
+            return
+
+        self._nextSend[xbeeMacAddress] = time.monotonic() + self.minInterval
+
+        try:
+
+            await self.transmit(xbeeMacAddress, payload)
+
+        except Exception as e:
+
+            logger.warning("Could not send %d control points to %s: %s", len(points), xbeeMacAddress, e, extra={"rateLimitKey": xbeeMacAddress})
+            self.failed += len(points)
+            state = pointFailed
+
+        else:
+
+            logger.debug("Sent control points %s to %s", points, xbeeMacAddress)
+            self.sent += len(points)
+            state = pointSent
+
+        for point in points:
+
+            # A newer write waiting for the next send keeps its queued state
+
+            if point not in self._pending.get(xbeeMacAddress, ()):
+
+                self._setStatus(xbeeMacAddress, point, state, True)
+
+    async def run(self):
+
+        while True:
+
+            self._wakeup.clear()
+            now = time.monotonic()
+
+            for mac in [mac for mac in self._pending if self._nextSend.get(mac, 0) <= now]:
+
+                await self._send(mac, self._pending.pop(mac))
+
+            if not self._pending:
+
+                await self._wakeup.wait()
+
+                continue
+
+            # Wait for the first rate limited radio to be due, or for a write to a radio that is due already
+
+            delay = min(self._nextSend.get(mac, 0) for mac in self._pending) - time.monotonic()
+
+            if delay > 0:
+
+                try:
+
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+
+                except asyncio.TimeoutError:
+
+                    pass
+
+    def stats(self):
+
+        return {
+
+            "radios": len(self._routes),
+            "pendingRadios": len(self._pending),
+            "pendingPoints": sum(len(points) for points in self._pending.values()),
+            "clientWrites": self.clientWrites,
+            "coalesced": self.coalesced,
+            "sent": self.sent,
+            "failed": self.failed,
+            "rejected": self.rejected
+
+        }
@@ -0,0 +1,346 @@
+import os, mmap, time, logging, threading
+from . import variables
+from struct import Struct
+
+logger = logging.getLogger(__name__)
+
+# Raw frame capture, records what the coordinators received before anything is decoded or routed
+# A capture file is a header followed by length prefixed records:
+#   frame record: radio timestamp, 64-bit mac address, coordinator name and the payload bytes as received
+#   index record: written every captureIndexInterval frames, covers the frames since the previous index record
+#                 (offset of the first one, first and last timestamp, count) and points back to the previous index record
+# A cleanly closed file ends with a trailer holding the offset of the last index record, so a reader can walk the
+# index chain backwards without touching the frames; a file cut short by a crash is still readable by a linear scan
+
+captureMagic = b"CGWCAP01"
+trailerMagic = b"CGWCEND1"
+
+frameRecordType = 1
+indexRecordType = 2
+
+recordHeader = Struct(">IB") # Record length (type byte and body), record type
+frameHeader = Struct(">d8sB") # Radio timestamp, mac address, coordinator name length
+indexBody = Struct(">QQddI") # Previous index record offset (0 for none), first frame offset, first and last timestamp, frame count
+trailer = Struct(">Q8s") # Last index record offset, trailer magic
+
+class FrameCaptureWriter:
+
+    # Frames are packed into an in memory buffer on the xbee reader threads and written to disk by a background thread,
+    # the files rotate at captureMaxBytes and only the newest captureMaxFiles are kept
+
+    def __init__(self, directory=None, maxBytes=None, maxFiles=None, indexInterval=None, flushInterval=None):
+
+        self.directory = variables.captureDirectory if directory is None else directory
+        self.maxBytes = variables.captureMaxBytes if maxBytes is None else maxBytes
+        self.maxFiles = variables.captureMaxFiles if maxFiles is None else maxFiles
+        self.indexInterval = variables.captureIndexInterval if indexInterval is None else indexInterval
+        self.flushInterval = variables.captureFlushInterval if flushInterval is None else flushInterval
+
+        self.capturedFrames = 0
+        self.droppedFrames = 0
+        self.currentPath = None
+
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._file = None
+        self._fileSize = 0
+        self._chunkStart = None # Offset of the first frame not covered by an index record yet
+        self._chunkFirstTime = None
+        self._chunkLastTime = None
+        self._chunkFrames = 0
+        self._lastIndexOffset = 0
+        self._fileSequence = 0
+        self._running = False
+        self._thread = None
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def capture(self, coordinatorName, xbeeMacAddress, radioTimestamp, xbeeDataAsByte):
+
+        # Called on the xbee reader thread, only packs the record into the buffer
+
+        coordinatorBytes = str(coordinatorName or "").encode()[:255]
+
+        try:
+
+            macBytes = bytes.fromhex(xbeeMacAddress)
+
+        except ValueError:
+
+            self.droppedFrames += 1
+
+            return
+
+        with self._lock:
+
+            if len(self._buffer) > variables.captureMaxBuffer:
+
+                self.droppedFrames += 1
+
+                return
+
+            self._buffer += recordHeader.pack(1 + frameHeader.size + len(coordinatorBytes) + len(xbeeDataAsByte), frameRecordType)
+            self._buffer += frameHeader.pack(radioTimestamp, macBytes, len(coordinatorBytes))
+            self._buffer += coordinatorBytes
+            self._buffer += xbeeDataAsByte
+            self.capturedFrames += 1
+
+    def start(self):
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="frame-capture", daemon=True)
+        self._thread.start()
+
+    def close(self):
+
+        self._running = False
+
+        if self._thread is not None:
+
+            self._thread.join()
+            self._thread = None
+
+        self._flush()
+        self._closeFile()
+
+    def _run(self):
+
+        while self._running:
+
+            time.sleep(self.flushInterval)
+
+            try:
+
+                self._flush()
+
+            except OSError as e:
+
+                logger.error("Frame capture write failed: %s", e)
+
+    def _openFile(self):
+
+        # The sequence number keeps names unique and ordered when several files are started within a second
+        self._fileSequence += 1
+        self.currentPath = os.path.join(self.directory, time.strftime("frames-%Y%m%d-%H%M%S") + f"-{self._fileSequence:04d}.cgc")
+        self._file = open(self.currentPath, "wb")
+        self._file.write(captureMagic)
+        self._fileSize = len(captureMagic)
+        self._lastIndexOffset = 0
+
+        logger.info("Capturing frames to %s", self.currentPath)
+
+        captures = sorted(name for name in os.listdir(self.directory) if name.startswith("frames-") and name.endswith(".cgc"))
+
+        for name in captures[:max(0, len(captures) - self.maxFiles)]:
+
+            os.remove(os.path.join(self.directory, name))
+
+    def _closeFile(self):
+
+        if self._file is None:
+
+            return
+
+        self._writeIndex()
+        self._file.write(trailer.pack(self._lastIndexOffset, trailerMagic))
+        self._file.close()
+        self._file = None
+
+    def _writeIndex(self):
+
+        if not self._chunkFrames:
+
+            return
+
+        indexOffset = self._fileSize
+        indexRecord = recordHeader.pack(1 + indexBody.size, indexRecordType) + indexBody.pack(self._lastIndexOffset, self._chunkStart, self._chunkFirstTime, self._chunkLastTime, self._chunkFrames)
+
+        self._file.write(indexRecord)
+        self._fileSize += len(indexRecord)
+        self._lastIndexOffset = indexOffset
+        self._chunkFrames = 0
+
+    def _flush(self):
+
+        with self._lock:
+
+            pending, self._buffer = self._buffer, bytearray()
+
+        if not pending:
+
+            return
+
+        if self._file is None:
+
+            self._openFile()
+
+        # Walk the packed frames once to place index records between them, only the headers are read
+
+        pendingView = memoryview(pending)
+        pointer = 0
+
+        while pointer < len(pending):
+
+            recordLength = recordHeader.unpack_from(pending, pointer)[0]
+            recordEnd = pointer + 4 + recordLength
+            radioTimestamp = frameHeader.unpack_from(pending, pointer + recordHeader.size)[0]
+
+            if not self._chunkFrames:
+
+                self._chunkStart = self._fileSize
+                self._chunkFirstTime = radioTimestamp
+
+            self._file.write(pendingView[pointer:recordEnd])
+            self._fileSize += recordEnd - pointer
+            self._chunkLastTime = radioTimestamp
+            self._chunkFrames += 1
+            pointer = recordEnd
+
+            if self._chunkFrames >= self.indexInterval:
+
+                self._writeIndex()
+
+        self._file.flush()
+
+        if self._fileSize >= self.maxBytes:
+
+            self._closeFile()
+
+    def stats(self):
+
+        return {
+
+            "path": self.currentPath,
+            "capturedFrames": self.capturedFrames,
+            "droppedFrames": self.droppedFrames,
+            "bufferedBytes": len(self._buffer)
+
+        }
+
+class CaptureReader:
+
+    # Memory maps a capture file, frames are yielded as views into the map without copying the payloads
+
+    def __init__(self, path):
+
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(captureMagic)] != captureMagic:
+
+            self.close()
+
+            raise ValueError(f"{path} is not a frame capture file")
+
+        # A file without trailer was not closed cleanly, its frames end at the last complete record
+
+        self.closedCleanly = len(self._map) >= len(captureMagic) + trailer.size and self._map[-len(trailerMagic):] == trailerMagic
+        self.dataEnd = len(self._map) - trailer.size if self.closedCleanly else len(self._map)
+
+    def close(self):
+
+        try:
+
+            self._map.close()
+
+        except BufferError:
+
+            pass # Payload views handed out by frames() are still alive, the map is released with the last of them
+
+        self._file.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exception):
+
+        self.close()
+
+    def indexEntries(self):
+
+        # (first frame offset, first timestamp, last timestamp, frame count) per chunk, oldest first
+        # Cleanly closed files are read through the index chain, others by hopping over the records
+
+        entries = []
+
+        if self.closedCleanly:
+
+            indexOffset = trailer.unpack_from(self._map, self.dataEnd)[0]
+
+            while indexOffset:
+
+                previousOffset, chunkStart, firstTime, lastTime, frameCount = indexBody.unpack_from(self._map, indexOffset + recordHeader.size)
+                entries.append((chunkStart, firstTime, lastTime, frameCount))
+                indexOffset = previousOffset
+
+            entries.reverse()
+
+            return entries
+
+        for offset, recordType in self._records(len(captureMagic)):
+
+            if recordType == indexRecordType:
+
+                previousOffset, chunkStart, firstTime, lastTime, frameCount = indexBody.unpack_from(self._map, offset + recordHeader.size)
+                entries.append((chunkStart, firstTime, lastTime, frameCount))
+
+        return entries
+
+    def seek(self, startTime):
+
+        # Offset to start reading from so that no frame at or after startTime is skipped
+
+        startOffset = len(captureMagic)
+
+        for chunkStart, firstTime, lastTime, frameCount in self.indexEntries():
+
+            if lastTime >= startTime:
+
+                return chunkStart
+
+            startOffset = chunkStart
+
+        return startOffset
+
+    def _records(self, offset):
+
+        captureMap = self._map
+        dataEnd = self.dataEnd
+
+        while offset + recordHeader.size <= dataEnd:
+
+            recordLength, recordType = recordHeader.unpack_from(captureMap, offset)
+
+            if offset + 4 + recordLength > dataEnd:
+
+                return # Record cut short by a crash
+
+            yield offset, recordType
+            offset += 4 + recordLength
+
+    def frames(self, startTime=None):
+
+        # Yields (coordinator name, mac address, radio timestamp, payload memoryview) in capture order
+
+        offset = len(captureMagic) if startTime is None else self.seek(startTime)
+        captureView = memoryview(self._map)
+
+        for recordOffset, recordType in self._records(offset):
+
+            if recordType != frameRecordType:
+
+                continue
+
+            recordLength = recordHeader.unpack_from(self._map, recordOffset)[0]
+            radioTimestamp, macBytes, coordinatorLength = frameHeader.unpack_from(self._map, recordOffset + recordHeader.size)
+
+            if startTime is not None and radioTimestamp < startTime:
+
+                continue
+
+            coordinatorStart = recordOffset + recordHeader.size + frameHeader.size
+            payloadStart = coordinatorStart + coordinatorLength
+
+            yield bytes(captureView[coordinatorStart:payloadStart]).decode(), macBytes.hex().upper(), radioTimestamp, captureView[payloadStart:recordOffset + 4 + recordLength]
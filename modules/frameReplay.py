@@ -0,0 +1,200 @@
+import sys, asyncio, logging, argparse
+from functools import partial
+from . import variables
+from .coordinator import Coordinator
+from .frameCapture import CaptureReader
+from .ingestBridge import makeDataReceiveCallback
+from .gatewayLogging import setupLogging, stopLogging
+
+logger = logging.getLogger(__name__)
+
+# Feeds a frame capture back into the gateway pipeline in place of the coordinator radios
+# speed 1 replays at the original pace, N replays N times faster and 0 replays flat out
+# Frames keep their radio timestamps, so a replay also rebuilds lost history with the original times
+# Run from the project root: python -m modules.frameReplay captures/frames-20250101-120000-0001.cgc --speed 10
+
+class ReplayRemoteDevice:
+
+    __slots__ = ("xbeeMacAddress",)
+
+    def __init__(self, xbeeMacAddress):
+
+        self.xbeeMacAddress = xbeeMacAddress
+
+    def get_64bit_addr(self):
+
+        return self.xbeeMacAddress
+
+class ReplayMessage:
+
+    # Duck typed digi-xbee XBeeMessage, only what the data received callback reads
+
+    __slots__ = ("remote_device", "data", "timestamp")
+
+    def __init__(self, xbeeMacAddress, data, timestamp):
+
+        self.remote_device = ReplayRemoteDevice(xbeeMacAddress)
+        self.data = data
+        self.timestamp = timestamp
+
+async def replayFrames(capturePaths, speed, ingestBridge, startTime=None, finished=None):
+
+    loop = asyncio.get_running_loop()
+    callbacks = {} # Coordinator name -> data received callback of its stand in coordinator
+    highWater = max(1, ingestBridge.capacity * 3 // 4) # Replay waits here instead of letting the overflow policy drop frames
+    replayedFrames = 0
+    firstRadioTime = None
+
+    for capturePath in capturePaths:
+
+        with CaptureReader(capturePath) as reader:
+
+            if not reader.closedCleanly:
+
+                logger.warning("%s was not closed cleanly, replaying up to its last complete frame", capturePath)
+
+            for coordinatorName, xbeeMacAddress, radioTimestamp, payload in reader.frames(startTime):
+
+                if speed:
+
+                    if firstRadioTime is None:
+
+                        firstRadioTime, replayStart = radioTimestamp, loop.time()
+
+                    delay = replayStart + (radioTimestamp - firstRadioTime) / speed - loop.time()
+
+                    if delay > 0:
+
+                        await asyncio.sleep(delay)
+
+                while ingestBridge.qsize() >= highWater:
+
+                    await asyncio.sleep(0.001)
+
+                callback = callbacks.get(coordinatorName)
+
+                if callback is None:
+
+                    coordinator = Coordinator(coordinatorName or "replay", ingestBridge)
+                    coordinator.connected = True
+                    variables.coordinators.append(coordinator)
+                    callback = callbacks[coordinatorName] = makeDataReceiveCallback(ingestBridge, coordinator)
+
+                # The payload is copied out of the map, frames outlive the reader once queued
+
+                callback(ReplayMessage(xbeeMacAddress, bytes(payload), radioTimestamp))
+                replayedFrames += 1
+
+                if not replayedFrames % 1000:
+
+                    await asyncio.sleep(0) # Flat out replay still lets the processing workers run
+
+    logger.info("Replayed %d frames from %d capture files", replayedFrames, len(capturePaths))
+
+    if finished is not None:
+
+        finished.set()
+
+async def replayIntoGateway(args):
+
+    from .main import startProcess, xbeeQueue
+
+    # The replayed coordinators stand in for the configured ones
+    variables.coordinators = []
+    variables.radioFlag = True
+
+    finished = asyncio.Event()
+    gateway = asyncio.create_task(startProcess(frameSource=partial(replayFrames, args.captures, args.speed, startTime=args.start_time, finished=finished)))
+    finishedWait = asyncio.create_task(finished.wait())
+
+    await asyncio.wait((gateway, finishedWait), return_when=asyncio.FIRST_COMPLETED)
+
+    if gateway.done():
+
+        finishedWait.cancel()
+        await gateway # Raises the reason the gateway stopped
+
+        return
+
+    if args.keep_running:
+
+        await gateway
+
+        return
+
+    # Let the queued frames reach the registers and history before stopping
+
+    while xbeeQueue.qsize() or any(variables.processingStage.shardDepths()):
+
+        await asyncio.sleep(0.05)
+
+    await asyncio.sleep(0.1)
+
+    while variables.historyWriter.backlog():
+
+        await variables.historyWriter.flush()
+
+    while variables.spoolDrainer is not None and variables.historySpool.depth():
+
+        drained, succeeded = await variables.spoolDrainer.drain()
+
+        if not succeeded:
+
+            logger.warning("%d replayed history documents left in the spool, they are drained on the next gateway start", variables.historySpool.depth())
+
+            break
+
+    gateway.cancel()
+
+    await asyncio.gather(gateway, return_exceptions=True)
+
+def describeCaptures(capturePaths):
+
+    for capturePath in capturePaths:
+
+        with CaptureReader(capturePath) as reader:
+
+            indexEntries = reader.indexEntries()
+            frameCount = sum(entry[3] for entry in indexEntries)
+
+            if indexEntries:
+
+                print (f"{capturePath}: {frameCount} indexed frames from {indexEntries[0][1]:.3f} to {indexEntries[-1][2]:.3f}, {len(indexEntries)} index blocks, closed cleanly: {reader.closedCleanly}")
+
+            else:
+
+                print (f"{capturePath}: no index blocks, closed cleanly: {reader.closedCleanly}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay frame captures through the gateway pipeline")
+    parser.add_argument("captures", nargs="+", help="Capture files, replayed in the given order")
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="1 for the original pace, N for N times faster, 0 for flat out")
+    parser.add_argument("-t", "--start-time", type=float, default=None, help="Unix time of the first frame to replay, earlier frames are skipped through the index")
+    parser.add_argument("-k", "--keep-running", action="store_true", help="Keep the gateway (modbus server, metrics) running after the replay")
+    parser.add_argument("-i", "--info", action="store_true", help="Only describe the captures from their index blocks")
+    args = parser.parse_args()
+
+    if args.info:
+
+        describeCaptures(args.captures)
+
+        sys.exit(0)
+
+    if args.speed < 0:
+
+        parser.error("speed should be 0 (flat out) or positive")
+
+    setupLogging()
+
+    try:
+
+        asyncio.run(replayIntoGateway(args))
+
+    except KeyboardInterrupt:
+
+        print ("\nReplay cancelled\n")
+
+    finally:
+
+        stopLogging()
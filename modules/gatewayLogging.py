@@ -0,0 +1,126 @@
+import sys, time, queue, logging, threading
+from . import variables
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Logging for the gateway process
+# Callers only format and enqueue a record, the file and console writes happen on the queue listener thread
+# Per packet details are logged at DEBUG so they are skipped before any formatting when DEBUG is disabled
+# Records logged with extra={"rateLimitKey": mac} are limited per mac address and message, so a radio sending
+# a burst of unconfigured or undecodable frames produces one line per interval instead of one per frame
+
+gatewayLoggerName = "modules"
+logFormat = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+class MacRateLimitFilter(logging.Filter):
+
+    def __init__(self, interval=None):
+
+        super().__init__()
+
+        self.interval = variables.logRateLimitInterval if interval is None else interval
+        self._lastEmitted = {} # (message template, rate limit key) -> [time of last emitted record, suppressed since]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+
+        rateLimitKey = getattr(record, "rateLimitKey", None)
+
+        if rateLimitKey is None or not self.interval:
+
+            return True
+
+        key = (record.msg, rateLimitKey)
+        now = time.monotonic()
+
+        with self._lock:
+
+            entry = self._lastEmitted.get(key)
+
+            if entry is not None and now - entry[0] < self.interval:
+
+                entry[1] += 1
+
+                return False
+
+            suppressed = 0 if entry is None else entry[1]
+            self._lastEmitted[key] = [now, 0]
+
+            if len(self._lastEmitted) > variables.logRateLimitKeys:
+
+                # Forget keys that were quiet for a whole interval, bounds memory with many radios
+
+                self._lastEmitted = {key: entry for key, entry in self._lastEmitted.items() if now - entry[0] < self.interval}
+
+        if suppressed:
+
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+
+        return True
+
+_listener = None
+
+def setupLogging(logFile=None, level=None, loggerLevels=None, console=None):
+
+    # Installs the queue handler on the gateway logger and starts the background listener, returns the listener
+
+    global _listener
+
+    if _listener is not None:
+
+        return _listener
+
+    logFile = variables.logFile if logFile is None else logFile
+    level = variables.logLevel if level is None else level
+    loggerLevels = variables.logLevels if loggerLevels is None else loggerLevels
+    console = variables.logToConsole if console is None else console
+
+    formatter = logging.Formatter(logFormat)
+    handlers = []
+
+    if logFile:
+
+        fileHandler = RotatingFileHandler(logFile, maxBytes=variables.logMaxBytes, backupCount=variables.logBackupCount, encoding="utf-8")
+        fileHandler.setFormatter(formatter)
+        handlers.append(fileHandler)
+
+    if console or not handlers:
+
+        consoleHandler = logging.StreamHandler(sys.stdout)
+        consoleHandler.setFormatter(formatter)
+        handlers.append(consoleHandler)
+
+    logQueue = queue.SimpleQueue()
+    queueHandler = QueueHandler(logQueue)
+    queueHandler.addFilter(MacRateLimitFilter())
+
+    gatewayLogger = logging.getLogger(gatewayLoggerName)
+    gatewayLogger.setLevel(level)
+    gatewayLogger.addHandler(queueHandler)
+    gatewayLogger.propagate = False
+
+    for loggerName, loggerLevel in loggerLevels.items():
+
+        logging.getLogger(loggerName).setLevel(loggerLevel)
+
+    _listener = QueueListener(logQueue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    return _listener
+
+def stopLogging():
+
+    # Flushes every queued record to the handlers, called once on shutdown
+
+    global _listener
+
+    if _listener is None:
+
+        return
+
+    _listener.stop()
+
+    for handler in _listener.handlers:
+
+        handler.close()
+
+    _listener = None
@@ -0,0 +1,187 @@
+import argparse, datetime, logging
+from . import variables
+from .historyStore import historyStorageModes, ensureHistoryStorage, storeHistoryBatch
+from .historyRollup import watermarkCollectionName
+
+logger = logging.getLogger(__name__)
+
+# Moves the per radio history collections into the single collection layout of the timeSeries or hourBuckets mode
+# Each configured radio's collection is streamed in _id order, batchSize documents at a time, and every batch is written
+# with storeHistoryBatch: one insert_many or bulk_write per batch, nothing is held in memory beyond one batch
+# The _id of the last copied document is checkpointed per radio in the historyMigration collection after each batch,
+# a stopped migration started again continues from there instead of copying the radio again
+# Set historyStorageMode to the target mode once the migration finished, radios keep writing the old layout until then
+# Samples the rollup engine already counted are not counted again: time series documents keep their _id and the
+# radio's rollup watermark is copied to the target mode, hour buckets only holding samples below it are not flagged
+# Run from the project root: python -m modules.historyMigration hourBuckets --batch-size 5000 --dry-run
+
+migrationCollectionName = "historyMigration"
+
+def migrateRadioHistory(gatewayDb, xbeeMacAddress, targetMode, batchSize, dryRun=False):
+
+    # Returns {"success", "copied"} or {"error", "copied"}, copied counts this run's documents only
+    # A radio already migrated only gets the documents written to its collection since
+
+    checkpoints = gatewayDb[migrationCollectionName]
+    checkpointId = f"{targetMode}:{xbeeMacAddress}"
+    checkpoint = checkpoints.find_one({"_id": checkpointId}) or {}
+
+    rollupWatermark = (gatewayDb[watermarkCollectionName].find_one({"_id": f"perRadio:{xbeeMacAddress}"}) or {}).get("lastId")
+    query = {"_id": {"$gt": checkpoint["lastId"]}} if "lastId" in checkpoint else {}
+    cursor = gatewayDb[xbeeMacAddress].find(query, {"timestamp": 1, "data": 1}).sort("_id", 1).batch_size(batchSize)
+    copied = 0
+    batch = []
+    lastId = None
+
+    def flush():
+
+        if dryRun:
+
+            return None
+
+        # Documents are in _id order, the rolled up ones come first
+
+        # Each part is checkpointed once stored, a retried part is not stored twice (storeHistoryBatch skips documents
+        # whose _id is already stored)
+
+        rolledUp = [entry for entry in batch if rollupWatermark is not None and entry[1]["_id"] <= rollupWatermark]
+
+        for entries, rolled, checkpointLastId in ((rolledUp, True, rolledUp[-1][1]["_id"] if rolledUp else None), (batch[len(rolledUp):], False, lastId)):
+
+            if checkpointLastId is None:
+
+                continue
+
+            storedCount, failed, lastError = storeHistoryBatch(gatewayDb, entries, targetMode, rolledUp=rolled)
+
+            if failed:
+
+                return lastError
+
+            checkpoints.update_one({"_id": checkpointId}, {"$set": {"lastId": checkpointLastId, "updatedAt": datetime.datetime.now()}, "$inc": {"copied": storedCount}}, upsert=True)
+
+        return None
+
+    for document in cursor:
+
+        # Documents without a timestamp cannot be placed in time, they are skipped like readers skip them
+
+        if isinstance(document.get("timestamp"), datetime.datetime):
+
+            batch.append((xbeeMacAddress, {"_id": document["_id"], "timestamp": document["timestamp"], "data": document.get("data")}))
+
+        lastId = document["_id"]
+
+        if len(batch) >= batchSize:
+
+            lastError = flush()
+
+            if lastError:
+
+                return {"error": lastError, "copied": copied}
+
+            copied += len(batch)
+            batch = []
+
+    if lastId is not None:
+
+        lastError = flush()
+
+        if lastError:
+
+            return {"error": lastError, "copied": copied}
+
+        copied += len(batch)
+
+    if not dryRun:
+
+        if rollupWatermark is not None and targetMode == "timeSeries":
+
+            gatewayDb[watermarkCollectionName].update_one({"_id": f"timeSeries:{xbeeMacAddress}"}, {"$max": {"lastId": rollupWatermark}, "$set": {"updatedAt": datetime.datetime.now()}}, upsert=True)
+
+        checkpoints.update_one({"_id": checkpointId}, {"$set": {"done": True, "updatedAt": datetime.datetime.now()}}, upsert=True)
+
+    return {"success": f"{xbeeMacAddress} migrated", "copied": copied}
+
+def migrateHistory(gatewayDb, targetMode, batchSize=None, dropSource=False, dryRun=False):
+
+    # Migrates every configured radio with a per radio history collection, returns {"success" or "error", "radios"}
+    # with the result of each radio, a failing radio does not stop the others
+
+    if targetMode not in historyStorageModes or targetMode == "perRadio":
+
+        return {"error": f"Invalid target mode {targetMode}. Allowed modes: {historyStorageModes[1:]}", "radios": {}}
+
+    if dropSource and not dryRun and variables.historyStorageMode == "perRadio":
+
+        # The gateway still writes every radio's collection, samples written after its copy would be dropped with it
+
+        return {"error": f"Set historyStorageMode to {targetMode} and restart the gateway before dropping the per radio collections", "radios": {}}
+
+    batchSize = batchSize or variables.historyBatchSize
+
+    if not dryRun:
+
+        ensureHistoryStorage(gatewayDb, targetMode)
+
+    existingCollections = set(gatewayDb.list_collection_names())
+    results = {}
+
+    for xbeeMacAddress in gatewayDb["configuredRadio"].distinct("xbeeMac"):
+
+        if xbeeMacAddress not in existingCollections:
+
+            continue
+
+        try:
+
+            results[xbeeMacAddress] = migrateRadioHistory(gatewayDb, xbeeMacAddress, targetMode, batchSize, dryRun)
+
+        except Exception as e:
+
+            logger.error("History migration of %s failed with details as: %s", xbeeMacAddress, e)
+            results[xbeeMacAddress] = {"error": str(e), "copied": 0}
+
+        if dropSource and not dryRun and "success" in results[xbeeMacAddress]:
+
+            # Documents a gateway still running the old layout wrote since the copy are copied before the drop
+
+            catchUp = migrateRadioHistory(gatewayDb, xbeeMacAddress, targetMode, batchSize)
+            results[xbeeMacAddress]["copied"] += catchUp["copied"]
+
+            if "error" in catchUp:
+
+                results[xbeeMacAddress] = catchUp
+
+            else:
+
+                gatewayDb[xbeeMacAddress].drop()
+
+    failedRadios = [xbeeMacAddress for xbeeMacAddress, result in results.items() if "error" in result]
+    copied = sum(result["copied"] for result in results.values())
+
+    if failedRadios:
+
+        return {"error": f"{len(failedRadios)} of {len(results)} radios failed, run again to resume them", "radios": results}
+
+    return {"success": f"{len(results)} radios, {copied} history documents {'would be ' if dryRun else ''}copied to {targetMode}", "radios": results}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Copy the per radio history collections into the timeSeries or hourBuckets layout")
+    parser.add_argument("mode", choices=historyStorageModes[1:], help="Target history storage mode")
+    parser.add_argument("-b", "--batch-size", type=int, default=None, help=f"History documents read and written per batch, default {variables.historyBatchSize}")
+    parser.add_argument("--drop-source", action="store_true", help="Drop each radio's collection once it is fully copied, historyStorageMode must already be the target mode")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Read and count without writing anything")
+    args = parser.parse_args()
+
+    # Imported here so --help works without a database connection
+    from .dbIntegration import gatewayDb
+
+    result = migrateHistory(gatewayDb, args.mode, batchSize=args.batch_size, dropSource=args.drop_source, dryRun=args.dry_run)
+
+    for xbeeMacAddress, radioResult in result["radios"].items():
+
+        print (f"{xbeeMacAddress}  {radioResult['copied']:>10}  {radioResult.get('success') or radioResult.get('error')}")
+
+    print (result.get("success") or result.get("error"))
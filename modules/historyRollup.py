@@ -0,0 +1,515 @@
+import asyncio, datetime, logging, math, time
+import pymongo
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from . import variables
+from .historyStore import validateHistoryStorageMode, historyCollection, readHistory
+
+logger = logging.getLogger(__name__)
+
+# Background rollups of raw history into 1 minute, 1 hour and 1 day summaries per radio and channel
+# A rollup document is {"xbeeMac", "bucketStart", "count", "channels": {"<index>": {"min", "max", "sum", "count"}}},
+# the average is sum / count, computed when read
+# A pass finds the minutes that received raw samples and recomputes them from the raw history, then the hours of
+# those minutes from the minute tier and the days from the hour tier: every write is a $set of the whole summary, so
+# reading a sample again never counts it twice and a sample arriving late (spool drain, replay) lands in its buckets
+# How a pass finds the minutes with new samples:
+#   perRadio and timeSeries  the _id of the last document read of each radio is kept in rollupWatermark, a pass reads
+#                            the radio's documents above it and, again, those given their _id in the last
+#                            rollupLookback seconds: an _id comes from the clock of the process inserting it, another
+#                            process or a clock step can insert below the watermark; documents younger than
+#                            rollupSettleDelay wait for the next pass so an insert still in flight is not missed
+#   hourBuckets              storeHistoryBatch flags a bucket rollupPending, a pass recomputes the flagged buckets'
+#                            minutes from their samples and clears the flag unless a sample was pushed meanwhile
+# Retention is a TTL per tier: raw history after rawHistoryRetentionDays, rollup tiers after rollupRetentionDays
+# History timestamps and bucket starts are local naive times that mongodb reads as UTC, so every expireAfterSeconds
+# is shifted by the host's UTC offset when the gateway starts (a daylight saving change applies from the next start)
+
+rollupTiers = ("1m", "1h", "1d")
+tierSteps = {"1m": datetime.timedelta(minutes=1), "1h": datetime.timedelta(hours=1), "1d": datetime.timedelta(days=1)}
+watermarkCollectionName = "rollupWatermark"
+
+def tierStart(tier, timestamp):
+
+    if tier == "1m":
+
+        return timestamp.replace(second=0, microsecond=0)
+
+    if tier == "1h":
+
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def rollupCollection(gatewayDb, tier):
+
+    return gatewayDb[f"{variables.rollupCollectionPrefix}{tier}"]
+
+def utcOffsetSeconds():
+
+    # Seconds the host's local time is ahead of UTC, negative west of Greenwich
+
+    return int(datetime.datetime.now().astimezone().utcoffset().total_seconds())
+
+def retentionSeconds(days):
+
+    # A local time read as UTC is utcOffsetSeconds late (early west of Greenwich), the expiry makes up for it
+
+    return None if days is None else max(0, int(days * 86400) - utcOffsetSeconds())
+
+def ensureTtlIndex(collection, field, name, expireAfterSeconds, keepIndex=False):
+
+    # Single field index expiring documents expireAfterSeconds after field, None removes the expiry
+    # keepIndex keeps a plain index when the expiry is removed, for indexes queries rely on
+
+    currentIndex = collection.index_information().get(name)
+
+    if currentIndex is not None and currentIndex.get("expireAfterSeconds") == expireAfterSeconds:
+
+        return
+
+    if expireAfterSeconds is None:
+
+        if currentIndex is not None:
+
+            collection.drop_index(name)
+
+            if keepIndex:
+
+                collection.create_index([(field, pymongo.ASCENDING)], name=name)
+
+        return
+
+    if currentIndex is None:
+
+        collection.create_index([(field, pymongo.ASCENDING)], name=name, expireAfterSeconds=expireAfterSeconds)
+
+        return
+
+    try:
+
+        collection.database.command("collMod", collection.name, index={"name": name, "expireAfterSeconds": expireAfterSeconds})
+
+    except OperationFailure:
+
+        # Servers before 5.1 cannot turn a plain index into a TTL index
+
+        collection.drop_index(name)
+        collection.create_index([(field, pymongo.ASCENDING)], name=name, expireAfterSeconds=expireAfterSeconds)
+
+def ensureRadioHistoryRetention(radioHistoryCollection):
+
+    # Raw retention of one per radio history collection, its timestamp index becomes the TTL index
+
+    ensureTtlIndex(radioHistoryCollection, "timestamp", "timestamp", retentionSeconds(variables.rawHistoryRetentionDays), keepIndex=True)
+
+def ensureRollupStorage(gatewayDb, mode=None):
+
+    # Indexes of the rollup collections and the retention of raw history and every tier, safe to call on every start
+
+    mode = validateHistoryStorageMode(mode)
+    rawRetention = retentionSeconds(variables.rawHistoryRetentionDays)
+
+    if mode == "perRadio":
+
+        existingCollections = set(gatewayDb.list_collection_names())
+
+        for xbeeMacAddress in gatewayDb["configuredRadio"].distinct("xbeeMac"):
+
+            if xbeeMacAddress in existingCollections:
+
+                ensureRadioHistoryRetention(gatewayDb[xbeeMacAddress])
+
+    elif mode == "timeSeries":
+
+        gatewayDb.command("collMod", variables.historyCollectionName, expireAfterSeconds="off" if rawRetention is None else rawRetention)
+
+    else:
+
+        # A bucket expires as a whole once its hour is older than the retention
+
+        ensureTtlIndex(historyCollection(gatewayDb), "bucketStart", "bucketStartTtl", rawRetention)
+
+    for tier in rollupTiers:
+
+        rollupCollection(gatewayDb, tier).create_index([("xbeeMac", pymongo.ASCENDING), ("bucketStart", pymongo.ASCENDING)], name="xbeeMacBucketStart", unique=True)
+        ensureTtlIndex(rollupCollection(gatewayDb, tier), "bucketStart", "bucketStartTtl", retentionSeconds(variables.rollupRetentionDays.get(tier)))
+
+def tierRuns(bucketStarts, tier):
+
+    # Sorted bucket starts grouped into (run start, run end) ranges of consecutive buckets, one query per range
+
+    step = tierSteps[tier]
+    runs = []
+
+    for start in sorted(bucketStarts):
+
+        if runs and runs[-1][1] == start:
+
+            runs[-1][1] = start + step
+
+        else:
+
+            runs.append([start, start + step])
+
+    return runs
+
+def summarizeSamples(samples):
+
+    # {"count", "channels": {index: [min, max, sum, count]}} of raw samples, values that are not finite numbers are
+    # left out of their channel
+
+    summary = {"count": 0, "channels": {}}
+
+    for sample in samples:
+
+        summary["count"] += 1
+
+        for index, value in enumerate(sample.get("data") or []):
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+
+                continue
+
+            channel = summary["channels"].get(index)
+
+            if channel is None:
+
+                summary["channels"][index] = [value, value, value, 1]
+
+            else:
+
+                channel[0] = min(channel[0], value)
+                channel[1] = max(channel[1], value)
+                channel[2] += value
+                channel[3] += 1
+
+    return summary
+
+def mergeSummaries(storedSummaries):
+
+    # Summary of a bucket from the stored summaries of the tier below it
+
+    summary = {"count": 0, "channels": {}}
+
+    for storedSummary in storedSummaries:
+
+        summary["count"] += storedSummary.get("count", 0)
+
+        for index, stored in storedSummary.get("channels", {}).items():
+
+            channel = summary["channels"].get(int(index))
+
+            if channel is None:
+
+                summary["channels"][int(index)] = [stored["min"], stored["max"], stored["sum"], stored["count"]]
+
+            else:
+
+                channel[0] = min(channel[0], stored["min"])
+                channel[1] = max(channel[1], stored["max"])
+                channel[2] += stored["sum"]
+                channel[3] += stored["count"]
+
+    return summary
+
+def writeSummaries(gatewayDb, tier, summaries):
+
+    # summaries is (mac address, bucket start) -> summary, one unordered bulk_write of whole summary upserts
+
+    if not summaries:
+
+        return
+
+    updatedAt = datetime.datetime.now()
+
+    rollupCollection(gatewayDb, tier).bulk_write([pymongo.UpdateOne(
+
+        {"xbeeMac": xbeeMacAddress, "bucketStart": bucketStart},
+        {"$set": {
+            "count": summary["count"],
+            "channels": {str(index): {"min": minimum, "max": maximum, "sum": total, "count": count} for index, (minimum, maximum, total, count) in summary["channels"].items()},
+            "updatedAt": updatedAt
+        }},
+        upsert=True
+
+    ) for (xbeeMacAddress, bucketStart), summary in summaries.items()], ordered=False)
+
+def refreshRollups(gatewayDb, mode, touchedMinutes):
+
+    # touchedMinutes is mac address -> minute starts that received samples, returns the raw samples summarized
+
+    minuteSummaries = {}
+    summarizedSamples = 0
+
+    for xbeeMacAddress, minuteStarts in touchedMinutes.items():
+
+        for runStart, runEnd in tierRuns(minuteStarts, "1m"):
+
+            samplesPerMinute = {}
+
+            for sample in readHistory(gatewayDb, xbeeMacAddress, runStart, runEnd, mode):
+
+                if isinstance(sample.get("timestamp"), datetime.datetime):
+
+                    samplesPerMinute.setdefault(tierStart("1m", sample["timestamp"]), []).append(sample)
+
+            for minuteStart, samples in samplesPerMinute.items():
+
+                if minuteStart in minuteStarts:
+
+                    minuteSummaries[(xbeeMacAddress, minuteStart)] = summarizeSamples(samples)
+                    summarizedSamples += len(samples)
+
+    writeSummaries(gatewayDb, "1m", minuteSummaries)
+
+    # Hours from the minute tier, days from the hour tier
+
+    touchedBuckets = touchedMinutes
+
+    for tier, sourceTier in (("1h", "1m"), ("1d", "1h")):
+
+        touchedBuckets = {xbeeMacAddress: {tierStart(tier, start) for start in starts} for xbeeMacAddress, starts in touchedBuckets.items()}
+        storedPerBucket = {}
+
+        for xbeeMacAddress, bucketStarts in touchedBuckets.items():
+
+            for runStart, runEnd in tierRuns(bucketStarts, tier):
+
+                for storedSummary in rollupCollection(gatewayDb, sourceTier).find({"xbeeMac": xbeeMacAddress, "bucketStart": {"$gte": runStart, "$lt": runEnd}}, {"_id": 0, "bucketStart": 1, "count": 1, "channels": 1}):
+
+                    storedPerBucket.setdefault((xbeeMacAddress, tierStart(tier, storedSummary["bucketStart"])), []).append(storedSummary)
+
+        writeSummaries(gatewayDb, tier, {bucket: mergeSummaries(storedSummaries) for bucket, storedSummaries in storedPerBucket.items()})
+
+    return summarizedSamples
+
+def rollupRadioDocuments(gatewayDb, mode, batchSize, settleDelay, lookback):
+
+    # perRadio and timeSeries pass, at most batchSize documents above each radio's watermark
+
+    watermarks = gatewayDb[watermarkCollectionName]
+    storedWatermarks = {watermark["_id"]: watermark["lastId"] for watermark in watermarks.find({"_id": {"$regex": f"^{mode}:"}})}
+    settledTime = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=settleDelay)
+    settledId = ObjectId.from_datetime(settledTime)
+    lookbackId = ObjectId.from_datetime(settledTime - datetime.timedelta(seconds=lookback))
+    touchedMinutes = {}
+    advancedWatermarks = {}
+    moreWaiting = False
+
+    for xbeeMacAddress in gatewayDb["configuredRadio"].distinct("xbeeMac"):
+
+        watermarkId = f"{mode}:{xbeeMacAddress}"
+        lastId = storedWatermarks.get(watermarkId)
+
+        if mode == "perRadio":
+
+            collection, radioFilter = gatewayDb[xbeeMacAddress], {}
+
+        else:
+
+            collection, radioFilter = historyCollection(gatewayDb), {"xbeeMac": xbeeMacAddress}
+
+        # The batch ends at the batchSize-th document above the watermark, or at the settled documents
+
+        newRange = {"$lt": settledId} if lastId is None else {"$gt": lastId, "$lt": settledId}
+        batchEnd = list(collection.find({**radioFilter, "_id": newRange}, {"_id": 1}).sort("_id", pymongo.ASCENDING).skip(batchSize - 1).limit(1))
+        scanRange = {"$lte": batchEnd[0]["_id"]} if batchEnd else {"$lt": settledId}
+
+        if lastId is not None:
+
+            scanRange["$gt"] = min(lastId, lookbackId)
+
+        documents = list(collection.find({**radioFilter, "_id": scanRange}, {"timestamp": 1}))
+
+        if not documents:
+
+            continue
+
+        touchedMinutes[xbeeMacAddress] = {tierStart("1m", document["timestamp"]) for document in documents if isinstance(document.get("timestamp"), datetime.datetime)}
+        highestId = max(document["_id"] for document in documents)
+
+        if lastId is None or highestId > lastId:
+
+            advancedWatermarks[watermarkId] = highestId
+
+        moreWaiting = moreWaiting or bool(batchEnd)
+
+    summarizedSamples = refreshRollups(gatewayDb, mode, touchedMinutes)
+
+    if advancedWatermarks:
+
+        updatedAt = datetime.datetime.now()
+
+        watermarks.bulk_write([pymongo.UpdateOne({"_id": watermarkId}, {"$set": {"lastId": lastId, "updatedAt": updatedAt}}, upsert=True) for watermarkId, lastId in advancedWatermarks.items()], ordered=False)
+
+    return summarizedSamples, moreWaiting
+
+def rollupHourBuckets(gatewayDb, batchSize):
+
+    # hourBuckets pass, flagged buckets are read until about batchSize samples were found
+
+    buckets = []
+    pendingSamples = 0
+
+    for bucket in historyCollection(gatewayDb).find({"rollupPending": True}, {"xbeeMac": 1, "samples.timestamp": 1}):
+
+        buckets.append(bucket)
+        pendingSamples += len(bucket["samples"])
+
+        if pendingSamples >= batchSize:
+
+            break
+
+    touchedMinutes = {}
+
+    for bucket in buckets:
+
+        touchedMinutes.setdefault(bucket["xbeeMac"], set()).update(tierStart("1m", sample["timestamp"]) for sample in bucket["samples"])
+
+    summarizedSamples = refreshRollups(gatewayDb, "hourBuckets", touchedMinutes)
+
+    for bucket in buckets:
+
+        # The flag is only cleared when no sample was pushed since the bucket was read, count is the samples length
+
+        historyCollection(gatewayDb).update_one({"_id": bucket["_id"], "count": len(bucket["samples"])}, {"$unset": {"rollupPending": ""}})
+
+    return summarizedSamples, pendingSamples >= batchSize
+
+def rollupPass(gatewayDb, mode=None, batchSize=None, settleDelay=None, lookback=None):
+
+    # Recomputes the rollups of the raw samples added since the previous pass, returns (raw samples summarized,
+    # whether more are waiting), samples of the lookback window are summarized again and counted again here
+
+    mode = validateHistoryStorageMode(mode)
+    batchSize = variables.rollupBatchSize if batchSize is None else batchSize
+    settleDelay = variables.rollupSettleDelay if settleDelay is None else settleDelay
+    lookback = variables.rollupLookback if lookback is None else lookback
+
+    if mode == "hourBuckets":
+
+        return rollupHourBuckets(gatewayDb, batchSize)
+
+    return rollupRadioDocuments(gatewayDb, mode, batchSize, settleDelay, lookback)
+
+def readRollups(gatewayDb, xbeeMacAddress, tier, startTime, endTime):
+
+    # Summaries of one radio and tier from startTime to endTime (excluded), oldest first
+    # Each is {"bucketStart", "count", "channels": [{"min", "max", "avg", "count"} or None per channel index]}
+
+    if tier not in rollupTiers:
+
+        raise ValueError(f"Invalid rollup tier {tier}. Allowed tiers: {rollupTiers}")
+
+    summaries = []
+    cursor = rollupCollection(gatewayDb, tier).find({"xbeeMac": xbeeMacAddress, "bucketStart": {"$gte": tierStart(tier, startTime), "$lt": endTime}}, {"_id": 0, "bucketStart": 1, "count": 1, "channels": 1})
+
+    for summary in cursor.sort("bucketStart", pymongo.ASCENDING):
+
+        storedChannels = {int(index): channel for index, channel in summary.get("channels", {}).items()}
+        channels = [None] * (max(storedChannels) + 1 if storedChannels else 0)
+
+        for index, channel in storedChannels.items():
+
+            channels[index] = {"min": channel["min"], "max": channel["max"], "avg": channel["sum"] / channel["count"], "count": channel["count"]}
+
+        summaries.append({"bucketStart": summary["bucketStart"], "count": summary["count"], "channels": channels})
+
+    return summaries
+
+def renameRollups(gatewayDb, oldXbeeMacAddress, newXbeeMacAddress):
+
+    # Rollups and watermarks follow a radio's history when its mac address changes
+
+    for tier in rollupTiers:
+
+        rollupCollection(gatewayDb, tier).update_many({"xbeeMac": oldXbeeMacAddress}, {"$set": {"xbeeMac": newXbeeMacAddress}})
+
+    watermarks = gatewayDb[watermarkCollectionName]
+
+    for watermark in list(watermarks.find({"_id": {"$regex": f":{oldXbeeMacAddress}$"}})):
+
+        mode = watermark["_id"].split(":", 1)[0]
+
+        watermarks.replace_one({"_id": f"{mode}:{newXbeeMacAddress}"}, {key: value for key, value in watermark.items() if key != "_id"}, upsert=True)
+        watermarks.delete_one({"_id": watermark["_id"]})
+
+def swapRollups(gatewayDb, firstXbeeMacAddress, secondXbeeMacAddress):
+
+    temporaryName = f"{firstXbeeMacAddress}-swap"
+
+    renameRollups(gatewayDb, firstXbeeMacAddress, temporaryName)
+    renameRollups(gatewayDb, secondXbeeMacAddress, firstXbeeMacAddress)
+    renameRollups(gatewayDb, temporaryName, secondXbeeMacAddress)
+
+def dropRollups(gatewayDb, xbeeMacAddress):
+
+    for tier in rollupTiers:
+
+        rollupCollection(gatewayDb, tier).delete_many({"xbeeMac": xbeeMacAddress})
+
+    gatewayDb[watermarkCollectionName].delete_many({"_id": {"$regex": f":{xbeeMacAddress}$"}})
+
+class RollupEngine:
+
+    # Runs rollup passes off the event loop, every rollupInterval seconds or right away while a backlog is waiting
+
+    def __init__(self, rollupFunction, interval=None):
+
+        self.rollupFunction = rollupFunction # Blocking callable running one pass, e.g. rollupHistory
+        self.interval = variables.rollupInterval if interval is None else interval
+
+        self.passes = 0
+        self.failedPasses = 0
+        self.rolledSamples = 0
+        self.lastPassLatency = None
+        self.lastPassAt = None
+        self.lastError = None
+
+    async def run(self):
+
+        while True:
+
+            startTime = time.perf_counter()
+
+            try:
+
+                result = await asyncio.to_thread(self.rollupFunction)
+
+            except Exception as e:
+
+                result = {"error": str(e)}
+
+            self.lastPassLatency = time.perf_counter() - startTime
+            self.passes += 1
+
+            if "error" in result:
+
+                self.failedPasses += 1
+                self.lastError = result["error"]
+
+                logger.warning("History rollup pass failed, retrying in %ss. Details: %s", self.interval, self.lastError)
+
+                await asyncio.sleep(self.interval)
+
+                continue
+
+            self.rolledSamples += result["samples"]
+            self.lastPassAt = time.time()
+
+            if not result.get("more"):
+
+                await asyncio.sleep(self.interval)
+
+    def stats(self):
+
+        return {
+
+            "passes": self.passes,
+            "failedPasses": self.failedPasses,
+            "rolledSamples": self.rolledSamples,
+            "lastPassLatency": self.lastPassLatency,
+            "lastPassAt": self.lastPassAt
+
+        }
@@ -0,0 +1,247 @@
+import json, time, sqlite3, asyncio, logging, datetime, threading
+from bson import ObjectId
+from . import variables
+
+logger = logging.getLogger(__name__)
+
+# Write ahead spool for history documents, a sqlite database in WAL mode under the working directory
+# The history writer appends its batches here, which only needs the local disk, and a background drainer moves them
+# to mongodb in bulk whenever it is reachable, so samples received while mongodb is down or slow are kept
+# Delivery to mongodb is at least once: a batch that failed half way is retried as a whole
+# Every document gets a stable documentId when it is spooled, in hourBuckets mode it is handed to mongodb as the
+# sample's _id so a retried drain does not push samples already in their bucket again
+# The other modes let mongodb assign the _id at insert time, their rollup watermarks follow _id order and a document
+# drained after a long outage would carry an _id older than the watermark
+
+spoolEvictionPolicies = ("dropOldest", "dropNewest")
+
+class HistorySpool:
+
+    def __init__(self, path=None, maxDocuments=None, evictionPolicy=None):
+
+        self.path = variables.historySpoolPath if path is None else path
+        self.maxDocuments = variables.historySpoolMaxDocuments if maxDocuments is None else maxDocuments
+        self.evictionPolicy = variables.historySpoolEvictionPolicy if evictionPolicy is None else evictionPolicy
+
+        if self.evictionPolicy not in spoolEvictionPolicies:
+
+            raise ValueError(f"Invalid spool eviction policy {self.evictionPolicy}. Allowed policies: {spoolEvictionPolicies}")
+
+        self.spooledDocuments = 0
+        self.evictedDocuments = 0
+
+        # Appends come from the history writer thread and reads from the drainer thread, one connection serialised by a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL") # Survives a gateway crash, the last commits may be lost on power loss
+        self._connection.execute("CREATE TABLE IF NOT EXISTS historySpool (id INTEGER PRIMARY KEY AUTOINCREMENT, xbeeMac TEXT NOT NULL, timestamp REAL NOT NULL, data TEXT NOT NULL, documentId TEXT)")
+
+        if "documentId" not in [column[1] for column in self._connection.execute("PRAGMA table_info(historySpool)")]:
+
+            # Spool of an older gateway, its documents get random ids (12 bytes, the size of an ObjectId)
+
+            self._connection.execute("ALTER TABLE historySpool ADD COLUMN documentId TEXT")
+            self._connection.execute("UPDATE historySpool SET documentId = lower(hex(randomblob(12)))")
+
+        self._depth = self._connection.execute("SELECT COUNT(*) FROM historySpool").fetchone()[0]
+
+        if self._depth:
+
+            logger.info("History spool %s holds %d documents from a previous run", self.path, self._depth)
+
+    def depth(self):
+
+        return self._depth
+
+    def append(self, historyBatch):
+
+        # Flush function of the history writer, takes a list of (mac address, {"timestamp": ..., "data": [...]})
+
+        rows = [(xbeeMacAddress, document["timestamp"].timestamp(), json.dumps(document["data"]), str(ObjectId())) for xbeeMacAddress, document in historyBatch]
+
+        try:
+
+            with self._lock:
+
+                overflow = self._depth + len(rows) - self.maxDocuments
+
+                if overflow > 0 and self.evictionPolicy == "dropNewest":
+
+                    self.evictedDocuments += min(overflow, len(rows))
+                    rows = rows[:max(0, len(rows) - overflow)]
+                    overflow = 0
+
+                self._connection.execute("BEGIN")
+
+                if overflow > 0:
+
+                    self._connection.execute("DELETE FROM historySpool WHERE id IN (SELECT id FROM historySpool ORDER BY id LIMIT ?)", (overflow,))
+                    self.evictedDocuments += overflow
+                    self._depth -= overflow
+
+                self._connection.executemany("INSERT INTO historySpool (xbeeMac, timestamp, data, documentId) VALUES (?, ?, ?, ?)", rows)
+                self._connection.execute("COMMIT")
+
+                self._depth += len(rows)
+                self.spooledDocuments += len(rows)
+
+        except sqlite3.Error as e:
+
+            if self._connection.in_transaction:
+
+                self._connection.execute("ROLLBACK")
+
+            return {"error": str(e), "inserted": 0, "failed": historyBatch}
+
+        return {"success": f"spooled {len(rows)} history documents", "inserted": len(historyBatch)}
+
+    def peek(self, limit, withIds=False):
+
+        # Oldest spooled documents as (spool id, mac address, document), withIds adds the documentId as the document's _id
+
+        with self._lock:
+
+            rows = self._connection.execute("SELECT id, xbeeMac, timestamp, data, documentId FROM historySpool ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+        return [(spoolId, xbeeMacAddress, {**({"_id": ObjectId(documentId)} if withIds else {}), "timestamp": datetime.datetime.fromtimestamp(timestamp), "data": json.loads(data)}) for spoolId, xbeeMacAddress, timestamp, data, documentId in rows]
+
+    def remove(self, spoolIds):
+
+        if not spoolIds:
+
+            return
+
+        with self._lock:
+
+            # Ids evicted meanwhile are simply not found, rowcount only counts the rows really deleted
+
+            self._connection.execute("BEGIN")
+            removed = self._connection.executemany("DELETE FROM historySpool WHERE id = ?", ((spoolId,) for spoolId in spoolIds)).rowcount
+            self._connection.execute("COMMIT")
+            self._depth -= removed
+
+    def close(self):
+
+        with self._lock:
+
+            self._connection.close()
+
+    def stats(self):
+
+        return {
+
+            "depth": self._depth,
+            "maxDocuments": self.maxDocuments,
+            "spooled": self.spooledDocuments,
+            "evicted": self.evictedDocuments
+
+        }
+
+class SpoolDrainer:
+
+    # Moves spooled documents to mongodb in batches, backing off while mongodb fails
+
+    def __init__(self, spool, flushFunction, batchSize=None, idleInterval=None, maxRetryInterval=None):
+
+        self.spool = spool
+        self.flushFunction = flushFunction # Blocking callable taking a list of (mac, document), e.g. storeXbeeHistoryBatch
+        self.batchSize = variables.historyBatchSize if batchSize is None else batchSize
+        self.idleInterval = variables.historySpoolDrainInterval if idleInterval is None else idleInterval
+        self.maxRetryInterval = variables.historySpoolMaxRetryInterval if maxRetryInterval is None else maxRetryInterval
+
+        self.drainedDocuments = 0
+        self.failedDrains = 0
+        self.drainRate = 0.0 # Documents moved to mongodb per second over the last second
+        self.lastDrainLatency = None
+        self.lastError = None
+
+    async def drain(self):
+
+        # One batch from the spool to mongodb, returns (documents drained, whether the whole batch succeeded)
+
+        spooled = await asyncio.to_thread(self.spool.peek, self.batchSize, variables.historyStorageMode == "hourBuckets")
+
+        if not spooled:
+
+            return 0, True
+
+        batch = [(xbeeMacAddress, document) for spoolId, xbeeMacAddress, document in spooled]
+        startTime = time.perf_counter()
+
+        try:
+
+            result = await asyncio.to_thread(self.flushFunction, batch)
+
+        except Exception as e:
+
+            result = {"error": str(e), "failed": batch}
+
+        self.lastDrainLatency = time.perf_counter() - startTime
+
+        # storeXbeeHistoryBatch hands back the failed documents themselves, everything else reached mongodb
+
+        failed = result.get("failed", []) if isinstance(result, dict) else []
+        failedDocuments = {id(document) for xbeeMacAddress, document in failed}
+        drainedIds = [spoolId for spoolId, xbeeMacAddress, document in spooled if id(document) not in failedDocuments]
+
+        await asyncio.to_thread(self.spool.remove, drainedIds)
+
+        self.drainedDocuments += len(drainedIds)
+
+        if failed:
+
+            self.failedDrains += 1
+            self.lastError = result.get("error")
+
+        return len(drainedIds), not failed
+
+    async def run(self):
+
+        retryInterval = self.idleInterval
+        lastCount = self.drainedDocuments
+        lastTime = time.monotonic()
+
+        while True:
+
+            drained, succeeded = await self.drain()
+
+            now = time.monotonic()
+
+            if now - lastTime >= 1:
+
+                self.drainRate = (self.drainedDocuments - lastCount) / (now - lastTime)
+                lastCount, lastTime = self.drainedDocuments, now
+
+            if not succeeded:
+
+                logger.warning("History spool drain failed, %d documents waiting, retrying in %ss. Details: %s", self.spool.depth(), retryInterval, self.lastError)
+
+                await asyncio.sleep(retryInterval)
+
+                retryInterval = min(retryInterval * 2, self.maxRetryInterval)
+
+                continue
+
+            retryInterval = self.idleInterval
+
+            if drained < self.batchSize:
+
+                # Spool emptied, wait for the history writer to add more
+
+                await asyncio.sleep(self.idleInterval)
+
+                if not self.spool.depth():
+
+                    self.drainRate = 0.0
+
+    def stats(self):
+
+        return {
+
+            "drained": self.drainedDocuments,
+            "failedDrains": self.failedDrains,
+            "drainRate": self.drainRate,
+            "lastDrainLatency": self.lastDrainLatency
+
+        }
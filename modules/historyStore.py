@@ -0,0 +1,301 @@
+import logging
+import pymongo
+from pymongo.errors import PyMongoError, BulkWriteError, CollectionInvalid
+from . import variables
+
+logger = logging.getLogger(__name__)
+
+# History storage layouts, picked with historyStorageMode
+#   perRadio     one collection per mac address with one {"timestamp", "data"} document per frame (the original layout)
+#   timeSeries   one mongodb time series collection (MongoDB 5.0+), documents carry the mac address as metaField and the
+#                server groups them into compressed buckets per radio
+#   hourBuckets  one document per radio and hour in one collection: {"xbeeMac", "bucketStart", "count", "first",
+#                "last", "samples": [{"timestamp", "data"}]}, a frame is a $push into its radio's bucket
+# In both single collection modes a whole history batch is one insert_many or one bulk_write instead of one call per
+# radio, and a radio's time range is read from a handful of buckets through the (xbeeMac, time) index
+
+historyStorageModes = ("perRadio", "timeSeries", "hourBuckets")
+
+def historyCollection(gatewayDb):
+
+    return gatewayDb[variables.historyCollectionName]
+
+def bucketStart(timestamp):
+
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def validateHistoryStorageMode(mode=None):
+
+    mode = variables.historyStorageMode if mode is None else mode
+
+    if mode not in historyStorageModes:
+
+        raise ValueError(f"Invalid history storage mode {mode}. Allowed modes: {historyStorageModes}")
+
+    return mode
+
+def ensureHistoryStorage(gatewayDb, mode=None):
+
+    # Creates the collection and indexes of the single collection modes, safe to call on every start
+
+    mode = validateHistoryStorageMode(mode)
+
+    if mode == "timeSeries":
+
+        try:
+
+            gatewayDb.create_collection(variables.historyCollectionName, timeseries={"timeField": "timestamp", "metaField": "xbeeMac", "granularity": variables.historyTimeSeriesGranularity})
+
+        except CollectionInvalid:
+
+            pass # Already there
+
+        historyCollection(gatewayDb).create_index([("xbeeMac", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)], name="xbeeMacTimestamp")
+
+    elif mode == "hourBuckets":
+
+        historyCollection(gatewayDb).create_index([("xbeeMac", pymongo.ASCENDING), ("bucketStart", pymongo.ASCENDING)], name="xbeeMacBucketStart", unique=True)
+        historyCollection(gatewayDb).create_index([("rollupPending", pymongo.ASCENDING)], name="rollupPending", partialFilterExpression={"rollupPending": True})
+
+def storedTimeSeriesIds(gatewayDb, historyBatch):
+
+    # _id of the batch's documents already in the time series collection, looked up per radio through the
+    # (xbeeMac, timestamp) index since a time series collection has no _id index
+
+    documentsPerRadio = {}
+
+    for xbeeMacAddress, document in historyBatch:
+
+        if "_id" in document:
+
+            documentsPerRadio.setdefault(xbeeMacAddress, []).append(document)
+
+    storedIds = set()
+
+    for xbeeMacAddress, documents in documentsPerRadio.items():
+
+        timeRange = {"$gte": min(document["timestamp"] for document in documents), "$lte": max(document["timestamp"] for document in documents)}
+        storedIds.update(stored["_id"] for stored in historyCollection(gatewayDb).find({"xbeeMac": xbeeMacAddress, "timestamp": timeRange, "_id": {"$in": [document["_id"] for document in documents]}}, {"_id": 1}))
+
+    return storedIds
+
+def storedBucketSampleIds(gatewayDb, entriesPerBucket):
+
+    # _id of the batch's samples already in their hour bucket, one query over the batch's buckets
+
+    sampleIds = [document["_id"] for entries in entriesPerBucket.values() for xbeeMacAddress, document in entries if "_id" in document]
+
+    if not sampleIds:
+
+        return set()
+
+    bucketFilters = [{"xbeeMac": xbeeMacAddress, "bucketStart": hourStart} for xbeeMacAddress, hourStart in entriesPerBucket]
+    storedIds = set()
+
+    for bucket in historyCollection(gatewayDb).find({"$or": bucketFilters, "samples._id": {"$in": sampleIds}}, {"samples._id": 1}):
+
+        storedIds.update(sample.get("_id") for sample in bucket["samples"])
+
+    return storedIds.intersection(sampleIds)
+
+def storeHistoryBatch(gatewayDb, historyBatch, mode=None, rolledUp=False):
+
+    # historyBatch is a list of (mac address, {"timestamp": ..., "data": [...]})
+    # Returns (inserted count, failed entries, last error), failed entries are handed back to the caller for retry
+    # rolledUp leaves hour buckets unflagged for samples the rollup engine already summarized (history migration), a
+    # document's _id is kept in the time series collection so the rollup watermarks of migrated radios stay valid
+    # Documents carrying an _id (history migration, the spool in hourBuckets mode) are stored once however often their
+    # batch is retried: the time series collection does not enforce unique _id so stored ones are looked up and left
+    # out, a bucket's samples keep their _id, samples already in their bucket are looked up and left out and the push
+    # of a group whose first sample got there meanwhile is skipped
+
+    mode = validateHistoryStorageMode(mode)
+
+    if not historyBatch:
+
+        return 0, [], None
+
+    if mode == "perRadio":
+
+        documentsPerRadio = {}
+
+        for xbeeMacAddress, document in historyBatch:
+
+            documentsPerRadio.setdefault(xbeeMacAddress, []).append(document)
+
+        insertedCount = 0
+        failed = []
+        lastError = None
+
+        for xbeeMacAddress, documents in documentsPerRadio.items():
+
+            try:
+
+                # insert_many adds an _id to each document, copy so a retried entry is not rejected as a duplicate
+
+                historian = gatewayDb[xbeeMacAddress].insert_many([dict(document) for document in documents], ordered=False)
+                insertedCount += len(historian.inserted_ids)
+
+            except BulkWriteError as e:
+
+                # An unordered insert_many stores every document it can, only the ones it reports are retried
+
+                failedIndexes = {writeError["index"] for writeError in e.details.get("writeErrors", [])}
+                insertedCount += e.details.get("nInserted", 0)
+                lastError = str(e)
+                failed.extend((xbeeMacAddress, document) for index, document in enumerate(documents) if index in failedIndexes)
+
+            except PyMongoError as e:
+
+                lastError = str(e)
+                failed.extend((xbeeMacAddress, document) for document in documents)
+
+        return insertedCount, failed, lastError
+
+    if mode == "timeSeries":
+
+        try:
+
+            storedIds = storedTimeSeriesIds(gatewayDb, historyBatch)
+            newEntries = [(xbeeMacAddress, document) for xbeeMacAddress, document in historyBatch if document.get("_id") not in storedIds]
+
+            if not newEntries:
+
+                return len(historyBatch), [], None
+
+            historian = historyCollection(gatewayDb).insert_many([{**({"_id": document["_id"]} if "_id" in document else {}), "timestamp": document["timestamp"], "xbeeMac": xbeeMacAddress, "data": document["data"]} for xbeeMacAddress, document in newEntries], ordered=False)
+
+            return len(historian.inserted_ids) + len(historyBatch) - len(newEntries), [], None
+
+        except BulkWriteError as e:
+
+            failedIndexes = {writeError["index"] for writeError in e.details.get("writeErrors", [])}
+
+            return e.details.get("nInserted", 0) + len(historyBatch) - len(newEntries), [entry for index, entry in enumerate(newEntries) if index in failedIndexes], str(e)
+
+        except PyMongoError as e:
+
+            return 0, list(historyBatch), str(e)
+
+    # hourBuckets: one upsert per radio and hour pushing all of the batch's samples of that hour
+    # New samples flag their bucket for the rollup engine, which recomputes the minutes of flagged buckets
+
+    entriesPerBucket = {}
+
+    for entry in historyBatch:
+
+        xbeeMacAddress, document = entry
+        entriesPerBucket.setdefault((xbeeMacAddress, bucketStart(document["timestamp"])), []).append(entry)
+
+    try:
+
+        storedIds = storedBucketSampleIds(gatewayDb, entriesPerBucket)
+
+    except PyMongoError as e:
+
+        return 0, list(historyBatch), str(e)
+
+    if storedIds:
+
+        entriesPerBucket = {bucket: [entry for entry in entries if entry[1].get("_id") not in storedIds] for bucket, entries in entriesPerBucket.items()}
+
+    buckets = [(bucket, entries) for bucket, entries in entriesPerBucket.items() if entries]
+
+    if not buckets:
+
+        return len(historyBatch), [], None
+
+    updateOperation = [pymongo.UpdateOne(
+
+        # A group's samples are pushed in one update, when its first sample is in the bucket the whole group is: the
+        # filter then matches nothing and the upsert fails on the unique (xbeeMac, bucketStart) index
+
+        {"xbeeMac": xbeeMacAddress, "bucketStart": hourStart, **({"samples._id": {"$ne": entries[0][1]["_id"]}} if "_id" in entries[0][1] else {})},
+        {
+            "$push": {"samples": {"$each": [{**({"_id": document["_id"]} if "_id" in document else {}), "timestamp": document["timestamp"], "data": document["data"]} for mac, document in entries]}},
+            "$inc": {"count": len(entries)},
+            "$min": {"first": min(document["timestamp"] for mac, document in entries)},
+            "$max": {"last": max(document["timestamp"] for mac, document in entries)},
+            **({} if rolledUp else {"$set": {"rollupPending": True}})
+        },
+        upsert=True
+
+    ) for (xbeeMacAddress, hourStart), entries in buckets]
+
+    try:
+
+        historyCollection(gatewayDb).bulk_write(updateOperation, ordered=False)
+
+        return len(historyBatch), [], None
+
+    except BulkWriteError as e:
+
+        # Duplicate key errors of guarded groups are groups already stored
+
+        failedIndexes = {writeError["index"] for writeError in e.details.get("writeErrors", []) if not (writeError.get("code") == 11000 and "_id" in buckets[writeError["index"]][1][0][1])}
+        failed = [entry for index, (bucket, entries) in enumerate(buckets) if index in failedIndexes for entry in entries]
+
+        return len(historyBatch) - len(failed), failed, str(e)
+
+    except PyMongoError as e:
+
+        return 0, list(historyBatch), str(e)
+
+def readHistory(gatewayDb, xbeeMacAddress, startTime, endTime, mode=None):
+
+    # {"timestamp", "data"} documents of one radio from startTime (included) to endTime (excluded), oldest first
+
+    mode = validateHistoryStorageMode(mode)
+    timeRange = {"$gte": startTime, "$lt": endTime}
+
+    if mode == "perRadio":
+
+        return list(gatewayDb[xbeeMacAddress].find({"timestamp": timeRange}, {"_id": 0}).sort("timestamp", pymongo.ASCENDING))
+
+    if mode == "timeSeries":
+
+        return list(historyCollection(gatewayDb).find({"xbeeMac": xbeeMacAddress, "timestamp": timeRange}, {"_id": 0, "xbeeMac": 0}).sort("timestamp", pymongo.ASCENDING))
+
+    # Buckets whose hour overlaps the range, the bucket of the hour startTime falls in included
+
+    buckets = historyCollection(gatewayDb).find({"xbeeMac": xbeeMacAddress, "bucketStart": {"$gte": bucketStart(startTime), "$lt": endTime}}, {"_id": 0, "samples": 1})
+    samples = [{"timestamp": sample["timestamp"], "data": sample["data"]} for bucket in buckets for sample in bucket["samples"] if startTime <= sample["timestamp"] < endTime]
+    samples.sort(key=lambda sample: sample["timestamp"])
+
+    return samples
+
+def renameHistory(gatewayDb, oldXbeeMacAddress, newXbeeMacAddress, mode=None):
+
+    mode = validateHistoryStorageMode(mode)
+
+    if mode == "perRadio":
+
+        if oldXbeeMacAddress in gatewayDb.list_collection_names(filter={"name": oldXbeeMacAddress}):
+
+            gatewayDb[oldXbeeMacAddress].rename(newXbeeMacAddress)
+
+        return
+
+    historyCollection(gatewayDb).update_many({"xbeeMac": oldXbeeMacAddress}, {"$set": {"xbeeMac": newXbeeMacAddress}})
+
+def swapHistory(gatewayDb, firstXbeeMacAddress, secondXbeeMacAddress, mode=None):
+
+    # Through a temporary name, the two histories are never merged
+
+    temporaryName = f"{firstXbeeMacAddress}-swap"
+
+    renameHistory(gatewayDb, firstXbeeMacAddress, temporaryName, mode)
+    renameHistory(gatewayDb, secondXbeeMacAddress, firstXbeeMacAddress, mode)
+    renameHistory(gatewayDb, temporaryName, secondXbeeMacAddress, mode)
+
+def dropHistory(gatewayDb, xbeeMacAddress, mode=None):
+
+    mode = validateHistoryStorageMode(mode)
+
+    if mode == "perRadio":
+
+        gatewayDb[xbeeMacAddress].drop()
+
+    else:
+
+        historyCollection(gatewayDb).delete_many({"xbeeMac": xbeeMacAddress})
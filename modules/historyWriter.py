@@ -0,0 +1,158 @@
+import asyncio, logging, time
+from . import variables
+from collections import deque
+from .metrics import gatewayMetrics
+
+logger = logging.getLogger(__name__)
+
+# Background stage that batches history documents and writes them to mongodb off the event loop
+# A batch is flushed once historyBatchSize documents are waiting or the oldest one is historyFlushInterval seconds old
+
+class HistoryWriter:
+
+    def __init__(self, flushFunction, batchSize=None, flushInterval=None, maxBacklog=None):
+
+        self.flushFunction = flushFunction # Blocking callable taking a list of (mac, document), run in a worker thread
+        self.batchSize = variables.historyBatchSize if batchSize is None else batchSize
+        self.flushInterval = variables.historyFlushInterval if flushInterval is None else flushInterval
+        self.maxBacklog = variables.historyMaxBacklog if maxBacklog is None else maxBacklog
+
+        self.flushCount = 0
+        self.failedFlushes = 0
+        self.writtenDocuments = 0
+        self.droppedDocuments = 0
+        self.lastFlushLatency = None
+        self.lastBatchSize = 0
+
+        self._pending = deque()
+        self._oldestPending = None
+        self._batchReady = asyncio.Event()
+
+    def submit(self, xbeeMacAddress, xbeeData, xbeeDataTimestamp):
+
+        if len(self._pending) >= self.maxBacklog:
+
+            # Keep memory bounded while mongodb is unreachable, newest samples are the most useful
+
+            self._pending.popleft()
+            self.droppedDocuments += 1
+
+        if not self._pending:
+
+            self._oldestPending = time.monotonic()
+
+        self._pending.append((str(xbeeMacAddress).upper(), {"timestamp": xbeeDataTimestamp, "data": xbeeData}))
+
+        if len(self._pending) >= self.batchSize:
+
+            self._batchReady.set()
+
+    def backlog(self):
+
+        return len(self._pending)
+
+    async def run(self):
+
+        try:
+
+            while True:
+
+                try:
+
+                    await asyncio.wait_for(self._batchReady.wait(), timeout=self.flushInterval)
+
+                except asyncio.TimeoutError:
+
+                    pass
+
+                self._batchReady.clear()
+
+                if self._pending and (len(self._pending) >= self.batchSize or time.monotonic() - self._oldestPending >= self.flushInterval):
+
+                    writtenDocuments = await self.flush()
+
+                    # Keep draining without waiting while a full batch is queued, but back off after a failed flush
+
+                    if writtenDocuments and len(self._pending) >= self.batchSize:
+
+                        self._batchReady.set()
+
+        except asyncio.CancelledError:
+
+            # Best effort to persist whatever is still waiting before shutdown
+
+            if self._pending:
+
+                await self.flush()
+
+            raise
+
+    async def flush(self):
+
+        batch = []
+
+        while self._pending and len(batch) < self.batchSize:
+
+            batch.append(self._pending.popleft())
+
+        self._oldestPending = time.monotonic() if self._pending else None
+
+        if not batch:
+
+            return 0
+
+        startTime = time.perf_counter()
+
+        try:
+
+            result = await asyncio.to_thread(self.flushFunction, batch)
+
+        except Exception as e:
+
+            result = {"error": str(e), "failed": batch}
+
+        self.lastFlushLatency = time.perf_counter() - startTime
+        gatewayMetrics.historyFlushSeconds.observe(self.lastFlushLatency)
+        self.lastBatchSize = len(batch)
+        self.flushCount += 1
+
+        failed = result.get("failed", []) if isinstance(result, dict) else []
+        writtenDocuments = len(batch) - len(failed)
+        self.writtenDocuments += writtenDocuments
+
+        if failed:
+
+            self.failedFlushes += 1
+
+            logger.warning("History flush failed for %d of %d documents, will retry. Details: %s", len(failed), len(batch), result.get("error"))
+
+            # Put failed documents back in front so they are retried in their original order
+
+            spaceLeft = self.maxBacklog - len(self._pending)
+
+            if len(failed) > spaceLeft:
+
+                self.droppedDocuments += len(failed) - max(spaceLeft, 0)
+                failed = failed[len(failed) - max(spaceLeft, 0):]
+
+            self._pending.extendleft(reversed(failed))
+
+            if self._oldestPending is None and self._pending:
+
+                self._oldestPending = time.monotonic()
+
+        return writtenDocuments
+
+    def stats(self):
+
+        return {
+
+            "backlog": len(self._pending),
+            "flushCount": self.flushCount,
+            "failedFlushes": self.failedFlushes,
+            "writtenDocuments": self.writtenDocuments,
+            "droppedDocuments": self.droppedDocuments,
+            "lastBatchSize": self.lastBatchSize,
+            "lastFlushLatency": self.lastFlushLatency
+
+        }
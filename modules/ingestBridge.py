@@ -0,0 +1,237 @@
+import asyncio, logging, threading
+from . import variables
+from collections import deque
+from datetime import datetime
+from .metrics import gatewayMetrics
+
+# Bridge between the digi-xbee reader thread and the asyncio processing loop
+# Frames are handed over under a lock and the loop is woken with call_soon_threadsafe,
+# so a packet never waits for an unrelated loop wakeup and the buffer can never grow past its capacity
+
+logger = logging.getLogger(__name__)
+
+# Mirror of variables.knownXbeeAddress shared by every coordinator, keeps the per frame membership check constant time
+knownXbeeAddresses = set()
+
+overflowPolicies = ("dropOldest", "dropNewest", "coalesce")
+
+class IngestBridge:
+
+    def __init__(self, capacity=None, overflowPolicy=None):
+
+        capacity = variables.ingestQueueCapacity if capacity is None else capacity
+        overflowPolicy = variables.ingestOverflowPolicy if overflowPolicy is None else overflowPolicy
+
+        if overflowPolicy not in overflowPolicies:
+
+            raise ValueError(f"Invalid overflow policy {overflowPolicy}. Allowed policies: {overflowPolicies}")
+
+        if type(capacity) is not int or capacity < 1:
+
+            raise ValueError(f"Ingest capacity should be a positive integer, got {capacity}")
+
+        self.capacity = capacity
+        self.overflowPolicy = overflowPolicy
+        self.loop = None
+
+        self.receivedFrames = 0
+        self.droppedFrames = 0
+        self.coalescedFrames = 0
+
+        self._frames = deque()
+        self._pendingByMac = {} # Only used by the coalesce policy, maps mac address to its queued frame
+        self._waiters = deque()
+        self._wakeScheduled = False
+        self._lock = threading.Lock()
+
+    def bindLoop(self, loop=None):
+
+        # Must be called from the event loop that consumes the frames
+
+        self.loop = loop or asyncio.get_running_loop()
+
+    def put(self, xbeeMacAddress, xbeeDataAsByte, coordinator=None, receivedAt=None):
+
+        # Safe to call from any thread, returns False when the frame was dropped
+        # coordinator is the name of the radio the frame was received through, receivedAt its radio timestamp
+
+        with self._lock:
+
+            self.receivedFrames += 1
+
+            if self.overflowPolicy == "coalesce":
+
+                pendingFrame = self._pendingByMac.get(xbeeMacAddress)
+
+                if pendingFrame is not None:
+
+                    # Radio already has a frame waiting, keep only the newest payload in its queue position
+
+                    pendingFrame[1] = xbeeDataAsByte
+                    pendingFrame[2] = coordinator
+                    pendingFrame[3] = receivedAt
+                    self.coalescedFrames += 1
+
+                    return True
+
+            if len(self._frames) >= self.capacity:
+
+                self.droppedFrames += 1
+
+                if self.overflowPolicy == "dropNewest":
+
+                    return False
+
+                oldestFrame = self._frames.popleft()
+
+                if self._pendingByMac.get(oldestFrame[0]) is oldestFrame:
+
+                    del self._pendingByMac[oldestFrame[0]]
+
+            frame = [xbeeMacAddress, xbeeDataAsByte, coordinator, receivedAt]
+            self._frames.append(frame)
+
+            if self.overflowPolicy == "coalesce":
+
+                self._pendingByMac[xbeeMacAddress] = frame
+
+            wakeNeeded = bool(self._waiters) and not self._wakeScheduled and self.loop is not None
+
+            if wakeNeeded:
+
+                self._wakeScheduled = True
+
+        if wakeNeeded:
+
+            try:
+
+                self.loop.call_soon_threadsafe(self._wakeConsumers)
+
+            except RuntimeError:
+
+                # Loop already closed, nothing left to wake
+                pass
+
+        return True
+
+    def _wakeConsumers(self):
+
+        with self._lock:
+
+            self._wakeScheduled = False
+            waiters = list(self._waiters)
+            self._waiters.clear()
+
+        for waiter in waiters:
+
+            if not waiter.done():
+
+                waiter.set_result(None)
+
+    def getNowait(self):
+
+        with self._lock:
+
+            if not self._frames:
+
+                return None
+
+            return self._popFrame()
+
+    def _popFrame(self):
+
+        # Caller must hold the lock
+
+        frame = self._frames.popleft()
+
+        if self._pendingByMac.get(frame[0]) is frame:
+
+            del self._pendingByMac[frame[0]]
+
+        return frame[0], frame[1], frame[2], frame[3]
+
+    async def get(self):
+
+        if self.loop is None:
+
+            self.bindLoop()
+
+        while True:
+
+            with self._lock:
+
+                if self._frames:
+
+                    return self._popFrame()
+
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+
+            try:
+
+                await waiter
+
+            except asyncio.CancelledError:
+
+                with self._lock:
+
+                    if waiter in self._waiters:
+
+                        self._waiters.remove(waiter)
+
+                raise
+
+    def qsize(self):
+
+        return len(self._frames)
+
+    def stats(self):
+
+        with self._lock:
+
+            return {
+
+                "capacity": self.capacity,
+                "overflowPolicy": self.overflowPolicy,
+                "depth": len(self._frames),
+                "received": self.receivedFrames,
+                "dropped": self.droppedFrames,
+                "coalesced": self.coalescedFrames
+
+            }
+
+def makeDataReceiveCallback(ingestBridge, coordinator=None):
+
+    # Builds the digi-xbee data received callback, it runs on the xbee reader thread
+    # Frames are tagged with the coordinator they came through and counted on it
+
+    def dataReceiveCallback(xbeeMessage):
+
+        xbeeMacAddress = str(xbeeMessage.remote_device.get_64bit_addr())
+        xbeeDataAsByte = xbeeMessage.data
+        gatewayMetrics.recordPacket(xbeeMacAddress)
+
+        if variables.frameCapture is not None:
+
+            variables.frameCapture.capture(None if coordinator is None else coordinator.name, xbeeMacAddress, xbeeMessage.timestamp, xbeeDataAsByte)
+
+        if xbeeMacAddress not in knownXbeeAddresses:
+
+            knownXbeeAddresses.add(xbeeMacAddress)
+            variables.knownXbeeAddress.append(xbeeMacAddress)
+
+            logger.info("New XBee address discovered: %s (%d discovered so far)", xbeeMacAddress, len(knownXbeeAddresses))
+
+        if logger.isEnabledFor(logging.DEBUG):
+
+            logger.debug("Received data from %s @ %s are: %s", xbeeMacAddress, datetime.fromtimestamp(xbeeMessage.timestamp), xbeeDataAsByte)
+
+        if coordinator is not None:
+
+            coordinator.countFrame(xbeeDataAsByte)
+
+        if not ingestBridge.put(xbeeMacAddress, xbeeDataAsByte, None if coordinator is None else coordinator.name, xbeeMessage.timestamp):
+
+            logger.warning("Ingest queue full, dropped frame from %s", xbeeMacAddress, extra={"rateLimitKey": xbeeMacAddress})
+
+    return dataReceiveCallback
@@ -1,122 +1,159 @@
-import sys, asyncio
+import sys, time, asyncio, logging
 from functools import partial
 from modules import variables
-from datetime import datetime
-from digi.xbee.devices import XBeeDevice
-from modules.xbeeData import cayenneParse
-from digi.xbee.exception import XBeeException
-from pymodbus.server import StartAsyncTcpServer
+from modules.xbeeData import storeSensorValues
+from modules.changeDetector import changeDetector
+from modules.cayenneDecoder import flattenCayenneValues
+from modules.processingPool import ShardedProcessingStage
+from modules.ingestBridge import IngestBridge
+from modules.coordinator import Coordinator, coordinatorTargets
+from pymodbus.server import ModbusTcpServer
 from pymodbus.device import ModbusDeviceIdentification
-from modules.dbIntegration import dbQueryModbusStartAddress
-from modules.serialSelector import selectUsbPort, handleUsbDisconnection
-from modules.modbus import floatToRegisters, contextManager, getIpAddress
+from modules.routingCache import routingCache
+from modules.metrics import gatewayMetrics, metricsServer
+from modules.historyWriter import HistoryWriter
+from modules.historySpool import HistorySpool, SpoolDrainer
+from modules.frameCapture import FrameCaptureWriter
+from modules.summaryBlock import SummaryBlock
+from modules.downlink import DownlinkQueue
+from modules.historyRollup import RollupEngine
+from modules.dbIntegration import loadRoutingCache, dbQueryRadioRoute, storeXbeeHistoryBatch, assignModbusUnitIds, storeRegisterLayout, ensureDatabaseSchema, rollupHistory
+from modules.modbus import contextManager, getIpAddress
+
+logger = logging.getLogger(__name__)
+
+# Bounded, thread safe bridge to store incoming packets from every coordinator radio
+xbeeQueue = IngestBridge() # Stores recieved mac address and data temporarily for processing
+variables.coordinators = [Coordinator(target, xbeeQueue) for target in coordinatorTargets()]
+
+# Async wrapper for polling XBee data and placing into queue, each coordinator radio polls and reconnects on its own
+async def xbeePolling():
 
-# Async queue to store incoming packets
-xbeeQueue = asyncio.Queue() # Stores recieved mac address and data temporarily for processing
-serialPort = selectUsbPort()
-variables.xbeeInstance = XBeeDevice(serialPort, variables.xbeeBaudRate)
+    await asyncio.gather(*(coordinator.run() for coordinator in variables.coordinators))
 
+async def processFrame(registerImage, mac, raw_data, coordinator=None, receivedAt=None):
 
-if not serialPort:
+    # Resolve start address of the retrieved mac address from the in memory routing cache
+    # The database is only asked (off the event loop) once the negative cache entry of an unknown radio expires
 
-    print ("Gateway radio not connected")
+    stageStart = time.perf_counter()
+    route = routingCache.lookupRoute(mac)
 
-    sys.exit(1)
+    if route is None and routingCache.claimLookup(mac):
 
-# Async wrapper for polling XBee data and placing into queue
-async def xbeePolling():
+        route = await asyncio.to_thread(dbQueryRadioRoute, mac)
 
-    try:
+    gatewayMetrics.routingSeconds.observe(time.perf_counter() - stageStart)
 
-        variables.xbeeInstance.open()
-        variables.radioFlag = True
-        def dataReceiveCallback(xbeeMessage):
+    if route is None:
 
-            xbeeMacAddress = str(xbeeMessage.remote_device.get_64bit_addr())
-            timestamp = datetime.fromtimestamp(xbeeMessage.timestamp)
-            xbeeDataAsByte = xbeeMessage.data
+        logger.warning("Xbee radio with mac address %s, has not been configured", mac, extra={"rateLimitKey": mac})
 
-            if str(xbeeMacAddress) not in variables.knownXbeeAddress:
+        return
 
-                print (f"\nNew XBee Address Discovered: {xbeeMacAddress}")
+    if variables.summaryBlock is not None:
 
-                variables.knownXbeeAddress.append(str(xbeeMacAddress))
+        variables.summaryBlock.recordFrame(route["xbeeMac"])
 
-                print (f"List of addresses discovered so far are: {variables.knownXbeeAddress}\n")
+    if variables.downlink is not None:
 
-            print(f"Received data from {xbeeMacAddress} @ {timestamp} are: {xbeeDataAsByte}\n")
-            xbeeQueue.put_nowait((xbeeMacAddress, xbeeDataAsByte))
+        variables.downlink.recordCoordinator(route["xbeeMac"], coordinator) # Commands go back through the coordinator hearing the radio
 
-        variables.xbeeInstance.add_data_received_callback(dataReceiveCallback)
-        variables.xbeeInstance.add_error_callback(partial(handleUsbDisconnection, xbeeQueue=xbeeQueue, xbeeObject=variables.xbeeInstance))
+    startAddress = route["modbusStartAddress"]
 
-        while True:
-            # This is to make sure that the data is open and awaiting data
-            await asyncio.sleep(1) 
+    # Byte identical frame to the previous one, nothing to decode or write until the heartbeat is due
 
-    except Exception as e:
+    if changeDetector.isRepeatedPayload(mac, raw_data, route):
 
-        print (e)
+        return
 
-        pass
+    stageStart = time.perf_counter()
+    records = await variables.processingStage.decode(raw_data)
+    gatewayMetrics.decodeSeconds.observe(time.perf_counter() - stageStart)
 
-    finally:
+    if not changeDetector.hasSignificantChange(mac, records, route):
 
-        if variables.xbeeInstance is not None and variables.xbeeInstance.is_open():
+        return
 
-            variables.xbeeInstance.close()
+    sensorValues = flattenCayenneValues(records)
+    storeSensorValues(mac, sensorValues, receivedAt)
 
-async def modbusPolling(contextValue):
+    logger.debug("List of values extracted from %s byte array are: %s", mac, sensorValues)
 
-    while True:
+    # Convert the values to registers with the radio's precompiled encoder, as many as its block holds
+    channelLayout = route.get("channelLayout")
+
+    if channelLayout is None:
+
+        # Positional layout: the values in payload order, the whole block on every write
+
+        registerEncoder = route["registerEncoder"]
+        blockWrites = [(0, registerEncoder.encode(sensorValues))]
+        truncated = registerEncoder.truncated
+
+    else:
+
+        # Channel layout: every channel at its own registers, only the changed ranges are written
+
+        if channelLayout.update(records):
+
+            # New channels are stored in the background so the radio keeps its layout after a restart
+            asyncio.get_running_loop().run_in_executor(None, storeRegisterLayout, route["xbeeMac"], [list(entry) for entry in channelLayout.entries])
+
+        blockWrites = channelLayout.changedRanges()
+        truncated = channelLayout.truncated
+
+    if truncated:
+
+        logger.warning("Xbee radio with mac address %s sent %d values, only the first ones fitting its register block are written", mac, len(sensorValues), extra={"rateLimitKey": mac})
+
+    # Write to Holding (FC3) and Input (FC4) registers, a single slice copy per range when they share the register image
+    # In unitId mode the block starts at register 0 of the radio's own unit
+    stageStart = time.perf_counter()
+
+    if variables.deviceContexts is None:
+
+        for offset, registers in blockWrites:
+
+            registerImage.write(startAddress + offset, registers)
 
-        mac, raw_data = await xbeeQueue.get()
+    elif not variables.deviceContexts.write(route, blockWrites):
 
-        try:
+        logger.warning("Xbee radio with mac address %s has no modbus unit id, its values are not served over modbus", mac, extra={"rateLimitKey": mac})
 
-            # Query database to find out start address of the retrieved mac address
+        if channelLayout is not None:
 
-            startAddress = dbQueryModbusStartAddress(mac)
+            channelLayout.invalidate() # Written in full once the radio has a unit
 
-            if isinstance(startAddress, int):
+        return
 
-                sensorValues = await cayenneParse(mac, raw_data)
+    if variables.summaryBlock is not None:
 
-                # Assign a block if first time 
-                # if xbeeMac not in variables.xbeeAddressModbusMap:
+        variables.summaryBlock.updateValues(route["xbeeMac"], sensorValues)
 
-                #     variables.xbeeAddressModbusMap[xbeeMac] = variables.nextModbusAddressStart
-                #     variables.nextModbusAddressStart += variables.incrementalModbusAddress  # Reserve 50 registers per device
+    gatewayMetrics.setValuesSeconds.observe(time.perf_counter() - stageStart)
 
-                # Convert floats to register values
-                registerValues = []
-                for val in sensorValues:
-                    registerValues.extend(floatToRegisters(val))
-                
-                # Limit to 20 registers (10 floats)
-                registers = registerValues[:20]
-                # startAddress = variables.xbeeAddressModbusMap[xbeeMac]
+    changeDetector.recordWrite(mac, records, route)
 
-                # Write to Holding (FC3) and Input (FC4) registers
-                # contextValue[0][0].setValues(3, start_addr, regs)
-                # contextValue[0][0].setValues(4, start_addr, regs)
-                contextValue[0].setValues(3, startAddress, registers)
-                contextValue[0].setValues(4, startAddress, registers)
-            
-            else:
+async def modbusPolling(registerImage):
 
-                print (f"Xbee radio with mac address {mac}, has not been configured\nOther possible error are {startAddress}")
+    # Pool of processingWorkers consumers, frames are sharded by mac address so each radio keeps its packet order
 
-        except Exception as e:
-            
-            print(f"Modbus polling error: {str(e)}")
+    variables.processingStage = ShardedProcessingStage(xbeeQueue, partial(processFrame, registerImage))
 
-        finally:
+    await variables.processingStage.run()
 
-            xbeeQueue.task_done()
-            await asyncio.sleep(0)
+async def routingCacheResync():
 
-async def modbusServer(context):
+    # Fallback for configuration changes made from another process (e.g. the configuration gui)
+
+    while True:
+
+        await asyncio.sleep(variables.routingCacheResyncInterval)
+
+        await asyncio.to_thread(loadRoutingCache)
+
+async def modbusServer(context, host=None, port=None):
 
     identity = ModbusDeviceIdentification()
     identity.VendorName = 'Cors System'
@@ -126,24 +163,122 @@ async def modbusServer(context):
     identity.ModelName = 'Genesis'
     identity.MajorMinorRevision = '2.0'
 
-    ipAddress = getIpAddress()
+    ipAddress = getIpAddress() if host is None else host
+    port = variables.modbusPort if port is None else port
 
     # unpackedContext = context[0]
-    print(f"Starting Modbus TCP server on port {variables.modbusPort}...")
-    await StartAsyncTcpServer(context, identity=identity, address=(ipAddress, variables.modbusPort))
+    logger.info("Starting Modbus TCP server on %s port %s", ipAddress, port)
+    # Same server StartAsyncTcpServer builds, kept as an instance so the metrics endpoint can count its connections
+    # Requests for a unit id without a radio get no answer, as from a serial gateway whose device is missing
+    # (pymodbus answers them with an exception clients cannot decode otherwise)
+    server = ModbusTcpServer(context, identity=identity, address=(ipAddress, port), trace_pdu=gatewayMetrics.tracePdu, ignore_missing_slaves=True)
+    gatewayMetrics.modbusServer = server
+    await server.serve_forever()
     # await StartAsyncTcpServer(unpackedContext, identity=identity, address=("0.0.0.0", 5020))
 
 # Main entry
-async def startProcess():
-    
+# frameSource replaces the coordinator radios (e.g. a capture replay), it is called with the ingest bridge once the pipeline is up
+async def startProcess(frameSource=None):
+
+    if frameSource is None:
+
+        availablePorts = await asyncio.gather(*(asyncio.to_thread(coordinator.resolvePort) for coordinator in variables.coordinators))
+
+        if not any(availablePorts):
+
+            logger.error("Gateway radio not connected")
+
+            sys.exit(1)
+
+        if variables.captureEnabled:
+
+            variables.frameCapture = FrameCaptureWriter()
+            variables.frameCapture.start()
+
     context = contextManager()
-    variables.xbeePollingTask = asyncio.create_task(xbeePolling())
 
-    await asyncio.gather(
+    if variables.summaryBlockEnabled:
+
+        if variables.registerImage is None:
+
+            logger.warning("The summary block lives in the shared register map, it is not served in %s addressing mode", variables.modbusAddressingMode)
+
+        else:
+
+            variables.summaryBlock = SummaryBlock(variables.registerImage)
+
+    if variables.downlinkEnabled:
+
+        # Client writes to control registers are queued from the modbus datablocks once this is set
+
+        variables.downlink = DownlinkQueue(variables.registerImage)
+
+    xbeeQueue.bindLoop()
+    gatewayMetrics.ingestBridge = xbeeQueue
+
+    # Indexes and migrations of the Gateway database, a failure is logged and the gateway runs on without them
+
+    await asyncio.to_thread(ensureDatabaseSchema)
+
+    if variables.deviceContexts is not None:
+
+        # Radios configured before unitId mode was enabled get their unit ids before the routes are loaded
+
+        await asyncio.to_thread(assignModbusUnitIds)
+
+    loadedRoutes = await asyncio.to_thread(loadRoutingCache)
+
+    if isinstance(loadedRoutes, int):
+
+        logger.info("Routing cache loaded with %d configured radio", loadedRoutes)
+
+    if variables.historySpoolEnabled:
+
+        # History reaches the local spool first, the drainer moves it to mongodb whenever mongodb is reachable
+
+        variables.historySpool = await asyncio.to_thread(HistorySpool)
+        variables.spoolDrainer = SpoolDrainer(variables.historySpool, storeXbeeHistoryBatch)
+        variables.historyWriter = HistoryWriter(variables.historySpool.append)
+
+    else:
+
+        variables.historyWriter = HistoryWriter(storeXbeeHistoryBatch)
+
+    if variables.rollupEnabled:
+
+        variables.rollupEngine = RollupEngine(rollupHistory)
+
+    variables.xbeePollingTask = asyncio.create_task(xbeePolling() if frameSource is None else frameSource(xbeeQueue))
+
+    gatewayTasks = [
 
         # xbeePolling(),
         variables.xbeePollingTask,
-        modbusPolling(context),
+        modbusPolling(variables.registerImage),
+        routingCacheResync(),
+        variables.historyWriter.run(),
         modbusServer(context)
 
-    )
+    ]
+
+    if variables.spoolDrainer is not None:
+
+        gatewayTasks.append(variables.spoolDrainer.run())
+
+    if variables.rollupEngine is not None:
+
+        gatewayTasks.append(variables.rollupEngine.run())
+
+    if variables.summaryBlock is not None:
+
+        gatewayTasks.append(variables.summaryBlock.run())
+
+    if variables.downlink is not None:
+
+        gatewayTasks.append(variables.downlink.run())
+
+    if variables.metricsEnabled:
+
+        gatewayTasks.append(metricsServer())
+
+    await asyncio.gather(*gatewayTasks)
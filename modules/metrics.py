@@ -0,0 +1,308 @@
+import time, asyncio, logging, threading
+from . import variables
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Gateway metrics in the Prometheus text format, served over http from the gateway's own event loop
+# Hot path instrumentation only bumps preallocated counters and fixed bucket histograms,
+# everything derived from the other stages (queue depths, coordinator state...) is read when the endpoint is scraped
+
+latencyBuckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+flushBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=latencyBuckets):
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # Last slot counts observations above the highest bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+
+        # Upper bound of the bucket holding the q quantile, good enough for benchmark reports
+
+        if not self.count:
+
+            return 0.0
+
+        rank = q * self.count
+        cumulative = 0
+
+        for bucket, bucketCount in zip(self.buckets, self.counts):
+
+            cumulative += bucketCount
+
+            if cumulative >= rank:
+
+                return bucket
+
+        return float("inf")
+
+    def render(self, name, help):
+
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        cumulative = 0
+
+        for bucket, bucketCount in zip(self.buckets, self.counts):
+
+            cumulative += bucketCount
+            lines.append(f'{name}_bucket{{le="{bucket}"}} {cumulative}')
+
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+
+        return lines
+
+class GatewayMetrics:
+
+    def __init__(self):
+
+        self.startTime = time.time()
+        self.packetsReceived = 0
+        self.radioPackets = {} # mac -> [packets received, last seen unix time], written on the xbee reader threads
+        self._packetLock = threading.Lock() # One xbee reader thread per coordinator, their increments must not race
+
+        self.routingSeconds = Histogram()
+        self.decodeSeconds = Histogram()
+        self.setValuesSeconds = Histogram()
+        self.historyFlushSeconds = Histogram(flushBuckets)
+
+        self.modbusRequests = [0] * 128 # Requests received per modbus function code
+        self.modbusExceptions = [0] * 128 # Exception responses sent per modbus function code
+
+        # Set by the gateway once its stages exist, scraped for queue depths and connected modbus clients
+        self.ingestBridge = None
+        self.modbusServer = None
+
+    def recordPacket(self, xbeeMacAddress):
+
+        # Called from the xbee reader thread of every coordinator for every received frame
+
+        now = time.time()
+
+        with self._packetLock:
+
+            self.packetsReceived += 1
+            radio = self.radioPackets.get(xbeeMacAddress)
+
+            if radio is None:
+
+                self.radioPackets[xbeeMacAddress] = [1, now]
+
+            else:
+
+                radio[0] += 1
+                radio[1] = now
+
+    def tracePdu(self, sending, pdu):
+
+        # pymodbus trace_pdu hook, called with every request received and response sent, must return the pdu
+
+        functionCode = pdu.function_code
+
+        if sending:
+
+            if functionCode & 0x80:
+
+                self.modbusExceptions[functionCode & 0x7F] += 1
+
+        else:
+
+            self.modbusRequests[functionCode & 0x7F] += 1
+
+        return pdu
+
+    def render(self):
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for labels, value in samples:
+
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+        metric("gateway_uptime_seconds", "gauge", "Seconds since the gateway started", [("", time.time() - self.startTime)])
+        metric("gateway_radio_connected", "gauge", "1 while at least one coordinator radio is connected (radioFlag)", [("", int(bool(variables.radioFlag)))])
+        metric("gateway_packets_received_total", "counter", "Frames received from every coordinator radio", [("", self.packetsReceived)])
+
+        coordinators = [coordinator.stats() for coordinator in variables.coordinators]
+
+        metric("gateway_packets_per_second", "gauge", "Frames received per second over the last second", [("", sum(coordinator["framesPerSecond"] for coordinator in coordinators))])
+
+        if coordinators:
+
+            metric("gateway_coordinator_connected", "gauge", "Connection state per coordinator radio", [(f'coordinator="{coordinator["name"]}"', int(coordinator["connected"])) for coordinator in coordinators])
+            metric("gateway_coordinator_packets_per_second", "gauge", "Frames received per second per coordinator radio", [(f'coordinator="{coordinator["name"]}"', coordinator["framesPerSecond"]) for coordinator in coordinators])
+            metric("gateway_coordinator_reconnects_total", "counter", "Reconnections per coordinator radio", [(f'coordinator="{coordinator["name"]}"', coordinator["reconnects"]) for coordinator in coordinators])
+            metric("gateway_coordinator_frames_sent_total", "counter", "Downlink frames sent per coordinator radio", [(f'coordinator="{coordinator["name"]}"', coordinator["framesSent"]) for coordinator in coordinators])
+
+        if variables.metricsPerRadio:
+
+            with self._packetLock:
+
+                radios = [(mac, list(radio)) for mac, radio in self.radioPackets.items()]
+
+            metric("gateway_radio_packets_received_total", "counter", "Frames received per radio mac address", [(f'mac="{mac}"', radio[0]) for mac, radio in radios])
+            metric("gateway_radio_last_seen_timestamp_seconds", "gauge", "Unix time of the last frame received per radio", [(f'mac="{mac}"', radio[1]) for mac, radio in radios])
+
+        if self.ingestBridge is not None:
+
+            ingestStats = self.ingestBridge.stats()
+
+            metric("gateway_ingest_queue_depth", "gauge", "Frames waiting in the ingest bridge", [("", ingestStats["depth"])])
+            metric("gateway_ingest_dropped_total", "counter", "Frames dropped by the ingest overflow policy", [("", ingestStats["dropped"])])
+            metric("gateway_ingest_coalesced_total", "counter", "Frames replaced by a newer frame of the same radio", [("", ingestStats["coalesced"])])
+
+        if variables.processingStage is not None:
+
+            stageStats = variables.processingStage.stats()
+
+            metric("gateway_shard_queue_depth", "gauge", "Frames waiting per processing worker", [(f'shard="{index}"', depth) for index, depth in enumerate(stageStats["shardDepths"])])
+            metric("gateway_shard_dropped_total", "counter", "Frames dropped by the overflow policy of a full processing shard", [(f'shard="{index}"', dropped) for index, dropped in enumerate(stageStats["droppedFrames"])])
+            metric("gateway_shard_coalesced_total", "counter", "Frames replaced by a newer frame of the same radio in a processing shard", [(f'shard="{index}"', coalesced) for index, coalesced in enumerate(stageStats["coalescedFrames"])])
+            metric("gateway_frames_failed_total", "counter", "Frames whose processing raised", [("", sum(stageStats["failedFrames"]))])
+
+        if variables.historyWriter is not None:
+
+            historyStats = variables.historyWriter.stats()
+
+            metric("gateway_history_backlog", "gauge", "History documents waiting to be written", [("", historyStats["backlog"])])
+            metric("gateway_history_written_total", "counter", "History documents written to mongodb", [("", historyStats["writtenDocuments"])])
+            metric("gateway_history_dropped_total", "counter", "History documents dropped past historyMaxBacklog", [("", historyStats["droppedDocuments"])])
+
+        if variables.historySpool is not None:
+
+            spoolStats = variables.historySpool.stats()
+
+            metric("gateway_history_spool_depth", "gauge", "History documents waiting in the local spool", [("", spoolStats["depth"])])
+            metric("gateway_history_spool_evicted_total", "counter", "History documents evicted from the full spool", [("", spoolStats["evicted"])])
+
+        if variables.spoolDrainer is not None:
+
+            drainerStats = variables.spoolDrainer.stats()
+
+            metric("gateway_history_spool_drained_total", "counter", "History documents moved from the spool to mongodb", [("", drainerStats["drained"])])
+            metric("gateway_history_spool_drain_rate", "gauge", "History documents moved to mongodb per second over the last second", [("", drainerStats["drainRate"])])
+            metric("gateway_history_spool_failed_drains_total", "counter", "Spool drain batches mongodb did not fully accept", [("", drainerStats["failedDrains"])])
+
+        if variables.rollupEngine is not None:
+
+            rollupStats = variables.rollupEngine.stats()
+
+            metric("gateway_rollup_passes_total", "counter", "History rollup passes", [("", rollupStats["passes"])])
+            metric("gateway_rollup_failed_passes_total", "counter", "History rollup passes that failed", [("", rollupStats["failedPasses"])])
+            metric("gateway_rollup_samples_total", "counter", "Raw history samples summarized by rollup passes, samples of the lookback window on every pass", [("", rollupStats["rolledSamples"])])
+
+            if rollupStats["lastPassAt"] is not None:
+
+                metric("gateway_rollup_last_pass_timestamp_seconds", "gauge", "Unix time of the last successful rollup pass", [("", rollupStats["lastPassAt"])])
+
+        lines.extend(self.routingSeconds.render("gateway_routing_lookup_seconds", "Routing cache lookup time, including database fallbacks"))
+        lines.extend(self.decodeSeconds.render("gateway_decode_seconds", "Cayenne decode time per frame"))
+        lines.extend(self.setValuesSeconds.render("gateway_set_values_seconds", "Time spent writing a frame's registers to the modbus datastore"))
+        lines.extend(self.historyFlushSeconds.render("gateway_history_flush_seconds", "Latency of one history batch write"))
+
+        if variables.deviceContexts is not None:
+
+            metric("gateway_modbus_unit_devices", "gauge", "Radios served as their own modbus unit id", [("", variables.deviceContexts.stats()["devices"])])
+
+        if variables.summaryBlock is not None:
+
+            summaryStats = variables.summaryBlock.stats()
+
+            metric("gateway_summary_radios", "gauge", "Radios owning a slot of the summary block", [("", summaryStats["radios"])])
+            metric("gateway_summary_fresh_radios", "gauge", "Radios whose summary fresh bit is set", [("", summaryStats["freshRadios"])])
+
+        if variables.downlink is not None:
+
+            downlinkStats = variables.downlink.stats()
+
+            metric("gateway_downlink_pending_points", "gauge", "Control points waiting to be sent to their radio", [("", downlinkStats["pendingPoints"])])
+            metric("gateway_downlink_client_writes_total", "counter", "Client writes to control registers", [("", downlinkStats["clientWrites"])])
+            metric("gateway_downlink_coalesced_total", "counter", "Control writes replacing a value still waiting to be sent", [("", downlinkStats["coalesced"])])
+            metric("gateway_downlink_sent_total", "counter", "Control points handed to a coordinator radio", [("", downlinkStats["sent"])])
+            metric("gateway_downlink_failed_total", "counter", "Control points whose transmission failed", [("", downlinkStats["failed"])])
+            metric("gateway_downlink_rejected_total", "counter", "Control points whose value does not fit the downlink cayenne type", [("", downlinkStats["rejected"])])
+
+        if self.modbusServer is not None:
+
+            metric("gateway_modbus_clients", "gauge", "Connected modbus tcp clients", [("", len(self.modbusServer.active_connections))])
+
+        metric("gateway_modbus_requests_total", "counter", "Modbus requests received per function code", [(f'function_code="{functionCode}"', count) for functionCode, count in enumerate(self.modbusRequests) if count])
+        metric("gateway_modbus_exceptions_total", "counter", "Modbus exception responses per function code", [(f'function_code="{functionCode}"', count) for functionCode, count in enumerate(self.modbusExceptions) if count])
+
+        lines.append("")
+
+        return "\n".join(lines)
+
+gatewayMetrics = GatewayMetrics()
+
+async def handleMetricsRequest(reader, writer):
+
+    try:
+
+        requestLine = await asyncio.wait_for(reader.readline(), timeout=5)
+
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+
+            pass
+
+        requestParts = requestLine.decode("latin-1").split()
+
+        if len(requestParts) >= 2 and requestParts[0] == "GET" and requestParts[1].split("?")[0] == "/metrics":
+
+            status, body = "200 OK", gatewayMetrics.render().encode()
+
+        else:
+
+            status, body = "404 Not Found", b"Not found, metrics are served on /metrics\n"
+
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    except (asyncio.TimeoutError, ConnectionError) as e:
+
+        logger.debug("Metrics request aborted: %s", e)
+
+    finally:
+
+        writer.close()
+
+async def metricsServer(host=None, port=None):
+
+    host = variables.metricsAddress if host is None else host
+    port = variables.metricsPort if port is None else port
+
+    try:
+
+        server = await asyncio.start_server(handleMetricsRequest, host, port)
+
+    except OSError as e:
+
+        # The endpoint is optional, a taken port must not stop the gateway tasks gathered with it
+
+        logger.error("Could not serve metrics on %s:%s, running without metrics: %s", host, port, e)
+
+        return
+
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+
+    async with server:
+
+        await server.serve_forever()
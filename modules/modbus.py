@@ -1,7 +1,14 @@
-import psutil, socket
-from struct import pack, unpack
+import psutil, socket, sys, math, logging, threading
+from array import array
+from . import variables
+from struct import pack, unpack, Struct
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
 from pymodbus.datastore import ModbusSequentialDataBlock
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus.pdu import ExceptionResponse
+from .cayenneDecoder import lppTypes
+
+logger = logging.getLogger(__name__)
 
 # Float to two 16-bit Modbus registers
 def floatToRegisters(floatValue):
@@ -9,17 +16,747 @@ def floatToRegisters(floatValue):
     binaryData = pack('<f', floatValue)
     return list(unpack('<HH', binaryData))
 
-def contextManager():
+# Whole sample vector to 16-bit Modbus registers in one struct call, written into a reusable buffer
+# wordOrder "little" puts the low word of each float first and byteOrder "big" keeps each register's natural value,
+# which is the layout floatToRegisters has always produced
+
+class RegisterEncoder:
+
+    def __init__(self, maxValues=10, wordOrder=None, byteOrder=None):
+
+        wordOrder = variables.registerWordOrder if wordOrder is None else wordOrder
+        byteOrder = variables.registerByteOrder if byteOrder is None else byteOrder
+
+        if wordOrder not in ("big", "little") or byteOrder not in ("big", "little"):
+
+            raise ValueError(f"Word and byte order should be 'big' or 'little', got {wordOrder} and {byteOrder}")
+
+        self.maxValues = maxValues
+        self.wordOrder = wordOrder
+        self.byteOrder = byteOrder
+
+        # Packing the floats big endian lays out each register as its byte swapped value on a little endian host,
+        # so big endian packing is used for big word order and a final byteswap fixes the bytes inside the registers
+
+        self._floatEndian = ">" if wordOrder == "big" else "<"
+        packedBytesSwapped = (wordOrder == "big") == (sys.byteorder == "little")
+        self._byteswap = packedBytesSwapped == (byteOrder == "big")
+
+        self._registers = array("H", bytes(4 * maxValues))
+        self._registerBytes = memoryview(self._registers).cast("B")
+        self._registerView = memoryview(self._registers)
+        self._packers = {}
+        self.truncated = False # Whether the last encode call dropped values past maxValues
+
+    def registerOffsets(self, valueCount):
+
+        # First register of each value, plus the end of the last one, for the values that fit maxValues
+
+        return [2 * index for index in range(min(valueCount, self.maxValues) + 1)]
+
+    def encode(self, floatValues):
+
+        # Returns a memoryview over the internal buffer, valid until the next encode call
+
+        valueCount = min(len(floatValues), self.maxValues)
+        self.truncated = valueCount < len(floatValues)
+        packer = self._packers.get(valueCount)
+
+        if packer is None:
+
+            packer = self._packers[valueCount] = Struct(f"{self._floatEndian}{valueCount}f")
+
+        packer.pack_into(self._registerBytes, 0, *floatValues[:valueCount])
+
+        if self._byteswap:
+
+            # array.byteswap works on the whole buffer, only the written part is meaningful
+
+            self._registers.byteswap()
+
+        return self._registerView[:2 * valueCount]
+
+# Register profiles, stored per radio as "encoding" on its configuredRadio document: a list with one entry per value in
+# payload order, the last entry also applies to any further values. An entry is a type name or a dictionary:
+#     "encoding": [{"type": "int16", "scale": 10}, {"type": "float32", "order": "ABCD"}, "uint32"]
+# int16 and uint32 write round(value * scale) clamped to their range (NaN writes 0), float32 writes the value itself
+# 32-bit types take an order of ABCD, CDAB, BADC or DCBA (A is the most significant byte, first register first),
+# without one they follow registerWordOrder/registerByteOrder. Radios without a profile keep the float RegisterEncoder
+
+registerTypes = {"int16": ("h", 1, -0x8000, 0x7FFF), "uint32": ("I", 2, 0, 0xFFFFFFFF), "float32": ("f", 2, None, None)}
+registerOrders = {"ABCD": ("big", "big"), "CDAB": ("little", "big"), "BADC": ("big", "little"), "DCBA": ("little", "little")} # (word order, byte order)
+
+def validateRegisterProfile(profile):
+
+    # Returns an error message, or None when the profile is valid
+
+    if not isinstance(profile, list) or not profile:
+
+        return "Encoding should be a non empty list of register types, e.g. [{'type': 'int16', 'scale': 10}, 'float32']"
+
+    for index, entry in enumerate(profile):
+
+        entry = {"type": entry} if isinstance(entry, str) else entry
+
+        if not isinstance(entry, dict) or str(entry.get("type")).lower() not in registerTypes:
+
+            return f"Encoding entry {index} should name a register type. Allowed types: {tuple(registerTypes)}"
+
+        invalidKey = [key for key in entry if key not in ("type", "scale", "order")]
+
+        if invalidKey:
+
+            return f"Invalid keys in encoding entry {index}: {invalidKey}. Allowed keys: ('type', 'scale', 'order')"
+
+        scale = entry.get("scale", 1)
+
+        if isinstance(scale, bool) or not isinstance(scale, (int, float)) or scale == 0:
+
+            return f"Scale of encoding entry {index} should be a non zero number"
+
+        if "order" in entry and str(entry["order"]).upper() not in registerOrders:
+
+            return f"Invalid order {entry['order']} in encoding entry {index}. Allowed orders: {tuple(registerOrders)}"
+
+    return None
+
+class ProfileEncoder:
+
+    # Encodes a radio's values by its register profile, compiled once per value count into a single struct call
+    # plus the word and byte swaps of the registers whose order differs from the packed layout
+    # Values past maxRegisters (the radio's block) are left out instead of a fixed 10 value limit
+
+    def __init__(self, profile, maxRegisters):
+
+        self.maxRegisters = maxRegisters
+        self.truncated = False # Whether the last encode call dropped values that do not fit the block
+
+        defaultOrder = (variables.registerWordOrder, variables.registerByteOrder)
+        self._fields = []
+
+        for entry in profile:
+
+            entry = {"type": entry} if isinstance(entry, str) else entry
+            registerType = str(entry["type"]).lower()
+            order = registerOrders[str(entry["order"]).upper()] if "order" in entry else defaultOrder
+            self._fields.append((registerType, entry.get("scale", 1), order))
+
+        self._registers = array("H", bytes(2 * maxRegisters))
+        self._registerBytes = memoryview(self._registers).cast("B")
+        self._registerView = memoryview(self._registers)
+        self._compiled = {}
+
+    def _compile(self, valueCount):
+
+        # Little endian packing leaves every register with its natural value on a little endian host and puts the low
+        # word of 32-bit values first, i.e. CDAB. Other orders are fixed afterwards with word and/or byte swaps
+        # Neighbouring values sharing a conversion or a swap are merged into runs, handled with one slice operation each
+
+        formatCodes = []
+        integerRuns = [] # [first value, end value, scale, lowest, highest]
+        wordSwapRuns = [] # [first register, end register] of 32-bit values whose high word goes first
+        byteSwapRuns = [] # [first register, end register] whose bytes are swapped
+        registerCount = 0
+
+        def extendRun(runs, first, end, *parameters):
+
+            if runs and runs[-1][1] == first and runs[-1][2:] == list(parameters):
+
+                runs[-1][1] = end
+
+            else:
+
+                runs.append([first, end, *parameters])
+
+        for index in range(valueCount):
+
+            registerType, scale, (wordOrder, byteOrder) = self._fields[min(index, len(self._fields) - 1)]
+            formatCode, width, lowest, highest = registerTypes[registerType]
+
+            if registerCount + width > self.maxRegisters:
+
+                break
+
+            formatCodes.append(formatCode)
+
+            if lowest is not None:
+
+                extendRun(integerRuns, index, index + 1, scale, lowest, highest)
+
+            if width == 2:
+
+                if wordOrder == "big":
+
+                    extendRun(wordSwapRuns, registerCount, registerCount + 2)
+
+                if byteOrder == "little":
+
+                    extendRun(byteSwapRuns, registerCount, registerCount + 2)
+
+            registerCount += width
+
+        compiled = self._compiled[valueCount] = (Struct("<" + "".join(formatCodes)), len(formatCodes), integerRuns, wordSwapRuns, byteSwapRuns, registerCount)
+
+        return compiled
+
+    def registerOffsets(self, valueCount):
+
+        # First register of each value, plus the end of the last one, for the values that fit maxRegisters
+
+        offsets = [0]
+
+        for index in range(valueCount):
+
+            width = registerTypes[self._fields[min(index, len(self._fields) - 1)][0]][1]
+
+            if offsets[-1] + width > self.maxRegisters:
+
+                break
+
+            offsets.append(offsets[-1] + width)
+
+        return offsets
+
+    def encode(self, values):
+
+        # Returns a memoryview over the internal buffer, valid until the next encode call
+
+        compiled = self._compiled.get(len(values)) or self._compile(len(values))
+        packer, packedCount, integerRuns, wordSwapRuns, byteSwapRuns, registerCount = compiled
+        self.truncated = packedCount < len(values)
+
+        values = values[:packedCount]
+
+        if integerRuns:
+
+            values = list(values)
+
+            for first, end, scale, lowest, highest in integerRuns:
+
+                values[first:end] = [0 if (scaled := value * scale) != scaled else lowest if scaled <= lowest else highest if scaled >= highest else round(scaled) for value in values[first:end]]
+
+        packer.pack_into(self._registerBytes, 0, *values)
+
+        registers = self._registers
+
+        if sys.byteorder == "big":
+
+            registers.byteswap()
+
+        for first, end in wordSwapRuns:
+
+            registers[first:end:2], registers[first + 1:end:2] = registers[first + 1:end:2], registers[first:end:2]
+
+        for first, end in byteSwapRuns:
+
+            swapped = registers[first:end]
+            swapped.byteswap()
+            registers[first:end] = swapped
+
+        return self._registerView[:registerCount]
+
+def buildRegisterEncoder(profile, maxRegisters):
+
+    # Encoder of one radio: its profile when it has one, otherwise floats in the map's word order as before
+
+    if profile:
+
+        return ProfileEncoder(profile, maxRegisters)
+
+    return RegisterEncoder(maxValues=maxRegisters // 2)
+
+# Channel keyed register layout: each (cayenne channel, type) of a radio keeps the registers it got when it was first
+# seen, whatever else the payload carries, so a frame missing a channel no longer shifts the following values
+# The layout is stored on the configuredRadio document as "registerLayout": [[channel, type], ...] in register order,
+# either set by hand or learned from the radio's frames, new channels are appended after the known ones
+# Values are encoded in layout order with the radio's register encoder, the encoding profile applies per layout value
+# Only the register ranges of channels whose registers changed are written, channels not received yet read as NaN (0 for integer types)
+
+def validateRegisterLayout(registerLayout):
+
+    # Returns an error message, or None when the layout is valid
+
+    if not isinstance(registerLayout, list):
+
+        return "Register layout should be a list of [channel, type] pairs"
+
+    seen = set()
+
+    for entry in registerLayout:
+
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2 or not all(isinstance(part, int) and not isinstance(part, bool) for part in entry):
+
+            return f"Invalid register layout entry {entry}, expected [channel, type]"
+
+        if not 0 <= entry[0] <= 255 or entry[1] not in lppTypes:
+
+            return f"Invalid register layout entry {entry}, unknown cayenne channel or type"
+
+        if tuple(entry) in seen:
+
+            return f"Register layout entry {entry} is listed twice"
+
+        seen.add(tuple(entry))
+
+    return None
+
+class ChannelLayout:
+
+    def __init__(self, registerLayout, encoder):
+
+        self.encoder = encoder
+        self.entries = [] # [channel, type] in register order
+        self.truncated = False # Whether the last encode dropped values that do not fit the block
+
+        self._positions = {} # (channel, type) -> (first value, value count)
+        self._values = [] # Latest value of every layout value, in layout order
+        self._ranges = [] # (first register, end register) per entry, None when it does not fit the block
+        self._written = None # Registers as last written, None until the first write
+
+        for channel, lppType in registerLayout:
+
+            self._append(channel, lppType)
+
+        self._computeRanges()
+
+    def _append(self, channel, lppType):
+
+        valueCount = len(lppTypes[lppType][3])
+        self._positions[(channel, lppType)] = (len(self._values), valueCount)
+        self._values.extend([math.nan] * valueCount)
+        self.entries.append([channel, lppType])
+
+    def _computeRanges(self):
+
+        offsets = self.encoder.registerOffsets(len(self._values))
+        self._ranges = []
+
+        for channel, lppType in self.entries:
+
+            firstValue, valueCount = self._positions[(channel, lppType)]
+            endValue = min(firstValue + valueCount, len(offsets) - 1)
+            self._ranges.append((offsets[firstValue], offsets[endValue]) if endValue > firstValue else None)
+
+    def update(self, records):
+
+        # Stores the decoded (channel, type, value) records, returns True when the layout gained channels
+
+        grew = False
+
+        for channel, lppType, value in records:
+
+            position = self._positions.get((channel, lppType))
+
+            if position is None:
+
+                if lppType not in lppTypes:
+
+                    continue
+
+                self._append(channel, lppType)
+                position = self._positions[(channel, lppType)]
+                grew = True
+
+            firstValue, valueCount = position
+
+            if type(value) is tuple:
+
+                self._values[firstValue:firstValue + valueCount] = value[:valueCount]
+
+            else:
+
+                self._values[firstValue] = value
+
+        if grew:
+
+            self._computeRanges()
+            self._written = None # The block grew, written once in full
+
+        return grew
+
+    def invalidate(self):
+
+        # The registers were not written, or were cleared, the next changedRanges returns the whole block
+
+        self._written = None
+
+    def changedRanges(self):
+
+        # Encodes the layout values and returns (register offset, registers) for every run of changed channels
+        # The memoryviews point into the encoder buffer, valid until the next encode call
+
+        registers = self.encoder.encode(self._values)
+        self.truncated = self.encoder.truncated
+
+        if self._written is None or len(self._written) != len(registers):
+
+            self._written = array("H", registers)
+
+            return [(0, registers)]
+
+        if registers == self._written:
+
+            return []
+
+        changed = []
+        written = self._written
+
+        for registerRange in self._ranges:
+
+            if registerRange is None:
+
+                continue
+
+            first, end = registerRange
+
+            if registers[first:end] != written[first:end]:
+
+                if changed and changed[-1][1] == first:
+
+                    changed[-1][1] = end
+
+                else:
+
+                    changed.append([first, end])
+
+                memoryview(written)[first:end] = registers[first:end]
+
+        return [(first, registers[first:end]) for first, end in changed]
+
+# Register image: the holding (and input) registers as pages of array('H'), written with slice assignments
+# Pages are only allocated once a register inside them is written, so the whole 16-bit address space costs memory
+# in proportion to the blocks actually assigned, unwritten registers read as 0
+# With sharedInputRegisters FC3 and FC4 read the same pages, so each frame is written once
+
+class RegisterPages:
+
+    def __init__(self, registerCount, pageSize):
+
+        if pageSize < 1 or pageSize & (pageSize - 1):
+
+            raise ValueError(f"Register page size should be a power of two, got {pageSize}")
+
+        self.registerCount = registerCount
+        self.pageSize = pageSize
+        self._pageShift = pageSize.bit_length() - 1
+        self._pageMask = pageSize - 1
+        self._pages = [None] * -(-registerCount // pageSize)
+
+    def __len__(self):
+
+        return self.registerCount
+
+    def __iter__(self):
+
+        for pageIndex in range(len(self._pages)):
+
+            yield from self.read(pageIndex << self._pageShift, min(self.pageSize, self.registerCount - (pageIndex << self._pageShift)))
+
+    def _allocate(self, pageIndex):
+
+        page = self._pages[pageIndex] = array("H", bytes(2 * self.pageSize))
+
+        return page
+
+    def write(self, startAddress, registers):
+
+        # registers is a memoryview or array of 16-bit values, copied page by page without an intermediate list
+
+        registerCount = len(registers)
+        pageIndex = startAddress >> self._pageShift
+        pageOffset = startAddress & self._pageMask
+
+        if pageOffset + registerCount <= self.pageSize:
+
+            # Common case, the whole block sits in one page
+            # The view is made per write, a view kept per page would add a third to the page memory
+            page = self._pages[pageIndex] or self._allocate(pageIndex)
+            memoryview(page)[pageOffset:pageOffset + registerCount] = registers
+
+            return
+
+        written = 0
+
+        while written < registerCount:
+
+            pageIndex = (startAddress + written) >> self._pageShift
+            pageOffset = (startAddress + written) & self._pageMask
+            chunk = min(registerCount - written, self.pageSize - pageOffset)
+            page = self._pages[pageIndex] or self._allocate(pageIndex)
+            memoryview(page)[pageOffset:pageOffset + chunk] = registers[written:written + chunk]
+            written += chunk
+
+    def read(self, startAddress, count):
+
+        # Returns an array('H'), a slice of one page in the common case
+
+        pageIndex = startAddress >> self._pageShift
+        pageOffset = startAddress & self._pageMask
+
+        if pageOffset + count <= self.pageSize:
+
+            page = self._pages[pageIndex]
+
+            return array("H", bytes(2 * count)) if page is None else page[pageOffset:pageOffset + count]
+
+        # Page crossing read, the page slices are concatenated (cheaper than copying into a memoryview for 'H' arrays)
+
+        registers = array("H")
+
+        while count > 0:
+
+            chunk = min(count, self.pageSize - pageOffset)
+            page = self._pages[pageIndex]
+            registers += array("H", bytes(2 * chunk)) if page is None else page[pageOffset:pageOffset + chunk]
+            count -= chunk
+            pageIndex += 1
+            pageOffset = 0
+
+        return registers
+
+    def clear(self):
+
+        self._pages = [None] * len(self._pages)
+
+    def allocatedPages(self):
+
+        return sum(page is not None for page in self._pages)
+
+    def memoryBytes(self):
+
+        # Register storage actually allocated, page tables included
+
+        return sys.getsizeof(self._pages) + sum(sys.getsizeof(page) for page in self._pages if page is not None)
+
+class RegisterImage:
+
+    def __init__(self, registerCount=None, sharedInputRegisters=None, pageSize=None):
+
+        self.registerCount = variables.modbusRegisterCount if registerCount is None else registerCount
+        self.sharedInputRegisters = variables.sharedInputRegisters if sharedInputRegisters is None else sharedInputRegisters
+        pageSize = variables.registerPageSize if pageSize is None else pageSize
+
+        self.holding = RegisterPages(self.registerCount, pageSize)
+        self.input = self.holding if self.sharedInputRegisters else RegisterPages(self.registerCount, pageSize)
+
+    def write(self, startAddress, registers):
+
+        # registers is any sequence of 16-bit values, a RegisterEncoder memoryview is copied without an intermediate list
+
+        if not isinstance(registers, (memoryview, array)):
+
+            registers = array("H", registers)
+
+        endAddress = startAddress + len(registers)
+
+        if startAddress < 0 or endAddress > self.registerCount:
+
+            raise ValueError(f"Registers {startAddress} to {endAddress - 1} are outside the {self.registerCount} register image")
+
+        self.holding.write(startAddress, registers)
+
+        if not self.sharedInputRegisters:
+
+            self.input.write(startAddress, registers)
+
+    def read(self, startAddress, count, inputRegisters=False):
+
+        return (self.input if inputRegisters else self.holding).read(startAddress, count)
+
+    def stats(self):
+
+        return {
+
+            "registerCount": self.registerCount,
+            "pageSize": self.holding.pageSize,
+            "allocatedPages": self.holding.allocatedPages() + (0 if self.sharedInputRegisters else self.input.allocatedPages()),
+            "memoryBytes": self.holding.memoryBytes() + (0 if self.sharedInputRegisters else self.input.memoryBytes())
+
+        }
+
+class RegisterImageBlock(BaseModbusDataBlock):
+
+    # pymodbus datablock over register pages, reads return array slices instead of lists of python ints
+    # Out of range requests get an illegal data address exception instead of a short answer
+    # Client writes are also handed to the downlink queue, which sends the ones made to control registers to the radios
+
+    def __init__(self, pages, address=1, unitId=None):
+
+        # ModbusSlaveContext adds 1 to every address, starting the block at 1 maps register N to register N of the pages
+
+        self.values = pages
+        self.address = address
+        self.unitId = unitId # Unit id of the radio in unitId mode, None for the shared map
+        self.default_value = 0
+
+    def getValues(self, address, count=1):
+
+        start = address - self.address
+
+        if start < 0 or start + count > len(self.values):
+
+            return ExceptionResponse.ILLEGAL_ADDRESS
+
+        return self.values.read(start, count)
+
+    def setValues(self, address, values):
+
+        start = address - self.address
+
+        if not isinstance(values, (list, tuple, array)):
+
+            values = [values]
+
+        if start < 0 or start + len(values) > len(self.values):
+
+            return ExceptionResponse.ILLEGAL_ADDRESS
+
+        self.values.write(start, array("H", values))
+
+        if variables.downlink is not None:
+
+            variables.downlink.clientWrite(self.unitId, start, values)
+
+        return None
+
+    def reset(self):
+
+        self.values.clear()
+
+# unitId addressing: every configured radio is its own modbus unit, served from a small register image at register 0
+# so SCADA polls each radio with the same request and only the unit id changes
+# Unit contexts follow the routing cache, they are added and removed as radios are configured, changed or deleted
+
+modbusAddressingModes = ("shared", "unitId")
+modbusUnitIds = range(1, 248) # 0 is the broadcast address and 248 to 255 are reserved
+
+class DeviceContexts:
+
+    def __init__(self, serverContext, registerCount=None, sharedInputRegisters=None):
+
+        self.serverContext = serverContext
+        self.registerCount = variables.unitRegisterCount if registerCount is None else registerCount
+        self.sharedInputRegisters = variables.sharedInputRegisters if sharedInputRegisters is None else sharedInputRegisters
+        self._pageSize = 1 << (self.registerCount - 1).bit_length() # One page holds a whole radio block
+
+        # Coils and discrete inputs are not used by the gateway, every unit shares the same small blocks
+        self._coils = ModbusSequentialDataBlock(0, [0]*16)
+        self._discreteInputs = ModbusSequentialDataBlock(0, [0]*16)
+
+        self._images = {} # unit id -> RegisterImage of the radio
+        self._owners = {} # unit id -> mac address the image was created for
+        self._lock = threading.Lock() # Changes come from dbIntegration on worker threads
+
+    def addDevice(self, unitId, xbeeMacAddress):
+
+        with self._lock:
+
+            if self._owners.get(unitId) == xbeeMacAddress:
+
+                return self._images[unitId]
+
+            # New unit, or a unit id handed to another radio: start from a zeroed block so old values are not served
+
+            registerImage = RegisterImage(self.registerCount, self.sharedInputRegisters, self._pageSize)
+            holdingBlock = RegisterImageBlock(registerImage.holding, unitId=unitId)
+
+            self.serverContext[unitId] = ModbusSlaveContext(
+                di=self._discreteInputs,
+                co=self._coils,
+                hr=holdingBlock,
+                ir=holdingBlock if self.sharedInputRegisters else RegisterImageBlock(registerImage.input),
+            )
+
+            self._images[unitId] = registerImage
+            self._owners[unitId] = xbeeMacAddress
+
+        return registerImage
+
+    def removeDevice(self, unitId):
+
+        with self._lock:
+
+            if self._images.pop(unitId, None) is not None:
+
+                del self._owners[unitId]
+                del self.serverContext[unitId]
+
+    def sync(self, routes):
+
+        # Reconciles the units with the routing table, radios without a valid unit id are not served
+
+        wantedUnits = {route["modbusUnitId"]: route["xbeeMac"] for route in routes if route.get("modbusUnitId") in modbusUnitIds}
+
+        for unitId in set(self._images) - set(wantedUnits):
+
+            self.removeDevice(unitId)
+
+        for unitId, xbeeMacAddress in wantedUnits.items():
+
+            self.addDevice(unitId, xbeeMacAddress)
+
+        return len(wantedUnits)
+
+    def write(self, route, blockWrites):
+
+        # blockWrites are (offset in the radio's block, registers), returns False when the radio has no unit yet
+
+        registerImage = self._images.get(route.get("modbusUnitId"))
+
+        if registerImage is None:
+
+            return False
+
+        for offset, registers in blockWrites:
+
+            registerImage.write(offset, registers)
+
+        return True
+
+    def stats(self):
+
+        images = list(self._images.values())
+
+        return {
+
+            "devices": len(images),
+            "registerCount": self.registerCount,
+            "memoryBytes": sum(registerImage.stats()["memoryBytes"] for registerImage in images)
+
+        }
+
+def contextManager(registerImage=None):
+
+    # Holding and input registers come from the register image, kept in variables.registerImage for the frame pipeline
+    # In unitId mode the context starts without units, variables.deviceContexts fills it from the routing cache
+
+    if variables.modbusAddressingMode not in modbusAddressingModes:
+
+        raise ValueError(f"Invalid modbus addressing mode {variables.modbusAddressingMode}. Allowed modes: {modbusAddressingModes}")
+
+    if variables.modbusAddressingMode == "unitId":
+
+        context = ModbusServerContext(slaves={}, single=False)
+        variables.deviceContexts = DeviceContexts(context)
+
+        return context
+
+    registerImage = RegisterImage() if registerImage is None else registerImage
+    variables.registerImage = registerImage
+
+    holdingBlock = RegisterImageBlock(registerImage.holding)
 
     store = ModbusSlaveContext(
         di=ModbusSequentialDataBlock(0, [0]*1000),  # Discrete Inputs
         co=ModbusSequentialDataBlock(0, [0]*1000),  # Coils
-        hr=ModbusSequentialDataBlock(0, [0]*1000),  # Holding Registers
-        ir=ModbusSequentialDataBlock(0, [0]*1000),  # Input Registers
+        hr=holdingBlock,  # Holding Registers
+        ir=holdingBlock if registerImage.sharedInputRegisters else RegisterImageBlock(registerImage.input),  # Input Registers
     )
 
-    contextAsNextedDic = ModbusServerContext(slaves={0: store, 1:store}, single=True)
-    context = contextAsNextedDic[0]
+    # Single context: every unit id is answered from the same store and context[0] is that store
+    # The server needs the ModbusServerContext itself, handing it the inner {unit id: store} dict breaks on client connect
+
+    context = ModbusServerContext(slaves=store, single=True)
 
     return context
 
@@ -70,17 +807,17 @@ def getIpAddress():
 
     if ethernetIp:
 
-        print(f"Ethernet IP Address: {ethernetIp}")
+        logger.info("Ethernet IP Address: %s", ethernetIp)
         return ethernetIp
     
     elif wifiIp:
 
-        print("No Ethernet interface detected. Falling back to Wi-Fi.")
-        print(f"Wi-Fi IP Address: {wifiIp}")
+        logger.info("No Ethernet interface detected. Falling back to Wi-Fi.")
+        logger.info("Wi-Fi IP Address: %s", wifiIp)
         return wifiIp
     
     else:
 
-        print("No Ethernet or Wi-Fi network detected on this machine.")
-        print(f"Using default address {default}")
+        logger.warning("No Ethernet or Wi-Fi network detected on this machine.")
+        logger.warning("Using default address %s", default)
         return default
@@ -0,0 +1,144 @@
+import asyncio, logging, zlib
+from . import variables
+from .cayenneDecoder import decodeCayenne
+from .ingestBridge import IngestBridge
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Pool of frame processing workers fed from the ingest bridge
+# Frames are sharded by mac address so every radio always lands on the same worker and keeps its packet order,
+# while a slow frame (decode, database lookup...) only stalls the radios sharing its shard
+# Each shard buffers its frames in its own IngestBridge of shardCapacity frames: the dispatcher never waits on a full
+# shard, the shard applies the ingest overflow policy to its own frames and counts what it dropped or coalesced
+
+logger = logging.getLogger(__name__)
+
+decodeOffloadModes = (None, "thread", "process")
+
+def shardForMac(xbeeMacAddress, shardCount):
+
+    try:
+
+        # Xbee mac addresses are hex strings, their low bits vary even when the manufacturer prefix is shared
+
+        return int(xbeeMacAddress, 16) % shardCount
+
+    except (TypeError, ValueError):
+
+        return zlib.crc32(str(xbeeMacAddress).encode()) % shardCount
+
+class ShardedProcessingStage:
+
+    def __init__(self, frameSource, processFrame, workerCount=None, shardCapacity=None, decodeOffload="default", shardOverflowPolicy=None):
+
+        workerCount = variables.processingWorkers if workerCount is None else workerCount
+        shardCapacity = variables.shardQueueCapacity if shardCapacity is None else shardCapacity
+        shardOverflowPolicy = variables.ingestOverflowPolicy if shardOverflowPolicy is None else shardOverflowPolicy
+        decodeOffload = variables.decodeOffload if decodeOffload == "default" else decodeOffload
+
+        if type(workerCount) is not int or workerCount < 1:
+
+            raise ValueError(f"Processing workers should be a positive integer, got {workerCount}")
+
+        if decodeOffload not in decodeOffloadModes:
+
+            raise ValueError(f"Invalid decode offload {decodeOffload}. Allowed modes: {decodeOffloadModes}")
+
+        self.frameSource = frameSource # Anything with an async get() returning (mac, data, coordinator, receivedAt), e.g. IngestBridge
+        self.processFrame = processFrame # Coroutine function called with (mac, data, coordinator, receivedAt)
+        self.workerCount = workerCount
+        self.decodeOffload = decodeOffload
+
+        self.shardQueues = [IngestBridge(shardCapacity, shardOverflowPolicy) for _ in range(workerCount)]
+        self.processedFrames = [0] * workerCount
+        self.failedFrames = [0] * workerCount
+
+        if decodeOffload == "thread":
+
+            self.executor = ThreadPoolExecutor(max_workers=workerCount, thread_name_prefix="decode")
+
+        elif decodeOffload == "process":
+
+            self.executor = ProcessPoolExecutor(max_workers=workerCount)
+
+        else:
+
+            self.executor = None
+
+    async def decode(self, xbeeDataAsByte, decoder=decodeCayenne):
+
+        # Runs the decoder inline, or in the thread/process pool when decode offload is enabled
+
+        if self.executor is None:
+
+            return decoder(xbeeDataAsByte)
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, decoder, bytes(xbeeDataAsByte))
+
+    async def dispatch(self):
+
+        shardQueues = self.shardQueues
+        shardCount = self.workerCount
+
+        while True:
+
+            frame = await self.frameSource.get()
+
+            # Never waits, a full shard drops or coalesces its own frames while the other shards keep being fed
+
+            shardQueues[shardForMac(frame[0], shardCount)].put(*frame)
+
+    async def worker(self, shardIndex):
+
+        shardQueue = self.shardQueues[shardIndex]
+
+        while True:
+
+            frame = await shardQueue.get()
+
+            try:
+
+                await self.processFrame(*frame)
+
+            except Exception as e:
+
+                self.failedFrames[shardIndex] += 1
+
+                logger.error("Modbus polling error for %s: %s", frame[0], e, exc_info=logger.isEnabledFor(logging.DEBUG), extra={"rateLimitKey": frame[0]})
+
+            finally:
+
+                self.processedFrames[shardIndex] += 1
+
+    async def run(self):
+
+        for shardQueue in self.shardQueues:
+
+            shardQueue.bindLoop()
+
+        try:
+
+            await asyncio.gather(self.dispatch(), *(self.worker(shardIndex) for shardIndex in range(self.workerCount)))
+
+        finally:
+
+            if self.executor is not None:
+
+                self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def shardDepths(self):
+
+        return [shardQueue.qsize() for shardQueue in self.shardQueues]
+
+    def stats(self):
+
+        return {
+
+            "workers": self.workerCount,
+            "decodeOffload": self.decodeOffload,
+            "shardDepths": self.shardDepths(),
+            "processedFrames": list(self.processedFrames),
+            "droppedFrames": [shardQueue.droppedFrames for shardQueue in self.shardQueues],
+            "coalescedFrames": [shardQueue.coalescedFrames for shardQueue in self.shardQueues],
+            "failedFrames": list(self.failedFrames)
+
+        }
@@ -0,0 +1,72 @@
+import csv, json, argparse
+from . import variables
+from .addressIndex import allocationPolicies
+
+# Bulk provisioning of a site's radios from a CSV or JSON file
+# CSV: a header row naming xbeeMac, xbeeNodeIdentifier and optionally modbusStartAddress, or rows in that column order
+# JSON: a list of objects with the same keys, or of [xbeeMac, xbeeNodeIdentifier, modbusStartAddress] lists
+# A missing or empty modbusStartAddress gets the next free block (addressAllocationPolicy, addressAlignment)
+# Run from the project root: python -m modules.radioProvisioning site.csv --dry-run
+
+provisioningColumns = ("xbeeMac", "xbeeNodeIdentifier", "modbusStartAddress")
+
+def rowToRadio(row):
+
+    if isinstance(row, dict):
+
+        return {key: row.get(key) for key in provisioningColumns}
+
+    if isinstance(row, (list, tuple)):
+
+        return dict(zip(provisioningColumns, row))
+
+    return row # Reported as an invalid row by provisionXbeeRadios
+
+def readProvisioningFile(path):
+
+    if str(path).lower().endswith(".json"):
+
+        with open(path, encoding="utf-8") as provisioningFile:
+
+            rows = json.load(provisioningFile)
+
+        return [rowToRadio(row) for row in rows]
+
+    with open(path, newline="", encoding="utf-8-sig") as provisioningFile:
+
+        rows = [row for row in csv.reader(provisioningFile) if any(cell.strip() for cell in row)]
+
+    if rows and "xbeeMac" in (cell.strip() for cell in rows[0]):
+
+        header = [cell.strip() for cell in rows[0]]
+        rows = [dict(zip(header, (cell.strip() for cell in row))) for row in rows[1:]]
+
+    else:
+
+        rows = [[cell.strip() for cell in row] for row in rows]
+
+    return [rowToRadio(row) for row in rows]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Configure a batch of radios from a CSV or JSON file")
+    parser.add_argument("file", help="CSV or JSON file of xbeeMac, xbeeNodeIdentifier and optional modbusStartAddress")
+    parser.add_argument("-p", "--policy", choices=allocationPolicies, default=None, help=f"Block allocation policy, default {variables.addressAllocationPolicy}")
+    parser.add_argument("-a", "--alignment", type=int, default=None, help="Alignment of automatically picked start addresses, default addressAlignment")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Validate and allocate without storing anything")
+    args = parser.parse_args()
+
+    # Imported here so reading the file and --help work without a database connection
+    from .dbIntegration import provisionXbeeRadios
+
+    result = provisionXbeeRadios(readProvisioningFile(args.file), policy=args.policy, alignment=args.alignment, dryRun=args.dry_run)
+
+    for radio in result.get("configured", []):
+
+        print (f"{radio['xbeeMac']}  {radio['xbeeNodeIdentifier']:<20}{radio['modbusStartAddress']:>6} - {radio['modbusEndAddress']:<6} unit {radio['modbusUnitId']}")
+
+    for rowError in result.get("errors", []):
+
+        print (f"row {rowError['row']}: {rowError['xbeeMac']}: {rowError['error']}")
+
+    print (result.get("success") or result.get("error"))
@@ -0,0 +1,202 @@
+import time, logging, threading
+from . import variables
+from .modbus import ChannelLayout, buildRegisterEncoder, validateRegisterLayout, validateRegisterProfile
+from .downlink import controlRange
+
+logger = logging.getLogger(__name__)
+
+# In memory map of configured radios so the packet hot path never has to query mongodb
+# Entries are the configuredRadio documents (without _id) keyed by the normalised mac address, plus the radio's
+# compiled registerEncoder (kept across reloads while its encoderSpec is unchanged), in channel layout mode its
+# channelLayout, and with the downlink on its controlRange
+# Unknown mac addresses are remembered for unknownRadioCacheTtl seconds so a rogue radio cannot hammer the database
+
+def normaliseMac(xbeeMacAddress):
+
+    return str(xbeeMacAddress).strip().upper()
+
+class RoutingCache:
+
+    def __init__(self, negativeTtl=None):
+
+        self.negativeTtl = variables.unknownRadioCacheTtl if negativeTtl is None else negativeTtl
+        self.loaded = False
+        self.lastResync = None
+
+        self._routes = {}
+        self._unknownMacs = {} # mac address -> monotonic time the negative entry expires
+        self._lock = threading.Lock()
+
+    def load(self, configuredRadios):
+
+        # Replace the whole table in one assignment so readers never see a half built map
+
+        routes = {}
+
+        for radio in configuredRadios:
+
+            route = self._buildRoute(radio)
+
+            if route is not None:
+
+                routes[route["xbeeMac"]] = route
+
+        with self._lock:
+
+            self._routes = routes
+            now = time.monotonic()
+            self._unknownMacs = {mac: expiry for mac, expiry in self._unknownMacs.items() if expiry > now and mac not in routes}
+            self.loaded = True
+            self.lastResync = time.time()
+
+        return len(routes)
+
+    def _buildRoute(self, radio):
+
+        if not radio or radio.get("xbeeMac") is None or radio.get("modbusStartAddress") is None:
+
+            return None
+
+        route = {key: value for key, value in radio.items() if key != "_id"}
+        route["xbeeMac"] = normaliseMac(radio["xbeeMac"])
+        route["modbusStartAddress"] = int(radio["modbusStartAddress"])
+
+        if route.get("modbusEndAddress") is not None:
+
+            route["modbusEndAddress"] = int(route["modbusEndAddress"])
+
+        if route.get("modbusUnitId") is not None:
+
+            route["modbusUnitId"] = int(route["modbusUnitId"])
+
+        # The register encoder is compiled here, once per radio and routing cache load, instead of per packet
+        # It fills the radio's whole block: its unit's registers in unitId mode, start to end address otherwise
+
+        if variables.modbusAddressingMode == "unitId":
+
+            blockRegisters = variables.unitRegisterCount
+
+        else:
+
+            blockRegisters = route.get("modbusEndAddress", route["modbusStartAddress"] + variables.incrementalModbusAddress - 1) - route["modbusStartAddress"] + 1
+
+        # Control and status registers of the downlink end the block, the values are encoded into the registers before them
+
+        route["controlRange"] = controlRange(route, blockRegisters)
+
+        if route["controlRange"] is not None:
+
+            blockRegisters = route["controlRange"][0]
+
+        profile = route.get("encoding")
+        profileError = validateRegisterProfile(profile) if profile else None
+
+        if profileError:
+
+            logger.warning("Ignoring the register encoding of %s: %s", route["xbeeMac"], profileError)
+            profile = None
+
+        route["encoderSpec"] = (profile, max(2, blockRegisters)) # What the encoder was built from, compared on reload
+        previousRoute = self._routes.get(route["xbeeMac"])
+        sameEncoder = previousRoute is not None and previousRoute.get("encoderSpec") == route["encoderSpec"]
+        route["registerEncoder"] = previousRoute["registerEncoder"] if sameEncoder else buildRegisterEncoder(profile, max(2, blockRegisters))
+
+        if variables.registerLayoutMode == "channel":
+
+            # A layout learned but not stored yet is carried over from the radio's previous route
+
+            registerLayout = route.get("registerLayout")
+            layoutError = validateRegisterLayout(registerLayout) if registerLayout is not None else None
+            previousLayout = previousRoute.get("channelLayout") if previousRoute else None
+
+            if layoutError:
+
+                logger.warning("Ignoring the register layout of %s: %s", route["xbeeMac"], layoutError)
+                registerLayout = None
+
+            if not registerLayout:
+
+                registerLayout = previousLayout.entries if previousLayout else []
+
+            if sameEncoder and previousLayout is not None and [list(entry) for entry in registerLayout] == previousLayout.entries:
+
+                # Resync of an unchanged radio: the layout keeps its latest values and the registers as last written,
+                # a frame leaving channels out does not overwrite them with NaN and the block is not rewritten in full
+
+                route["channelLayout"] = previousLayout
+
+            else:
+
+                route["channelLayout"] = ChannelLayout(registerLayout, route["registerEncoder"])
+
+        return route
+
+    def updateRoute(self, radio):
+
+        route = self._buildRoute(radio)
+
+        if route is None:
+
+            return None
+
+        with self._lock:
+
+            self._routes[route["xbeeMac"]] = route
+            self._unknownMacs.pop(route["xbeeMac"], None)
+
+        return route
+
+    def removeRoute(self, xbeeMacAddress):
+
+        with self._lock:
+
+            return self._routes.pop(normaliseMac(xbeeMacAddress), None)
+
+    def lookupRoute(self, xbeeMacAddress):
+
+        return self._routes.get(normaliseMac(xbeeMacAddress))
+
+    def claimLookup(self, xbeeMacAddress):
+
+        # Returns True when the caller should confirm an unknown mac address against the database
+        # The negative entry is renewed before the query so concurrent packets from the same radio do not query again
+
+        xbeeMacAddress = normaliseMac(xbeeMacAddress)
+        now = time.monotonic()
+
+        with self._lock:
+
+            if xbeeMacAddress in self._routes:
+
+                return False
+
+            if self._unknownMacs.get(xbeeMacAddress, 0) > now:
+
+                return False
+
+            self._unknownMacs[xbeeMacAddress] = now + self.negativeTtl
+
+        return True
+
+    def markUnknown(self, xbeeMacAddress):
+
+        with self._lock:
+
+            self._unknownMacs[normaliseMac(xbeeMacAddress)] = time.monotonic() + self.negativeTtl
+
+    def routes(self):
+
+        return list(self._routes.values())
+
+    def stats(self):
+
+        return {
+
+            "loaded": self.loaded,
+            "routes": len(self._routes),
+            "unknownMacs": len(self._unknownMacs),
+            "lastResync": self.lastResync
+
+        }
+
+routingCache = RoutingCache()
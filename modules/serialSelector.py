@@ -1,10 +1,11 @@
 from . import variables
-from functools import partial
-from datetime import datetime
-from digi.xbee.devices import XBeeDevice
-import serial, argparse, sys, serial.tools.list_ports
+import serial, argparse, sys, logging, serial.tools.list_ports
 
-def selectUsbPort(get=False):
+logger = logging.getLogger(__name__)
+
+def selectUsbPort(get=False, serialNumber=None):
+
+    serialNumber = variables.prefferedRadioSerialNumber if serialNumber is None else serialNumber
 
     selectedPort = None
 
@@ -28,7 +29,7 @@ def selectUsbPort(get=False):
                 sys.exit(0) 
             
             # Select the first port number that matches the serial number which idealy would be only one
-            selectedPort = next((retrievedPort["port"] for retrievedPort in usbPorts if variables.prefferedRadioSerialNumber in retrievedPort.get("hwid")), None)
+            selectedPort = next((retrievedPort["port"] for retrievedPort in usbPorts if serialNumber in retrievedPort.get("hwid")), None)
         
         if selectedPort:
 
@@ -36,65 +37,26 @@ def selectUsbPort(get=False):
         
         else: 
 
-            txt = "run 'python -m modules.serialSelector -g' to retrieve connected port serial number and add replace in variable.py file"
-            print(txt)
+            # Called again every coordinatorReconnectInterval while the radio is missing, the hint is rate limited
+
+            logger.warning("No serial port matches %s, run 'python -m modules.serialSelector -g' to retrieve connected port serial number and add replace in variable.py file", serialNumber, extra={"rateLimitKey": serialNumber})
             return None
  
     except KeyboardInterrupt:
 
-        txt = "Operation interrupted by the user."
-        print(txt)
+        logger.warning("Operation interrupted by the user.")
         return None
     
     except serial.SerialException as se:
 
-        txt = f"Serial port error: {se}"
-        print(txt)
+        logger.error("Serial port error: %s", se, extra={"rateLimitKey": serialNumber})
         return None
     
     except Exception as e:
 
-        txt = f"Error while selecting serial port: {str(e)}"
-        print(txt)
+        logger.error("Error while selecting serial port: %s", e, extra={"rateLimitKey": serialNumber})
         return None
     
-def handleUsbDisconnection(err, xbeeQueue=None,xbeeObject=None):
-
-    usbDetected = False
-    variables.radioFlag = False
-
-    xbeeObject.close()
-    def dataReceiveCallback(xbeeMessage):
-
-            xbeeMacAddress = str(xbeeMessage.remote_device.get_64bit_addr())
-            timestamp = datetime.fromtimestamp(xbeeMessage.timestamp)
-            xbeeDataAsByte = xbeeMessage.data
-
-            if str(xbeeMacAddress) not in variables.knownXbeeAddress:
-
-                print (f"\nNew XBee Address Discovered: {xbeeMacAddress}")
-
-                variables.knownXbeeAddress.append(str(xbeeMacAddress))
-
-                print (f"List of addresses discovered so far are: {variables.knownXbeeAddress}\n")
-
-            print(f"Received data from {xbeeMacAddress} are: {xbeeDataAsByte}\n")
-            xbeeQueue.put_nowait((xbeeMacAddress, xbeeDataAsByte))
-
-    while not usbDetected:
-
-        detectPort = selectUsbPort()
-
-        if detectPort is not None:
-
-            usbDetected = True
-            xbee = XBeeDevice(detectPort, variables.xbeeBaudRate)
-            xbee.open()
-            xbee.add_data_received_callback(dataReceiveCallback)
-            xbee.add_error_callback(partial(handleUsbDisconnection, xbeeObject=variables.xbeeInstance))
-
-            print (f"usb connected- {detectPort}")
-
 def radioConnectionStatus():
 
     return variables.radioFlag
@@ -0,0 +1,176 @@
+import math, time, asyncio, logging, threading
+from array import array
+from . import variables
+from .modbus import RegisterEncoder
+
+logger = logging.getLogger(__name__)
+
+# Hot summary block: selected channels of every radio plus a status word, in consecutive registers of the shared map
+# so a SCADA master reads the whole fleet in a few 125 register requests instead of one request per radio block
+# Each radio owns one slot, the slot number is its block number in the map ((modbusStartAddress - lowestRegister) //
+# incrementalModbusAddress), so slots stay put as other radios are added or removed and unused slots read as 0
+# Blocks smaller than or not aligned to incrementalModbusAddress can share a slot, the radio with the lowest
+# modbusStartAddress keeps it and the others are logged and not summarised
+# A slot is the status word followed by the summaryChannels values as floats in the register map's word order:
+#   bit 15     fresh, a frame was received within summaryStaleAfter seconds
+#   bit 14     configured, a radio owns the slot
+#   bits 0-13  frames received from the radio, wrapping at 16384
+# Channels are indexes into the radio's flattened sensor values, a channel the radio does not send reads as NaN
+
+freshBit = 0x8000
+configuredBit = 0x4000
+counterMask = 0x3FFF
+
+def summarySlotSize(channels=None):
+
+    return 1 + 2 * len(variables.summaryChannels if channels is None else channels)
+
+def summaryRegisterCount(channels=None, maxRadios=None):
+
+    return (variables.summaryMaxRadios if maxRadios is None else maxRadios) * summarySlotSize(channels)
+
+def summarySlot(route):
+
+    return (route["modbusStartAddress"] - variables.lowestRegister) // variables.incrementalModbusAddress
+
+class SummaryBlock:
+
+    def __init__(self, registerImage, startAddress=None, channels=None, maxRadios=None, staleAfter=None):
+
+        self.registerImage = registerImage
+        self.startAddress = variables.summaryStartAddress if startAddress is None else startAddress
+        self.channels = list(variables.summaryChannels if channels is None else channels)
+        self.maxRadios = variables.summaryMaxRadios if maxRadios is None else maxRadios
+        self.staleAfter = variables.summaryStaleAfter if staleAfter is None else staleAfter
+        self.slotSize = summarySlotSize(self.channels)
+        self.registerCount = summaryRegisterCount(self.channels, self.maxRadios)
+
+        if self.startAddress < 0 or self.startAddress + self.registerCount > registerImage.registerCount:
+
+            raise ValueError(f"Summary block {self.startAddress} to {self.startAddress + self.registerCount - 1} is outside the {registerImage.registerCount} register image")
+
+        self._encoder = RegisterEncoder(maxValues=len(self.channels))
+        self._slots = {} # mac address -> slot
+        self._status = {} # slot -> status word as last written
+        self._lastFrame = {} # slot -> monotonic time of the radio's last frame
+        self._lock = threading.Lock() # sync runs on dbIntegration worker threads, frames on the event loop
+
+    def sync(self, routes):
+
+        # Reassigns the slots from the routing table, slots no radio owns any more are zeroed
+
+        slots = {}
+        slotOwners = {} # slot -> route of the radio owning it
+
+        for route in sorted(routes, key=lambda route: route["modbusStartAddress"]):
+
+            slot = summarySlot(route)
+
+            if slot in slotOwners:
+
+                logger.warning("Radio %s at register %s shares summary slot %d with %s at register %s, it is not summarised", route["xbeeMac"], route["modbusStartAddress"], slot, slotOwners[slot]["xbeeMac"], slotOwners[slot]["modbusStartAddress"], extra={"rateLimitKey": route["xbeeMac"]})
+
+            elif 0 <= slot < self.maxRadios:
+
+                slots[route["xbeeMac"]] = slot
+                slotOwners[slot] = route
+
+            else:
+
+                logger.warning("Radio %s at register %s is past the %d radio summary block, it is not summarised", route["xbeeMac"], route["modbusStartAddress"], self.maxRadios, extra={"rateLimitKey": route["xbeeMac"]})
+
+        with self._lock:
+
+            usedSlots = set(slots.values())
+
+            for slot in set(self._status) - usedSlots:
+
+                del self._status[slot]
+                self._lastFrame.pop(slot, None)
+                self.registerImage.write(self.startAddress + slot * self.slotSize, array("H", bytes(2 * self.slotSize)))
+
+            for slot in usedSlots - set(self._status):
+
+                self._writeStatus(slot, configuredBit)
+
+            self._slots = slots
+
+        return len(slots)
+
+    def _writeStatus(self, slot, status):
+
+        self._status[slot] = status
+        self.registerImage.write(self.startAddress + slot * self.slotSize, array("H", (status,)))
+
+    def recordFrame(self, xbeeMacAddress):
+
+        # Every frame counts, including the ones change detection skips, so the counter shows the radio is alive
+
+        slot = self._slots.get(xbeeMacAddress)
+
+        if slot is None:
+
+            return
+
+        with self._lock:
+
+            status = self._status.get(slot, configuredBit)
+            self._lastFrame[slot] = time.monotonic()
+            self._writeStatus(slot, freshBit | configuredBit | ((status + 1) & counterMask))
+
+    def updateValues(self, xbeeMacAddress, sensorValues):
+
+        slot = self._slots.get(xbeeMacAddress)
+
+        if slot is None or not self.channels:
+
+            return
+
+        channelValues = [sensorValues[channel] if channel < len(sensorValues) else math.nan for channel in self.channels]
+        self.registerImage.write(self.startAddress + slot * self.slotSize + 1, self._encoder.encode(channelValues))
+
+    def refresh(self):
+
+        # Clears the fresh bit of radios silent for more than staleAfter seconds, returns the number of fresh radios
+
+        staleBefore = time.monotonic() - self.staleAfter
+        freshRadios = 0
+
+        with self._lock:
+
+            for slot, status in list(self._status.items()):
+
+                if not status & freshBit:
+
+                    continue
+
+                if self._lastFrame.get(slot, 0) < staleBefore:
+
+                    self._writeStatus(slot, status & ~freshBit)
+
+                else:
+
+                    freshRadios += 1
+
+        return freshRadios
+
+    async def run(self):
+
+        while True:
+
+            await asyncio.sleep(variables.summaryRefreshInterval)
+
+            self.refresh()
+
+    def stats(self):
+
+        statuses = list(self._status.values())
+
+        return {
+
+            "startAddress": self.startAddress,
+            "registerCount": self.registerCount,
+            "radios": len(statuses),
+            "freshRadios": sum(1 for status in statuses if status & freshBit)
+
+        }
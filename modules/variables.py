@@ -1,19 +1,102 @@
 # prefferedRadioSerialNumber = "SER=AQ016E77"
 # prefferedRadioSerialNumber = "SER=AQ015ZB9"
 prefferedRadioSerialNumber = "SER=A10NX8UT"
+coordinatorRadios = [] # Serial numbers ("SER=...") or ports of every coordinator radio, empty uses prefferedRadioSerialNumber only
+coordinatorReconnectInterval = 5 # Seconds between attempts to reopen a missing coordinator radio
 xbeeBaudRate = 9600
 modbusPort = 5020
 validMacAddressLength = 16
-validModbusAddressLength = 3
+validModbusAddressLength = 5 # Digits of a modbus start address, 5 covers the whole 16-bit register space
 incrementalModbusAddress = 50
-lowestRegister = 0
-highestRegister = 1000 - incrementalModbusAddress
+addressAllocationPolicy = "firstFit" # firstFit or bestFit, how a free block is picked for radios configured without a start address
+addressAlignment = None # Automatically picked start addresses are multiples of this from lowestRegister, None uses incrementalModbusAddress
+lowestRegister = 0 # Lowest register a radio block may start at
+highestRegister = 65535 # Highest register a radio block may end at, the last register of the 16-bit modbus address space
+modbusRegisterCount = 65536 # Size of the holding and input register image, pages are only allocated where radios write
+registerPageSize = 256 # Registers per page of the register image, a power of two
+modbusAddressingMode = "shared" # shared maps every radio into one register space at its modbusStartAddress, unitId serves each radio as its own modbus unit id with its block at register 0
+unitRegisterCount = 64 # Registers of each radio's block in unitId mode
+registerLayoutMode = "channel" # channel keeps each cayenne channel at fixed registers and writes only changed channels, positional writes the values in payload order
+summaryBlockEnabled = False # Keep a contiguous summary block (status word and summaryChannels of every radio) in the shared register map
+summaryStartAddress = 60000 # First register of the summary block, radio blocks may not overlap it
+summaryChannels = [0, 1] # Indexes of the flattened sensor values copied into the summary block, two registers (float) each
+summaryMaxRadios = 1000 # Summary slots, radio blocks past slot summaryMaxRadios - 1 are not summarised
+summaryStaleAfter = 600 # Seconds without a frame after which a radio's fresh bit is cleared
+summaryRefreshInterval = 5 # Seconds between checks for stale radios
+downlinkEnabled = False # Send client writes to the control registers at the end of each radio's block back to the radio
+downlinkControlOffset = 40 # First control register in a radio's block, its values are encoded into the registers before it
+downlinkControlCount = 5 # Control registers per radio, followed by as many delivery status registers
+downlinkMinInterval = 2 # Seconds between two transmissions to the same radio, writes made meanwhile are coalesced
+downlinkChannelBase = 100 # Cayenne channel of a radio's first control register, the next ones follow
+downlinkLppType = 0x03 # Cayenne type the control values are sent as (Analog Output), the register holds its raw value
+sharedInputRegisters = True # Input registers (FC4) read the holding register image instead of a copy of it
+registerWordOrder = "little" # Word order of float registers, little puts the low word first
+registerByteOrder = "big" # Byte order inside each register, big keeps the natural 16-bit value
+processingWorkers = 4 # Frame processing workers, frames are sharded by mac address so per radio order is kept
+shardQueueCapacity = 500 # Frames waiting per processing worker, a full shard applies ingestOverflowPolicy to its own frames without holding back the others
+decodeOffload = None # None decodes on the event loop, "thread" or "process" moves cayenne decoding to a worker pool
+changeDetectionEnabled = True # Skip modbus and history writes for repeated frames and changes within a radio's deadbands
+maxSilenceHeartbeat = 300 # Seconds after which a radio's registers and history are written even if nothing changed
+ingestQueueCapacity = 2000 # Maximum number of frames waiting between the xbee reader thread and modbus processing
+ingestOverflowPolicy = "dropOldest" # dropOldest, dropNewest or coalesce (keep only the newest waiting frame per mac address)
+routingCacheResyncInterval = 60 # Seconds between full reloads of the in memory radio routing table
+unknownRadioCacheTtl = 30 # Seconds an unconfigured mac address is remembered before the database is asked again
+historyStorageMode = "perRadio" # perRadio keeps a collection per mac address, timeSeries one mongodb time series collection (MongoDB 5.0+), hourBuckets one document per radio and hour
+historyCollectionName = "radioHistory" # History collection of the timeSeries and hourBuckets modes
+historyTimeSeriesGranularity = "seconds" # Bucketing hint of the time series collection, seconds, minutes or hours by how often radios send
+rollupEnabled = True # Roll history up into 1 minute, 1 hour and 1 day min/max/avg/count summaries per radio and channel in the background
+rollupInterval = 60 # Seconds between rollup passes once the backlog is rolled up
+rollupBatchSize = 5000 # Raw history documents read per radio in one rollup pass
+rollupSettleDelay = 10 # Seconds a history document waits before it is rolled up, so inserts still in flight are not skipped
+rollupLookback = 300 # Seconds of history summarized again on every pass, documents given an _id below a radio's watermark (other processes, clock steps) within it still reach the rollups
+rollupCollectionPrefix = "radioRollup" # Rollup collections are radioRollup1m, radioRollup1h and radioRollup1d
+rawHistoryRetentionDays = None # Days raw history is kept before mongodb expires it, None keeps it forever
+rollupRetentionDays = {"1m": 30, "1h": 730, "1d": None} # Days each rollup tier is kept, None keeps it forever
+historyBatchSize = 500 # Maximum history documents written to mongodb in one flush
+historyFlushInterval = 2 # Seconds the oldest waiting history document may wait before a flush is forced
+historyMaxBacklog = 20000 # History documents kept in memory while mongodb is slow, oldest are dropped beyond this
+metricsEnabled = True # Serve gateway metrics in the Prometheus text format
+metricsAddress = "127.0.0.1" # Interface the unauthenticated metrics endpoint listens on, set "0.0.0.0" or a plant network address to let a remote Prometheus scrape it
+metricsPort = 9108 # Port of the metrics endpoint, scraped on /metrics
+metricsPerRadio = True # Per mac address packet counters and last seen times, disable to limit series with very large fleets
+historySpoolEnabled = True # Write history to a local sqlite spool first and drain it to mongodb in the background
+historySpoolPath = "historySpool.sqlite" # Spool database under the working directory
+historySpoolMaxDocuments = 2000000 # History documents kept in the spool while mongodb is unreachable (roughly 100 bytes each)
+historySpoolEvictionPolicy = "dropOldest" # dropOldest or dropNewest once the spool is full
+historySpoolDrainInterval = 1 # Seconds between drain attempts once the spool is empty
+historySpoolMaxRetryInterval = 60 # Longest wait between drain attempts while mongodb keeps failing
+captureEnabled = False # Record every received frame to raw capture files for replay with python -m modules.frameReplay
+captureDirectory = "captures" # Directory of the frame capture files
+captureMaxBytes = 64 * 1024 * 1024 # Size at which a new capture file is started
+captureMaxFiles = 20 # Capture files kept, the oldest are deleted
+captureIndexInterval = 1000 # Frames between index records of a capture file
+captureFlushInterval = 1 # Seconds between writes of captured frames to disk
+captureMaxBuffer = 8 * 1024 * 1024 # Bytes of captured frames buffered in memory while the disk is slow, newer frames are dropped beyond this
+logFile = "corsGateway.log" # Rotating log file of the gateway, empty string logs to the console only
+logLevel = "INFO" # Gateway log level, DEBUG adds per packet details (received bytes, decoded values)
+logLevels = {} # Per module levels overriding logLevel, e.g. {"modules.ingestBridge": "DEBUG"}
+logToConsole = False # Also write log records to stdout (captured by the systemd unit)
+logMaxBytes = 5 * 1024 * 1024 # Size at which the log file is rotated
+logBackupCount = 5 # Rotated log files kept next to the current one
+logRateLimitInterval = 60 # Seconds between repeated messages about the same mac address, 0 disables rate limiting
+logRateLimitKeys = 10000 # Rate limited message keys remembered before quiet ones are forgotten
 # xbeeDataAsByte = None # not used
 knownXbeeAddress = []
 # xbeeAddressModbusMap = {} # not used
 # nextModbusAddressStart = 0
 # xbeeMacAndDataMap = {}
-xbeeInstance = None # Holds the current xbee object instance
+coordinators = [] # Holds the Coordinator objects of every configured coordinator radio
 xbeePollingTask = None # Holds the current polling task
+historyWriter = None # Holds the background history writer once the gateway is running
+processingStage = None # Holds the sharded frame processing stage once the gateway is running
+registerImage = None # Holds the holding and input register image once the modbus context is created
+deviceContexts = None # Holds the per radio modbus unit contexts when modbusAddressingMode is unitId
+summaryBlock = None # Holds the hot summary block when summaryBlockEnabled is set
+downlink = None # Holds the downlink queue sending client writes to the radios when downlinkEnabled is set
+databaseSchemaVersion = None # Holds the database schema version reached by the bootstrap in this process
+historySpool = None # Holds the history spool when historySpoolEnabled is set
+rollupEngine = None # Holds the background history rollup engine when rollupEnabled is set
+spoolDrainer = None # Holds the background task moving the spool to mongodb
+frameCapture = None # Holds the frame capture writer when captureEnabled is set
 data_callback = None
 radioFlag = None
\ No newline at end of file
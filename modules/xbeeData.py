@@ -1,7 +1,10 @@
 from digi.xbee.devices import RemoteXBeeDevice, XBee64BitAddress
-from python_cayennelpp.decoder import decode
+from .cayenneDecoder import decodeCayenneValues
 from .dbIntegration import storeXbeeHistoryData
-import datetime
+from . import variables
+import datetime, logging
+
+logger = logging.getLogger(__name__)
 
 
 # def getNodeId(macAddress, initializedXbee):
@@ -21,25 +24,29 @@ import datetime
 
 #     return "UNKNOWN"
 
-async def cayenneParse(xbeeMacAddress,xbeeByteData):
+def storeSensorValues(xbeeMacAddress, sensorValues, receivedAt=None):
+
+    # Hand the sample to the background history writer when it is running so the event loop never waits on mongodb
+    # receivedAt is the radio timestamp of the frame, replayed captures keep their original history times
 
-    # Convert bytes payload to hex string
-    hexConversion = xbeeByteData.hex()
-    
-    convertedHexValues = decode(hexConversion)
+    timestamp = datetime.datetime.now() if receivedAt is None else datetime.datetime.fromtimestamp(receivedAt)
 
-    sensorValues = []
+    if variables.historyWriter is not None:
 
-    for item in convertedHexValues:
+        variables.historyWriter.submit(str(xbeeMacAddress), sensorValues, timestamp)
 
-        value = item.get("value")  # Extract the value section from the item
+    else:
+
+        storeXbeeHistoryData(str(xbeeMacAddress), sensorValues, timestamp)
+
+async def cayenneParse(xbeeMacAddress,xbeeByteData):
 
-        if value is not None:
+    # Decode the cayenne records straight from the received bytes, multi value types (gps, accelerometer...) are flattened
 
-            sensorValues.append(float(value))  # Add float values to the list
+    sensorValues = decodeCayenneValues(xbeeByteData)
 
-    storeXbeeHistoryData(str(xbeeMacAddress), sensorValues, datetime.datetime.now())
+    storeSensorValues(xbeeMacAddress, sensorValues)
 
-    print(f"List of values extracted from {xbeeMacAddress} byte array are: {sensorValues}\n")
+    logger.debug("List of values extracted from %s byte array are: %s", xbeeMacAddress, sensorValues)
 
     return sensorValues
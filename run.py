@@ -1,10 +1,18 @@
 import asyncio
 from modules import variables
 from modules.main import startProcess
+from modules.gatewayLogging import setupLogging, stopLogging
 
+async def closeCoordinators():
+
+    # Each coordinator closes its own serial port, reconnects are handled by Coordinator while the gateway runs
+
+    await asyncio.gather(*(coordinator.disconnect() for coordinator in variables.coordinators))
 
 if __name__ == "__main__":
 
+    setupLogging()
+
     try:
 
         asyncio.run(startProcess())
@@ -19,6 +27,14 @@ if __name__ == "__main__":
 
     finally:
 
-        if variables.xbeeInstance is not None and variables.xbeeInstance.is_open():
+        asyncio.run(closeCoordinators())
+
+        if variables.historySpool is not None:
+
+            variables.historySpool.close()
+
+        if variables.frameCapture is not None:
+
+            variables.frameCapture.close()
 
-            variables.xbeeInstance.close()
\ No newline at end of file
+        stopLogging()
\ No newline at end of file
@@ -0,0 +1,6 @@
+import os, sys
+
+# Tests import the gateway modules and the benchmark stand ins (simulated coordinator, fake transmit device) from the project root
+# Run from the project root: python -m pytest -q tests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
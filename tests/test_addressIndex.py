@@ -0,0 +1,170 @@
+import random
+import pymongo
+from pymongo.errors import PyMongoError
+from modules import variables, dbIntegration
+from modules.addressIndex import AddressIndex
+
+# Address index of the configured radio ranges, its gap diffs and their persistence to availableModbusAddress
+
+def makeIndex(radios=()):
+
+    addressIndex = AddressIndex(lowestRegister=0, highestRegister=99)
+    addressIndex.load(radios)
+
+    return addressIndex
+
+def test_gap_changes_are_the_difference_between_the_gaps_before_and_after():
+
+    randomGenerator = random.Random(7)
+    addressIndex = makeIndex()
+
+    for step in range(50):
+
+        gapsBefore = set(addressIndex.gaps())
+
+        for change in range(randomGenerator.randrange(1, 5)):
+
+            mac = f"0013A2004100000{randomGenerator.randrange(6)}"
+            startAddress = randomGenerator.randrange(0, 100, 10)
+
+            if randomGenerator.random() < 0.3:
+
+                addressIndex.remove(mac)
+
+            elif addressIndex.overlapping(startAddress, startAddress + 9, mac) is None:
+
+                addressIndex.add(startAddress, startAddress + 9, mac)
+
+        removedGaps, addedGaps = addressIndex.takeGapChanges()
+
+        assert (gapsBefore - set(removedGaps)) | set(addedGaps) == set(addressIndex.gaps())
+        assert not set(removedGaps) & set(addedGaps)
+
+def test_adding_and_removing_a_range_splits_and_merges_its_gap():
+
+    addressIndex = makeIndex([{"xbeeMac": "0013a20041000001", "modbusStartAddress": 40, "modbusEndAddress": 59}])
+
+    assert addressIndex.gaps() == [(0, 39), (60, 99)]
+
+    addressIndex.add(10, 19, "0013A20041000002")
+
+    assert addressIndex.takeGapChanges() == ([(0, 39)], [(0, 9), (20, 39)])
+
+    addressIndex.remove("0013A20041000001")
+
+    removedGaps, addedGaps = addressIndex.takeGapChanges()
+
+    assert sorted(removedGaps) == [(20, 39), (60, 99)]
+    assert addedGaps == [(20, 99)]
+
+    # Moved and moved back, nothing to persist
+
+    addressIndex.add(70, 79, "0013A20041000002")
+    addressIndex.add(10, 19, "0013A20041000002")
+
+    assert addressIndex.takeGapChanges() == ([], [])
+
+def test_overlap_checks_and_allocation():
+
+    addressIndex = makeIndex([{"xbeeMac": "0013A20041000001", "modbusStartAddress": 0, "modbusEndAddress": 19}, {"xbeeMac": "0013A20041000002", "modbusStartAddress": 50, "modbusEndAddress": 59}])
+
+    assert addressIndex.overlapping(15, 25) == "0013A20041000001"
+    assert addressIndex.overlapping(20, 49) is None
+    assert addressIndex.overlapping(55, 55, excludeMac="0013A20041000002") is None
+
+    assert addressIndex.allocate(10, policy="firstFit", alignment=10) == 20
+    assert addressIndex.allocate(30, policy="firstFit", alignment=10) == 20
+    assert addressIndex.allocate(10, policy="bestFit", alignment=10) == 20
+    assert addressIndex.allocate(35, policy="bestFit", alignment=5) == 60
+    assert addressIndex.allocate(10, policy="firstFit", alignment=10, reservedRanges=[(20, 49)]) == 60
+    assert addressIndex.allocate(50, policy="firstFit", alignment=10) is None
+
+class GapCollection:
+
+    # availableModbusAddress stand in applying InsertOne and DeleteMany, counting the bulk_write calls
+
+    def __init__(self, documents=()):
+
+        self.documents = list(documents)
+        self.bulkWrites = 0
+        self.failNext = False
+
+    def find(self, query=None, projection=None):
+
+        return [{"modbusAddressRange": document["modbusAddressRange"]} for document in self.documents]
+
+    def bulk_write(self, operations, ordered=True):
+
+        self.bulkWrites += 1
+
+        if self.failNext:
+
+            self.failNext = False
+
+            raise PyMongoError("connection lost")
+
+        for operation in operations:
+
+            if isinstance(operation, pymongo.DeleteMany):
+
+                removed = set(operation._filter["modbusAddressRange"]["$in"])
+                self.documents = [document for document in self.documents if document["modbusAddressRange"] not in removed]
+
+            else:
+
+                self.documents.append(operation._doc)
+
+    def ranges(self):
+
+        return sorted(document["modbusAddressRange"] for document in self.documents)
+
+def test_gaps_are_persisted_with_one_bulk_write_diff(monkeypatch):
+
+    monkeypatch.setattr(variables, "incrementalModbusAddress", 20)
+
+    addressIndex = makeIndex([{"xbeeMac": "0013A20041000001", "modbusStartAddress": 20, "modbusEndAddress": 39}])
+    gapCollection = GapCollection([{"modbusAddressRange": "0-19"}, {"modbusAddressRange": "0-99"}])
+    monkeypatch.setattr(dbIntegration, "addressIndex", addressIndex)
+    monkeypatch.setattr(dbIntegration, "availableModbusAddressCollection", gapCollection)
+
+    # After a load the stored gaps are diffed in full, the gap already stored is kept
+
+    dbIntegration.updateReusableAddress()
+
+    assert gapCollection.ranges() == ["0-19", "40-99"]
+    assert gapCollection.bulkWrites == 1
+
+    # Then only the gaps changed since
+
+    addressIndex.add(60, 79, "0013A20041000002")
+    dbIntegration.updateReusableAddress()
+
+    assert gapCollection.ranges() == ["0-19", "40-59", "80-99"]
+    assert gapCollection.bulkWrites == 2
+    assert [document["consumable"] for document in gapCollection.documents if document["modbusAddressRange"] == "40-59"] == ["✅"]
+
+    # Nothing changed, nothing written
+
+    dbIntegration.updateReusableAddress()
+
+    assert gapCollection.bulkWrites == 2
+
+def test_a_failed_persist_is_healed_by_a_full_diff(monkeypatch):
+
+    addressIndex = makeIndex()
+    gapCollection = GapCollection([{"modbusAddressRange": "0-99"}])
+    monkeypatch.setattr(dbIntegration, "addressIndex", addressIndex)
+    monkeypatch.setattr(dbIntegration, "availableModbusAddressCollection", gapCollection)
+
+    dbIntegration.updateReusableAddress()
+    addressIndex.add(0, 19, "0013A20041000001")
+    gapCollection.failNext = True
+
+    assert "error" in dbIntegration.updateReusableAddress()
+    assert addressIndex.fullSyncNeeded
+
+    addressIndex.add(40, 59, "0013A20041000002")
+    dbIntegration.updateReusableAddress()
+
+    assert gapCollection.ranges() == ["20-39", "60-99"]
+    assert not addressIndex.fullSyncNeeded
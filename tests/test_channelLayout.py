@@ -0,0 +1,90 @@
+from modules.modbus import ChannelLayout, RegisterEncoder, floatToRegisters
+
+# Channel keyed register layouts: fixed registers per (channel, type), only the changed channels are written
+# The encoders use the word order of floatToRegisters, low word first
+
+def makeLayout(registerLayout, maxValues=10):
+
+    return ChannelLayout(registerLayout, RegisterEncoder(maxValues=maxValues, wordOrder="little", byteOrder="big"))
+
+def writes(channelLayout):
+
+    return [(offset, list(registers)) for offset, registers in channelLayout.changedRanges()]
+
+def test_first_write_covers_the_block_and_unseen_channels_read_as_nan():
+
+    channelLayout = makeLayout([[1, 103], [2, 104], [3, 2]])
+    channelLayout.update([(2, 104, 40.0)])
+
+    [(offset, registers)] = writes(channelLayout)
+
+    assert offset == 0
+    assert registers[2:4] == list(floatToRegisters(40.0))
+    assert registers[0:2] == registers[4:6] == [0, 0x7FC0]
+
+def test_partial_frames_only_write_their_changed_channels():
+
+    channelLayout = makeLayout([[1, 103], [2, 104], [3, 2], [4, 2]])
+    channelLayout.update([(1, 103, 21.5), (2, 104, 40.0), (3, 2, 1.0), (4, 2, 2.0)])
+    writes(channelLayout)
+
+    # One channel, the others keep their values
+
+    channelLayout.update([(2, 104, 41.0)])
+
+    assert writes(channelLayout) == [(2, list(floatToRegisters(41.0)))]
+
+    # Neighbouring channels are merged into one range, others stay separate
+
+    channelLayout.update([(1, 103, 22.0), (2, 104, 42.0), (4, 2, 3.0)])
+
+    assert writes(channelLayout) == [(0, list(floatToRegisters(22.0)) + list(floatToRegisters(42.0))), (6, list(floatToRegisters(3.0)))]
+
+    # Unchanged values and channels left out write nothing
+
+    channelLayout.update([(1, 103, 22.0)])
+
+    assert writes(channelLayout) == []
+    assert writes(channelLayout) == []
+
+def test_multi_value_channels_span_their_registers():
+
+    channelLayout = makeLayout([[1, 0x71], [2, 103]])
+    channelLayout.update([(1, 0x71, (0.1, 0.2, 0.3)), (2, 103, 20.0)])
+    writes(channelLayout)
+
+    channelLayout.update([(1, 0x71, (0.1, 0.5, 0.3))])
+
+    assert writes(channelLayout) == [(0, [register for value in (0.1, 0.5, 0.3) for register in floatToRegisters(value)])]
+
+def test_new_channels_and_invalidation_write_the_whole_block():
+
+    channelLayout = makeLayout([[1, 103]])
+    channelLayout.update([(1, 103, 20.0)])
+    writes(channelLayout)
+
+    assert channelLayout.update([(1, 103, 20.0), (5, 103, 7.0)])
+    assert channelLayout.entries == [[1, 103], [5, 103]]
+    assert writes(channelLayout) == [(0, list(floatToRegisters(20.0)) + list(floatToRegisters(7.0)))]
+
+    channelLayout.invalidate()
+
+    assert [offset for offset, registers in writes(channelLayout)] == [0]
+
+    # Unknown cayenne types are ignored
+
+    assert not channelLayout.update([(6, 0xEE, 1.0)])
+
+def test_channels_past_the_block_are_truncated():
+
+    channelLayout = makeLayout([[1, 103], [2, 103], [3, 103]], maxValues=2)
+    channelLayout.update([(1, 103, 1.0), (2, 103, 2.0), (3, 103, 3.0)])
+
+    [(offset, registers)] = writes(channelLayout)
+
+    assert len(registers) == 4
+    assert channelLayout.truncated
+
+    channelLayout.update([(3, 103, 4.0)])
+
+    assert writes(channelLayout) == []
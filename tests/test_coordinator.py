@@ -0,0 +1,197 @@
+import asyncio, time
+from modules import variables
+from modules.coordinator import Coordinator
+from modules.ingestBridge import IngestBridge
+from benchmarks.simulatedCoordinator import SimulatedCoordinator
+
+# Coordinators on pseudo terminals answered by SimulatedCoordinator, no radio attached
+# Covers the frames and counters of each coordinator and the reconnect loop of Coordinator.run
+
+firstRadio = "0013A20041000001"
+secondRadio = "0013A20041000002"
+
+async def waitUntil(condition, timeout=10):
+
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+
+        if time.monotonic() > deadline:
+
+            raise AssertionError("condition not met in time")
+
+        await asyncio.sleep(0.02)
+
+async def stopCoordinators(tasks):
+
+    for task in tasks:
+
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def useCoordinators(monkeypatch, coordinators):
+
+    monkeypatch.setattr(variables, "coordinators", coordinators)
+    monkeypatch.setattr(variables, "coordinatorReconnectInterval", 0.1)
+    monkeypatch.setattr(variables, "radioFlag", False)
+
+def test_frames_are_tagged_and_counted_per_coordinator(monkeypatch):
+
+    simulators = [SimulatedCoordinator(serialLow=0x41000101), SimulatedCoordinator(serialLow=0x41000102)]
+
+    async def scenario():
+
+        bridge = IngestBridge(capacity=100)
+        coordinators = [Coordinator(simulator.port, bridge) for simulator in simulators]
+        useCoordinators(monkeypatch, coordinators)
+        tasks = [asyncio.create_task(coordinator.run()) for coordinator in coordinators]
+
+        try:
+
+            await waitUntil(lambda: all(coordinator.connected for coordinator in coordinators))
+
+            assert variables.radioFlag
+
+            for index in range(3):
+
+                simulators[0].sendFrame(firstRadio, bytes((1, 0x67, 0, index)))
+
+            for index in range(2):
+
+                simulators[1].sendFrame(secondRadio, bytes((2, 0x68, index)))
+
+            frames = [await asyncio.wait_for(bridge.get(), timeout=5) for index in range(5)]
+
+        finally:
+
+            await stopCoordinators(tasks)
+
+        return coordinators, frames
+
+    try:
+
+        coordinators, frames = asyncio.run(scenario())
+
+    finally:
+
+        for simulator in simulators:
+
+            simulator.close()
+
+    first, second = coordinators
+
+    assert sorted((mac, coordinator) for mac, data, coordinator, receivedAt in frames) == [(firstRadio, first.name)] * 3 + [(secondRadio, second.name)] * 2
+
+    assert first.stats()["framesReceived"] == 3
+    assert first.stats()["bytesReceived"] == 12
+    assert second.stats()["framesReceived"] == 2
+    assert second.stats()["bytesReceived"] == 6
+    assert first.stats()["reconnects"] == second.stats()["reconnects"] == 0
+
+    # Cancelled run tasks close their device
+
+    assert not first.connected and not second.connected
+    assert not variables.radioFlag
+
+def test_coordinator_reconnects_after_a_reported_error(monkeypatch):
+
+    simulator = SimulatedCoordinator()
+
+    async def scenario():
+
+        bridge = IngestBridge(capacity=100)
+        coordinator = Coordinator(simulator.port, bridge)
+        useCoordinators(monkeypatch, [coordinator])
+        task = asyncio.create_task(coordinator.run())
+
+        try:
+
+            await waitUntil(lambda: coordinator.connected)
+
+            firstDevice = coordinator.device
+
+            # What the error callback of the customized digi-xbee build does when the serial port fails
+
+            coordinator._disconnected.set()
+
+            await waitUntil(lambda: coordinator.reconnects == 1 and coordinator.connected)
+
+            assert coordinator.device is not firstDevice
+            assert not firstDevice.is_open()
+
+            simulator.sendFrame(firstRadio, b"\x01\x67\x00\xFA")
+            frame = await asyncio.wait_for(bridge.get(), timeout=5)
+
+        finally:
+
+            await stopCoordinators([task])
+
+        return coordinator, frame
+
+    try:
+
+        coordinator, frame = asyncio.run(scenario())
+
+    finally:
+
+        simulator.close()
+
+    assert frame[:3] == (firstRadio, b"\x01\x67\x00\xFA", coordinator.name)
+    assert coordinator.stats()["framesReceived"] == 1
+
+def test_coordinator_reconnects_after_its_port_vanished(monkeypatch):
+
+    unplugged = SimulatedCoordinator()
+    pluggedBack = SimulatedCoordinator()
+
+    async def scenario():
+
+        bridge = IngestBridge(capacity=100)
+        coordinator = Coordinator(unplugged.port, bridge)
+        useCoordinators(monkeypatch, [coordinator])
+        task = asyncio.create_task(coordinator.run())
+
+        try:
+
+            await waitUntil(lambda: coordinator.connected)
+
+            # Closing the pty master removes the slave path like unplugging the usb adapter removes /dev/ttyUSB0
+
+            unplugged.close()
+
+            await waitUntil(lambda: not coordinator.connected)
+
+            assert not variables.radioFlag
+            assert coordinator.reconnects == 1
+
+            # The adapter comes back, here on another pty path
+
+            coordinator.target = pluggedBack.port
+
+            await waitUntil(lambda: coordinator.connected)
+
+            assert coordinator.port == pluggedBack.port
+            assert variables.radioFlag
+
+            pluggedBack.sendFrame(secondRadio, b"\x02\x68\x50")
+            frame = await asyncio.wait_for(bridge.get(), timeout=5)
+
+        finally:
+
+            await stopCoordinators([task])
+
+        return coordinator, frame
+
+    try:
+
+        coordinator, frame = asyncio.run(scenario())
+
+    finally:
+
+        unplugged.close()
+        pluggedBack.close()
+
+    assert frame[:3] == (secondRadio, b"\x02\x68\x50", coordinator.name)
+    assert coordinator.stats()["reconnects"] == 1
+    assert coordinator.stats()["framesReceived"] == 1
@@ -0,0 +1,225 @@
+import asyncio, time
+from modules import variables
+from modules.coordinator import Coordinator
+from modules.ingestBridge import IngestBridge
+from modules.modbus import RegisterImage
+from modules.downlink import DownlinkQueue, encodeCommand, stateShift, counterMask, pointQueued, pointSent, pointFailed, pointRejected
+from benchmarks.downlinkBenchmark import FakeTransmitDevice
+
+# Client writes to the control registers of the shared register map, sent through a real Coordinator whose xbee
+# device is a FakeTransmitDevice
+# Covers coalescing, downlinkMinInterval per radio and the delivery status registers
+
+firstRadio = "0013A20041000001"
+secondRadio = "0013A20041000002"
+controlOffset = 40
+controlCount = 5
+blockRegisters = 50
+
+routes = [
+
+    {"xbeeMac": firstRadio, "modbusStartAddress": 0, "controlRange": (controlOffset, controlCount)},
+    {"xbeeMac": secondRadio, "modbusStartAddress": blockRegisters, "controlRange": (controlOffset, controlCount)}
+
+]
+
+def controlAddress(route, point):
+
+    return route["modbusStartAddress"] + controlOffset + point
+
+def readStatus(registerImage, route, point):
+
+    status = registerImage.read(route["modbusStartAddress"] + controlOffset + controlCount + point, 1)[0]
+
+    return status >> stateShift, status & counterMask
+
+async def waitUntil(condition, timeout=5):
+
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+
+        if time.monotonic() > deadline:
+
+            raise AssertionError("condition not met in time")
+
+        await asyncio.sleep(0.01)
+
+def makeDownlink(monkeypatch, minInterval=0.0, failRate=0.0, lppType=None):
+
+    device = FakeTransmitDevice(failRate)
+    coordinator = Coordinator("fake", IngestBridge(capacity=10))
+    coordinator.device = device
+    coordinator.connected = True
+
+    monkeypatch.setattr(variables, "coordinators", [coordinator])
+    monkeypatch.setattr(variables, "deviceContexts", None)
+
+    registerImage = RegisterImage(registerCount=2 * blockRegisters, sharedInputRegisters=True)
+    downlink = DownlinkQueue(registerImage, minInterval=minInterval, lppType=lppType)
+
+    assert downlink.sync(routes) == 2
+
+    return downlink, registerImage, coordinator, device
+
+async def runUntil(downlink, condition):
+
+    task = asyncio.create_task(downlink.run())
+
+    try:
+
+        await waitUntil(condition)
+
+    finally:
+
+        task.cancel()
+
+        await asyncio.gather(task, return_exceptions=True)
+
+def test_writes_waiting_for_a_radio_are_coalesced(monkeypatch):
+
+    downlink, registerImage, coordinator, device = makeDownlink(monkeypatch)
+    first = routes[0]
+
+    async def scenario():
+
+        downlink.clientWrite(None, controlAddress(first, 0), [5])
+        downlink.clientWrite(None, controlAddress(first, 0), [7, 9])
+        downlink.clientWrite(None, controlAddress(first, 4), [11])
+
+        # Writes next to the control registers are not control points
+
+        downlink.clientWrite(None, controlAddress(first, -1), [1])
+
+        assert readStatus(registerImage, first, 0) == (pointQueued, 0)
+        assert downlink.stats()["pendingPoints"] == 3
+
+        await runUntil(downlink, lambda: downlink.stats()["sent"] == 3)
+
+    asyncio.run(scenario())
+
+    stats = downlink.stats()
+
+    assert stats["clientWrites"] == 4
+    assert stats["coalesced"] == 1
+    assert stats["pendingRadios"] == 0
+
+    # One transmission with the last value of each point
+
+    assert [(mac, payload) for mac, payload, sentAt in device.transmissions] == [(firstRadio, encodeCommand({0: 7, 1: 9, 4: 11}, variables.downlinkChannelBase, variables.downlinkLppType)[0])]
+    assert coordinator.stats()["framesSent"] == 1
+
+    for point in (0, 1, 4):
+
+        assert readStatus(registerImage, first, point) == (pointSent, 1)
+
+    assert readStatus(registerImage, first, 2) == (0, 0)
+
+def test_a_radio_is_sent_at_most_once_per_min_interval(monkeypatch):
+
+    minInterval = 0.3
+    downlink, registerImage, coordinator, device = makeDownlink(monkeypatch, minInterval=minInterval)
+    first, second = routes
+
+    async def scenario():
+
+        task = asyncio.create_task(downlink.run())
+
+        try:
+
+            downlink.clientWrite(None, controlAddress(first, 0), [1])
+
+            await waitUntil(lambda: downlink.stats()["sent"] == 1)
+
+            # The first radio waits for its interval, the second one is not held back by it
+
+            downlink.clientWrite(None, controlAddress(first, 0), [2])
+            downlink.clientWrite(None, controlAddress(first, 0), [3])
+            downlink.clientWrite(None, controlAddress(second, 1), [4])
+
+            await waitUntil(lambda: downlink.stats()["sent"] == 2)
+
+            assert readStatus(registerImage, first, 0) == (pointQueued, 1)
+            assert readStatus(registerImage, second, 1) == (pointSent, 1)
+
+            await waitUntil(lambda: downlink.stats()["sent"] == 3)
+
+        finally:
+
+            task.cancel()
+
+            await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+    sendTimes = {}
+
+    for mac, payload, sentAt in device.transmissions:
+
+        sendTimes.setdefault(mac, []).append(sentAt)
+
+    assert [mac for mac, payload, sentAt in device.transmissions] == [firstRadio, secondRadio, firstRadio]
+    assert sendTimes[firstRadio][1] - sendTimes[firstRadio][0] >= minInterval * 0.95 # Recorded on a worker thread, a little after the interval started
+    assert sendTimes[secondRadio][0] - sendTimes[firstRadio][0] < minInterval
+    assert device.transmissions[-1][1] == encodeCommand({0: 3}, variables.downlinkChannelBase, variables.downlinkLppType)[0]
+    assert downlink.stats()["coalesced"] == 1
+
+    # The counter of a point counts its transmissions
+
+    assert readStatus(registerImage, first, 0) == (pointSent, 2)
+
+def test_failed_transmissions_show_in_the_status_registers(monkeypatch):
+
+    downlink, registerImage, coordinator, device = makeDownlink(monkeypatch, failRate=1.0)
+    first = routes[0]
+
+    async def scenario():
+
+        downlink.clientWrite(None, controlAddress(first, 2), [42])
+
+        await runUntil(downlink, lambda: downlink.stats()["failed"] == 1)
+
+    asyncio.run(scenario())
+
+    assert device.failures == 1
+    assert device.transmissions == []
+    assert downlink.stats()["sent"] == 0
+    assert coordinator.stats()["framesSent"] == 0
+    assert readStatus(registerImage, first, 2) == (pointFailed, 1)
+
+def test_values_the_cayenne_type_cannot_hold_are_rejected(monkeypatch):
+
+    # Digital Output holds one unsigned byte
+
+    downlink, registerImage, coordinator, device = makeDownlink(monkeypatch, lppType=0x01)
+    first = routes[0]
+
+    async def scenario():
+
+        downlink.clientWrite(None, controlAddress(first, 0), [300, 1])
+
+        await runUntil(downlink, lambda: downlink.stats()["sent"] == 1)
+
+    asyncio.run(scenario())
+
+    assert downlink.stats()["rejected"] == 1
+    assert readStatus(registerImage, first, 0) == (pointRejected, 0)
+    assert readStatus(registerImage, first, 1) == (pointSent, 1)
+    assert [payload for mac, payload, sentAt in device.transmissions] == [encodeCommand({1: 1}, variables.downlinkChannelBase, 0x01)[0]]
+
+def test_writes_without_a_connected_coordinator_fail(monkeypatch):
+
+    downlink, registerImage, coordinator, device = makeDownlink(monkeypatch)
+    coordinator.connected = False
+    second = routes[1]
+
+    async def scenario():
+
+        downlink.clientWrite(None, controlAddress(second, 3), [8])
+
+        await runUntil(downlink, lambda: downlink.stats()["failed"] == 1)
+
+    asyncio.run(scenario())
+
+    assert device.transmissions == []
+    assert readStatus(registerImage, second, 3) == (pointFailed, 1)
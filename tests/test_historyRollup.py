@@ -0,0 +1,27 @@
+import datetime
+from modules import historyRollup
+from modules.historyRollup import retentionSeconds
+
+# Retention of history and rollups, whose times are local naive datetimes read by the TTL monitor as UTC
+
+def test_retention_makes_up_for_the_utc_offset(monkeypatch):
+
+    monkeypatch.setattr(historyRollup, "utcOffsetSeconds", lambda: 2 * 3600)
+
+    # A sample taken at 12:00 UTC on a UTC+2 host is stored as 14:00 and expires exactly one day after it was taken
+
+    storedTimestamp = datetime.datetime(2026, 1, 1, 14, 0)
+    takenAt = datetime.datetime(2026, 1, 1, 12, 0)
+
+    assert storedTimestamp + datetime.timedelta(seconds=retentionSeconds(1)) == takenAt + datetime.timedelta(days=1)
+
+    monkeypatch.setattr(historyRollup, "utcOffsetSeconds", lambda: -5 * 3600)
+
+    assert retentionSeconds(1) == 86400 + 5 * 3600
+    assert retentionSeconds(None) is None
+
+def test_retention_never_goes_negative(monkeypatch):
+
+    monkeypatch.setattr(historyRollup, "utcOffsetSeconds", lambda: 14 * 3600)
+
+    assert retentionSeconds(0.25) == 0
@@ -0,0 +1,143 @@
+import datetime, sqlite3
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from pymongo.results import InsertManyResult, BulkWriteResult
+from modules import variables
+from modules.historySpool import HistorySpool
+from modules.historyStore import storeHistoryBatch
+
+# History batch writes against stand in collections that fail part of a write
+
+class PartlyFailingCollection:
+
+    # insert_many stores every document but the ones at failIndexes, like an unordered insert_many of mongodb
+
+    def __init__(self, failIndexes=()):
+
+        self.failIndexes = set(failIndexes)
+        self.documents = []
+
+    def insert_many(self, documents, ordered=True):
+
+        writeErrors = [{"index": index, "code": 121, "errmsg": "Document failed validation"} for index in range(len(documents)) if index in self.failIndexes]
+        self.documents.extend(document for index, document in enumerate(documents) if index not in self.failIndexes)
+
+        if writeErrors:
+
+            raise BulkWriteError({"writeErrors": writeErrors, "nInserted": len(documents) - len(writeErrors)})
+
+        return InsertManyResult(list(range(len(documents))), True)
+
+def historyDocuments(count):
+
+    start = datetime.datetime(2026, 1, 1, 12)
+
+    return [{"timestamp": start + datetime.timedelta(seconds=index), "data": [float(index)]} for index in range(count)]
+
+def test_per_radio_batch_only_hands_back_the_documents_that_failed():
+
+    gatewayDb = {"0013A20041000001": PartlyFailingCollection(failIndexes={1}), "0013A20041000002": PartlyFailingCollection()}
+    firstDocuments = historyDocuments(3)
+    secondDocuments = historyDocuments(2)
+    historyBatch = [("0013A20041000001", document) for document in firstDocuments] + [("0013A20041000002", document) for document in secondDocuments]
+
+    storedCount, failed, lastError = storeHistoryBatch(gatewayDb, historyBatch, "perRadio")
+
+    assert storedCount == 4
+    assert failed == [("0013A20041000001", firstDocuments[1])]
+    assert "failed validation" in lastError
+
+    # A retry of the failed entries does not write the stored ones again
+
+    gatewayDb["0013A20041000001"].failIndexes = set()
+
+    assert storeHistoryBatch(gatewayDb, failed, "perRadio") == (1, [], None)
+    assert [document["data"] for document in gatewayDb["0013A20041000001"].documents] == [[0.0], [2.0], [1.0]]
+
+class BucketCollection:
+
+    # Hour buckets collection holding the given buckets, bulk_write records the updates it receives
+
+    def __init__(self, buckets):
+
+        self.buckets = buckets
+        self.updates = []
+
+    def find(self, query, projection=None):
+
+        return [bucket for bucket in self.buckets if any(bucket["xbeeMac"] == bucketFilter["xbeeMac"] and bucket["bucketStart"] == bucketFilter["bucketStart"] for bucketFilter in query["$or"])]
+
+    def bulk_write(self, operations, ordered=True):
+
+        self.updates.extend(operations)
+
+        return BulkWriteResult({}, True)
+
+def test_spooled_documents_keep_their_id_across_drain_retries(tmp_path):
+
+    spool = HistorySpool(path=str(tmp_path / "spool.sqlite"), maxDocuments=100, evictionPolicy="dropOldest")
+
+    try:
+
+        spool.append([("0013A20041000001", document) for document in historyDocuments(3)])
+
+        firstDrain = spool.peek(10, withIds=True)
+        retriedDrain = spool.peek(10, withIds=True)
+
+        assert [document["_id"] for spoolId, mac, document in firstDrain] == [document["_id"] for spoolId, mac, document in retriedDrain]
+        assert len({document["_id"] for spoolId, mac, document in firstDrain}) == 3
+        assert all("_id" not in document for spoolId, mac, document in spool.peek(10))
+
+    finally:
+
+        spool.close()
+
+def test_spool_of_an_older_gateway_gets_document_ids(tmp_path):
+
+    path = str(tmp_path / "spool.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE historySpool (id INTEGER PRIMARY KEY AUTOINCREMENT, xbeeMac TEXT NOT NULL, timestamp REAL NOT NULL, data TEXT NOT NULL)")
+    connection.execute("INSERT INTO historySpool (xbeeMac, timestamp, data) VALUES ('0013A20041000001', 1767268800.0, '[1.0]')")
+    connection.commit()
+    connection.close()
+
+    spool = HistorySpool(path=path, maxDocuments=100, evictionPolicy="dropOldest")
+
+    try:
+
+        [(spoolId, mac, document)] = spool.peek(10, withIds=True)
+
+        assert isinstance(document["_id"], ObjectId)
+        assert spool.peek(10, withIds=True)[0][2]["_id"] == document["_id"]
+
+    finally:
+
+        spool.close()
+
+def test_hour_bucket_retry_only_pushes_samples_not_stored_yet(monkeypatch):
+
+    monkeypatch.setattr(variables, "historyCollectionName", "history")
+
+    documents = [{"_id": ObjectId(), **document} for document in historyDocuments(4)]
+    hourStart = documents[0]["timestamp"]
+
+    # The first two samples reached their bucket before the write was reported as failed, a newer sample joins the retry
+
+    history = BucketCollection([{"xbeeMac": "0013A20041000001", "bucketStart": hourStart, "samples": [{"_id": documents[0]["_id"]}, {"_id": documents[1]["_id"]}]}])
+    historyBatch = [("0013A20041000001", document) for document in documents]
+
+    assert storeHistoryBatch({"history": history}, historyBatch, "hourBuckets") == (4, [], None)
+
+    [update] = history.updates
+
+    assert [sample["_id"] for sample in update._doc["$push"]["samples"]["$each"]] == [documents[2]["_id"], documents[3]["_id"]]
+    assert update._doc["$inc"] == {"count": 2}
+    assert update._filter["samples._id"] == {"$ne": documents[2]["_id"]}
+
+    # Everything already stored, nothing is written
+
+    history.buckets[0]["samples"] += [{"_id": documents[2]["_id"]}, {"_id": documents[3]["_id"]}]
+    history.updates = []
+
+    assert storeHistoryBatch({"history": history}, historyBatch, "hourBuckets") == (4, [], None)
+    assert history.updates == []
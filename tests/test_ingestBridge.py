@@ -0,0 +1,92 @@
+import asyncio, threading
+import pytest
+from modules.ingestBridge import IngestBridge
+
+# Bridge between the xbee reader threads and the event loop, its overflow policies and counters
+
+def drain(bridge):
+
+    frames = []
+
+    while True:
+
+        frame = bridge.getNowait()
+
+        if frame is None:
+
+            return frames
+
+        frames.append(frame)
+
+def test_drop_oldest_keeps_the_newest_frames():
+
+    bridge = IngestBridge(capacity=3, overflowPolicy="dropOldest")
+
+    for index in range(5):
+
+        assert bridge.put("0013A20041000001", bytes((index,)), "coordinator", index)
+
+    assert [frame[1] for frame in drain(bridge)] == [b"\x02", b"\x03", b"\x04"]
+    assert bridge.stats() == {"capacity": 3, "overflowPolicy": "dropOldest", "depth": 0, "received": 5, "dropped": 2, "coalesced": 0}
+
+def test_drop_newest_rejects_frames_once_full():
+
+    bridge = IngestBridge(capacity=3, overflowPolicy="dropNewest")
+
+    accepted = [bridge.put("0013A20041000001", bytes((index,))) for index in range(5)]
+
+    assert accepted == [True, True, True, False, False]
+    assert [frame[1] for frame in drain(bridge)] == [b"\x00", b"\x01", b"\x02"]
+    assert bridge.stats()["dropped"] == 2
+
+def test_coalesce_keeps_the_newest_frame_of_each_radio_in_its_queue_position():
+
+    bridge = IngestBridge(capacity=3, overflowPolicy="coalesce")
+
+    bridge.put("0013A20041000001", b"\x01", "first", 1.0)
+    bridge.put("0013A20041000002", b"\x02", "first", 2.0)
+    bridge.put("0013A20041000001", b"\x03", "second", 3.0)
+
+    assert drain(bridge) == [("0013A20041000001", b"\x03", "second", 3.0), ("0013A20041000002", b"\x02", "first", 2.0)]
+    assert bridge.stats()["coalesced"] == 1
+
+    # A radio whose frame was taken queues again, a full bridge drops the oldest radio
+
+    for index in range(5):
+
+        bridge.put(f"0013A2004100001{index}", bytes((index,)))
+
+    bridge.put("0013A20041000013", b"\xFF")
+
+    assert [frame[:2] for frame in drain(bridge)] == [("0013A20041000012", b"\x02"), ("0013A20041000013", b"\xFF"), ("0013A20041000014", b"\x04")]
+    assert bridge.stats()["dropped"] == 2
+    assert bridge.stats()["coalesced"] == 2
+
+def test_invalid_settings_are_rejected():
+
+    with pytest.raises(ValueError):
+
+        IngestBridge(capacity=10, overflowPolicy="dropAll")
+
+    with pytest.raises(ValueError):
+
+        IngestBridge(capacity=0, overflowPolicy="dropOldest")
+
+def test_frames_put_from_a_reader_thread_wake_the_consumer():
+
+    async def scenario():
+
+        bridge = IngestBridge(capacity=100, overflowPolicy="dropOldest")
+        bridge.bindLoop()
+        consumer = asyncio.create_task(asyncio.wait_for(asyncio.gather(*(bridge.get() for _ in range(2))), timeout=5))
+
+        await asyncio.sleep(0.01)
+
+        reader = threading.Thread(target=lambda: [bridge.put("0013A20041000001", bytes((index,))) for index in range(2)])
+        reader.start()
+        frames = await consumer
+        reader.join()
+
+        return frames
+
+    assert sorted(frame[1] for frame in asyncio.run(scenario())) == [b"\x00", b"\x01"]
@@ -0,0 +1,45 @@
+import socket, asyncio, threading
+from modules.metrics import GatewayMetrics, metricsServer
+
+# Prometheus endpoint of the gateway
+
+def test_metrics_server_returns_when_its_port_is_taken(caplog):
+
+    with socket.socket() as taken:
+
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        port = taken.getsockname()[1]
+
+        # Returns instead of raising, the gateway tasks gathered with it keep running
+
+        assert asyncio.run(asyncio.wait_for(metricsServer("127.0.0.1", port), timeout=5)) is None
+
+    assert "running without metrics" in caplog.text
+
+def test_packets_recorded_by_concurrent_reader_threads_are_all_counted():
+
+    metrics = GatewayMetrics()
+    radios = [f"0013A2004100000{index}" for index in range(4)]
+    packetsPerThread = 20000
+
+    def reader():
+
+        # One thread per coordinator, each hearing every radio
+
+        for index in range(packetsPerThread):
+
+            metrics.recordPacket(radios[index % len(radios)])
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+
+    for thread in readers:
+
+        thread.start()
+
+    for thread in readers:
+
+        thread.join()
+
+    assert metrics.packetsReceived == 4 * packetsPerThread
+    assert {mac: radio[0] for mac, radio in metrics.radioPackets.items()} == {mac: packetsPerThread for mac in radios}
@@ -0,0 +1,148 @@
+import asyncio, time
+from modules.ingestBridge import IngestBridge
+from modules.processingPool import ShardedProcessingStage, shardForMac
+
+# Sharded processing stage fed from an ingest bridge, frames of one radio stay on one shard
+
+blockedRadio = "0013A20041000000"
+movingRadio = "0013A20041000001"
+
+async def waitUntil(condition, timeout=5):
+
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+
+        if time.monotonic() > deadline:
+
+            raise AssertionError("condition not met in time")
+
+        await asyncio.sleep(0.01)
+
+def test_a_full_shard_does_not_hold_back_the_other_shards():
+
+    assert shardForMac(blockedRadio, 2) != shardForMac(movingRadio, 2)
+
+    processed = []
+    started = []
+
+    async def scenario():
+
+        release = asyncio.Event()
+
+        async def processFrame(xbeeMacAddress, xbeeDataAsByte, coordinator, receivedAt):
+
+            started.append(xbeeMacAddress)
+
+            if xbeeMacAddress == blockedRadio:
+
+                await release.wait()
+
+            processed.append((xbeeMacAddress, xbeeDataAsByte))
+
+        bridge = IngestBridge(capacity=100)
+        bridge.bindLoop()
+        stage = ShardedProcessingStage(bridge, processFrame, workerCount=2, shardCapacity=2, decodeOffload=None, shardOverflowPolicy="dropOldest")
+        task = asyncio.create_task(stage.run())
+        blockedShard = shardForMac(blockedRadio, 2)
+        movingShard = shardForMac(movingRadio, 2)
+
+        try:
+
+            bridge.put(blockedRadio, b"\x00")
+
+            await waitUntil(lambda: started == [blockedRadio])
+
+            for index in range(1, 10):
+
+                bridge.put(blockedRadio, bytes((index,)))
+
+            await waitUntil(lambda: bridge.qsize() == 0)
+
+            # The blocked shard holds its 2 newest frames, the older ones were dropped instead of stalling the dispatcher
+
+            for index in range(5):
+
+                bridge.put(movingRadio, bytes((index,)))
+
+                await waitUntil(lambda: len(processed) == index + 1)
+
+            stats = stage.stats()
+
+            assert stats["shardDepths"][blockedShard] == 2
+            assert stats["droppedFrames"][blockedShard] == 7
+            assert stats["droppedFrames"][movingShard] == 0
+            assert stats["processedFrames"][movingShard] == 5
+
+            release.set()
+
+            await waitUntil(lambda: len(processed) == 8)
+
+        finally:
+
+            task.cancel()
+
+            await asyncio.gather(task, return_exceptions=True)
+
+        return stage
+
+    stage = asyncio.run(scenario())
+
+    assert processed[:5] == [(movingRadio, bytes((index,))) for index in range(5)]
+    assert processed[5:] == [(blockedRadio, bytes((index,))) for index in (0, 8, 9)]
+    assert stage.stats()["processedFrames"][shardForMac(blockedRadio, 2)] == 3
+
+def test_coalescing_shards_keep_the_newest_frame_of_each_radio():
+
+    processed = []
+    started = []
+
+    async def scenario():
+
+        release = asyncio.Event()
+
+        async def processFrame(xbeeMacAddress, xbeeDataAsByte, coordinator, receivedAt):
+
+            started.append(xbeeMacAddress)
+
+            await release.wait()
+
+            processed.append((xbeeMacAddress, xbeeDataAsByte))
+
+        bridge = IngestBridge(capacity=100)
+        bridge.bindLoop()
+        stage = ShardedProcessingStage(bridge, processFrame, workerCount=1, shardCapacity=10, decodeOffload=None, shardOverflowPolicy="coalesce")
+        task = asyncio.create_task(stage.run())
+
+        try:
+
+            bridge.put(blockedRadio, b"\x00")
+
+            await waitUntil(lambda: started == [blockedRadio])
+
+            for index in range(1, 4):
+
+                bridge.put(blockedRadio, bytes((index,)))
+                bridge.put(movingRadio, bytes((index,)))
+
+            await waitUntil(lambda: bridge.qsize() == 0)
+
+            release.set()
+
+            await waitUntil(lambda: len(processed) == 3)
+
+        finally:
+
+            task.cancel()
+
+            await asyncio.gather(task, return_exceptions=True)
+
+        return stage
+
+    stage = asyncio.run(scenario())
+
+    # The first frame was already being processed, the waiting frames of each radio collapsed into its newest one
+
+    assert processed == [(blockedRadio, b"\x00"), (blockedRadio, b"\x03"), (movingRadio, b"\x03")]
+    assert stage.stats()["coalescedFrames"] == [4]
+    assert stage.stats()["droppedFrames"] == [0]
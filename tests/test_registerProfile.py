@@ -0,0 +1,60 @@
+import math
+import pytest
+from modules.modbus import ProfileEncoder, validateRegisterProfile
+
+# Register profiles: per value types, scales and register orders of a radio's block
+
+@pytest.mark.parametrize("order, registers", [
+
+    ("ABCD", [0x1122, 0x3344]),
+    ("CDAB", [0x3344, 0x1122]),
+    ("BADC", [0x2211, 0x4433]),
+    ("DCBA", [0x4433, 0x2211])
+
+])
+def test_32_bit_orders(order, registers):
+
+    encoder = ProfileEncoder([{"type": "uint32", "order": order}, {"type": "float32", "order": order}], 10)
+    floatRegisters = {"ABCD": [0x3F80, 0x0000], "CDAB": [0x0000, 0x3F80], "BADC": [0x803F, 0x0000], "DCBA": [0x0000, 0x803F]}[order]
+
+    assert list(encoder.encode([0x11223344, 1.0])) == registers + floatRegisters
+
+def test_int16_is_scaled_rounded_and_clamped():
+
+    encoder = ProfileEncoder([{"type": "int16", "scale": 10}], 10)
+
+    assert list(encoder.encode([21.57, -1.0, 5000.0, -5000.0, math.nan])) == [216, 0xFFF6, 0x7FFF, 0x8000, 0]
+
+def test_uint32_is_clamped_to_its_range():
+
+    encoder = ProfileEncoder([{"type": "uint32", "order": "ABCD"}], 10)
+
+    assert list(encoder.encode([-5.0, 2.0 ** 40, math.nan])) == [0, 0, 0xFFFF, 0xFFFF, 0, 0]
+
+def test_last_entry_applies_to_further_values_and_the_block_truncates():
+
+    encoder = ProfileEncoder(["int16", {"type": "uint32", "order": "ABCD"}], 5)
+
+    assert list(encoder.encode([1.0, 2.0, 3.0])) == [1, 0, 2, 0, 3]
+    assert not encoder.truncated
+
+    assert list(encoder.encode([1.0, 2.0, 3.0, 4.0])) == [1, 0, 2, 0, 3]
+    assert encoder.truncated
+    assert encoder.registerOffsets(4) == [0, 1, 3, 5]
+
+@pytest.mark.parametrize("profile", [
+
+    [],
+    ["int8"],
+    [{"type": "int16", "scale": 0}],
+    [{"type": "uint32", "order": "ACBD"}],
+    [{"type": "int16", "offset": 3}]
+
+])
+def test_invalid_profiles_are_reported(profile):
+
+    assert validateRegisterProfile(profile) is not None
+
+def test_valid_profile():
+
+    assert validateRegisterProfile([{"type": "int16", "scale": 10}, {"type": "float32", "order": "abcd"}, "uint32"]) is None
@@ -0,0 +1,70 @@
+from modules import variables
+from modules.routingCache import RoutingCache
+
+# Routing cache reloads, as done on every routingCacheResyncInterval resync
+
+radio = {"xbeeMac": "0013a20041000001", "modbusStartAddress": 0, "modbusEndAddress": 19}
+
+def useChannelLayouts(monkeypatch):
+
+    monkeypatch.setattr(variables, "registerLayoutMode", "channel")
+    monkeypatch.setattr(variables, "modbusAddressingMode", "shared")
+    monkeypatch.setattr(variables, "downlinkEnabled", False)
+
+def writtenRanges(channelLayout):
+
+    return [(offset, list(registers)) for offset, registers in channelLayout.changedRanges()]
+
+def test_reload_keeps_the_channel_layout_of_an_unchanged_radio(monkeypatch):
+
+    useChannelLayouts(monkeypatch)
+    routingCache = RoutingCache()
+    routingCache.load([radio])
+
+    channelLayout = routingCache.lookupRoute(radio["xbeeMac"])["channelLayout"]
+    channelLayout.update([(1, 103, 21.5), (2, 104, 40.0)])
+    firstWrite = writtenRanges(channelLayout)
+
+    assert [offset for offset, registers in firstWrite] == [0]
+
+    routingCache.load([{**radio, "registerLayout": [[1, 103], [2, 104]]}])
+    route = routingCache.lookupRoute(radio["xbeeMac"])
+
+    assert route["channelLayout"] is channelLayout
+
+    # Only channel 1 is written, channel 2 keeps its 40.0 instead of being overwritten with NaN
+
+    route["channelLayout"].update([(1, 103, 22.0)])
+    secondWrite = writtenRanges(route["channelLayout"])
+    expected = route["registerEncoder"].encode([22.0, 40.0])
+
+    assert secondWrite == [(0, list(expected[0:2]))]
+    assert list(expected[2:4]) == firstWrite[0][1][2:4]
+
+def test_reload_rebuilds_the_channel_layout_when_the_radio_changed(monkeypatch):
+
+    useChannelLayouts(monkeypatch)
+    routingCache = RoutingCache()
+    routingCache.load([radio])
+
+    channelLayout = routingCache.lookupRoute(radio["xbeeMac"])["channelLayout"]
+    channelLayout.update([(1, 103, 21.5)])
+    channelLayout.changedRanges()
+
+    # A bigger block is a new encoder, its layout is written in full again
+
+    routingCache.load([{**radio, "modbusEndAddress": 39}])
+    route = routingCache.lookupRoute(radio["xbeeMac"])
+
+    assert route["channelLayout"] is not channelLayout
+    assert route["channelLayout"].entries == [[1, 103]]
+
+    route["channelLayout"].update([(1, 103, 21.5)])
+
+    assert [offset for offset, registers in route["channelLayout"].changedRanges()] == [0]
+
+    # A layout edited by hand replaces the learned one
+
+    routingCache.load([{**radio, "modbusEndAddress": 39, "registerLayout": [[2, 104], [1, 103]]}])
+
+    assert routingCache.lookupRoute(radio["xbeeMac"])["channelLayout"].entries == [[2, 104], [1, 103]]
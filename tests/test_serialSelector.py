@@ -0,0 +1,19 @@
+import logging
+import serial.tools.list_ports
+from modules.serialSelector import selectUsbPort
+
+# Serial port selection, called for every missing coordinator on each reconnect attempt
+
+def test_missing_port_is_logged_with_a_rate_limit_key(monkeypatch, caplog, capsys):
+
+    monkeypatch.setattr(serial.tools.list_ports, "comports", lambda: [])
+
+    with caplog.at_level(logging.WARNING):
+
+        assert selectUsbPort(serialNumber="SER=A10KXYZ") is None
+
+    [record] = caplog.records
+
+    assert record.rateLimitKey == "SER=A10KXYZ"
+    assert "python -m modules.serialSelector -g" in record.getMessage()
+    assert capsys.readouterr().out == ""
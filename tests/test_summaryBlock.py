@@ -0,0 +1,44 @@
+import logging
+from modules import variables
+from modules.modbus import RegisterImage
+from modules.summaryBlock import SummaryBlock, configuredBit
+
+# Summary block slots built from the routing table
+
+def makeSummaryBlock(monkeypatch):
+
+    monkeypatch.setattr(variables, "lowestRegister", 0)
+    monkeypatch.setattr(variables, "incrementalModbusAddress", 40)
+
+    registerImage = RegisterImage(registerCount=2000, sharedInputRegisters=True)
+
+    return SummaryBlock(registerImage, startAddress=1000, channels=[0], maxRadios=10, staleAfter=60), registerImage
+
+def test_radios_sharing_a_slot_are_logged_and_only_the_first_is_summarised(monkeypatch, caplog):
+
+    summaryBlock, registerImage = makeSummaryBlock(monkeypatch)
+
+    # 20 register blocks, both map to slot 0 with a 40 register increment
+
+    routes = [
+
+        {"xbeeMac": "0013A20041000002", "modbusStartAddress": 20},
+        {"xbeeMac": "0013A20041000001", "modbusStartAddress": 0},
+        {"xbeeMac": "0013A20041000003", "modbusStartAddress": 40}
+
+    ]
+
+    with caplog.at_level(logging.WARNING):
+
+        assert summaryBlock.sync(routes) == 2
+
+    assert "0013A20041000002 at register 20 shares summary slot 0 with 0013A20041000001" in caplog.text
+
+    summaryBlock.recordFrame("0013A20041000002")
+
+    assert registerImage.read(1000, 1)[0] == configuredBit
+
+    summaryBlock.recordFrame("0013A20041000001")
+
+    assert registerImage.read(1000, 1)[0] & 0x3FFF == 1
+    assert registerImage.read(1003, 1)[0] == configuredBit